@@ -32,6 +32,7 @@ from . import model
 class ClouderApplicationTag(models.Model):
 
     _name = 'clouder.application.tag'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
     application_ids = fields.Many2many(
@@ -50,6 +51,7 @@ class ClouderApplicationType(models.Model):
     """
 
     _name = 'clouder.application.type'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
     system_user = fields.Char('System User', required=True)
@@ -66,6 +68,17 @@ class ClouderApplicationType(models.Model):
     tag_ids = fields.Many2many(
         'clouder.application.tag', 'clouder_application_type_tag_rel',
         'type_id', 'tag_id', 'Tags')
+    readiness_type = fields.Selection([
+        ('running', 'Container running'), ('port', 'TCP port open'),
+        ('http', 'HTTP 200'), ('command', 'Command succeeds'),
+        ('health', 'Docker health status')], 'Readiness check',
+        required=True, default='running')
+    readiness_port = fields.Char(
+        'Readiness port', help='Name of the port checked by the TCP and '
+                               'HTTP checks.')
+    readiness_path = fields.Char('Readiness HTTP path', default='/')
+    readiness_command = fields.Char('Readiness command')
+    readiness_timeout = fields.Integer('Readiness timeout', default=120)
 
     _sql_constraints = [
         ('name_uniq', 'unique(name)', 'Name must be unique!'),
@@ -95,6 +108,7 @@ class ClouderApplicationTypeOption(models.Model):
     """
 
     _name = 'clouder.application.type.option'
+    _inherit = ['clouder.property.invalidation']
 
     application_type_id = fields.Many2one(
         'clouder.application.type',
@@ -142,6 +156,7 @@ class ClouderApplicationTemplate(models.Model):
     """
 
     _name = 'clouder.application.template'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
     link_ids = fields.One2many('clouder.application.link', 'template_id',
@@ -155,6 +170,7 @@ class ClouderApplication(models.Model):
     """
 
     _name = 'clouder.application'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
     code = fields.Char('Code', required=True)
@@ -393,6 +409,7 @@ class ClouderApplicationOption(models.Model):
     """
 
     _name = 'clouder.application.option'
+    _inherit = ['clouder.property.invalidation']
 
     application_id = fields.Many2one('clouder.application', 'Application',
                                      ondelete="cascade", required=False)
@@ -447,6 +464,7 @@ class ClouderApplicationMetadata(models.Model):
     """
 
     _name = 'clouder.application.metadata'
+    _inherit = ['clouder.property.invalidation']
 
     application_id = fields.Many2one(
         'clouder.application', 'Application',
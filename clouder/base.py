@@ -199,7 +199,7 @@ class ClouderBase(models.Model):
         return self.container_id.childs['exec'] and \
             self.container_id.childs['exec'].ports['http']['hostport']
 
-    @property
+    @model.cached_property
     def options(self):
         """
         Property returning a dictionary containing the value of all options
@@ -217,7 +217,7 @@ class ClouderBase(models.Model):
                                          'value': option.value}
         return options
 
-    @property
+    @model.cached_property
     def links(self):
         """
         Property returning a dictionary containing the value of all links
@@ -953,6 +953,7 @@ class ClouderBaseOption(models.Model):
     to a base.
     """
     _name = 'clouder.base.option'
+    _inherit = ['clouder.property.invalidation']
 
     base_id = fields.Many2one('clouder.base', 'Base', ondelete="cascade",
                               required=True)
@@ -1156,6 +1157,7 @@ class ClouderBaseMetadata(models.Model):
     """
 
     _name = 'clouder.base.metadata'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Many2one(
         'clouder.application.metadata', 'Application Metadata',
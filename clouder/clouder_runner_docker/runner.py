@@ -21,12 +21,19 @@
 ##############################################################################
 
 from openerp import models, api, modules
-import time
+import hashlib
+import json
 from datetime import datetime
 
 import logging
 _logger = logging.getLogger(__name__)
 
+# Number of cached builds kept on a server for each image
+BUILD_CACHE_SIZE = 3
+
+# Minutes after which the parent image of a build is pulled again
+BUILD_PULL_TTL = 24 * 60
+
 
 class ClouderImage(models.Model):
     """
@@ -35,45 +42,151 @@ class ClouderImage(models.Model):
 
     _inherit = 'clouder.image'
 
+    @property
+    def sources_path(self):
+        """
+        Property returning the local path of the sources sent with the
+        Dockerfile, or False if there are none.
+        """
+        sources_path = False
+        if self.type_id:
+            if self.type_id.name in \
+                    ['backup', 'salt-master', 'salt-minion']:
+                sources_path = \
+                    modules.get_module_path('clouder') + '/sources'
+            else:
+                module_path = modules.get_module_path(
+                    'clouder_template_' + self.type_id.name
+                )
+                sources_path = module_path and module_path + '/sources'
+        if sources_path and self.env['clouder.model']\
+                .local_dir_exist(sources_path):
+            return sources_path
+        return False
+
+    @api.multi
+    def build_parent_digest(self, server):
+        """
+        Pull the parent image on the server if it was not pulled for
+        BUILD_PULL_TTL minutes, and return its registry digest, or its id
+        when it has none.
+
+        The pull time is kept in a marker file on the server, so the
+        updates of the parent are picked up by every server, and the builds
+        made with salt or directly use the same parent.
+
+        :param server: The docker host where the image is built.
+        """
+        if self.parent_id and self.parent_version_id:
+            parent = self.parent_version_id.fullpath
+        else:
+            parent = self.parent_from
+        marker = '/tmp/clouder-pull-' + \
+            hashlib.sha1(parent.encode('utf-8')).hexdigest()
+        server.execute([
+            'find', marker, '-mmin', '-' + str(BUILD_PULL_TTL),
+            '2>/dev/null', '|', 'grep', '-q', '.', '||',
+            '{', 'docker', 'pull', parent, '>/dev/null', '&&',
+            'touch', marker, ';', '}'])
+        digest = server.execute([
+            'docker', 'inspect', "--format='{{index .RepoDigests 0}}'",
+            parent, '2>/dev/null']).strip()
+        if not digest or not digest.startswith(parent.split(':')[0]):
+            digest = server.execute([
+                'docker', 'inspect', '--format={{.Id}}', parent,
+                '2>/dev/null']).strip()
+        return digest
+
+    @api.multi
+    def build_cache_name(self, server, expose_ports):
+        """
+        Return the name of the cached image for this build, computed from
+        the Dockerfile, the sources and the digest of the parent image, so
+        identical builds get the same name. See build_parent_digest for the
+        pull of the parent image.
+
+        :param server: The docker host where the container is deployed.
+        :param expose_ports: The ports added to the Dockerfile.
+        """
+        digest = self.build_parent_digest(server)
+
+        checksum = hashlib.sha1()
+        checksum.update(self.computed_dockerfile.encode('utf-8') + '\0')
+        checksum.update(' '.join([str(p) for p in expose_ports]) + '\0')
+        checksum.update(digest + '\0')
+        if self.sources_path:
+            checksum.update(self.env['clouder.model'].local_dir_checksum(
+                self.sources_path))
+        return self.name.lower() + '-build:' + checksum.hexdigest()[:16]
+
+    @api.multi
+    def build_cache_clean(self, server):
+        """
+        Remove the oldest cached images of this image from the server,
+        only the last ones given by BUILD_CACHE_SIZE are kept. The images
+        still used by a container are kept by docker.
+
+        :param server: The docker host to clean.
+        """
+        repository = self.name.lower() + '-build'
+        tags = server.execute([
+            'docker', 'images', '--format={{.Tag}}', repository]).split()
+        for tag in tags[BUILD_CACHE_SIZE:]:
+            server.execute([
+                'docker', 'rmi', repository + ':' + tag, '2>/dev/null'])
+
     def build_image(
-            self, model, server, runner=False, expose_ports=None, salt=True):
+            self, model, server, runner=False, expose_ports=None, salt=True,
+            build_name=False):
+        """
+        Build the image, or only prepare its build directory on the salt
+        master if salt is True.
+
+        When building for a container, the image is named after the
+        content of the build, and an existing image with this name is
+        reused instead of being rebuilt.
+
+        :param build_name: Name of the build directory and image, used
+        instead of the model name when the build is shared by several
+        containers.
+        """
 
         if not expose_ports:
             expose_ports = []
 
         res = super(ClouderImage, self).build_image(
-            model, server, runner=runner, expose_ports=expose_ports, salt=salt)
+            model, server, runner=runner, expose_ports=expose_ports, salt=salt,
+            build_name=build_name)
 
         if not runner or runner.application_id.type_id.name == 'docker':
 
-            path = model.name + '-' + datetime.now().strftime('%Y%m%d.%H%M%S')
+            path = (build_name or model.name) + '-' + \
+                datetime.now().strftime('%Y%m%d.%H%M%S')
+            cache = False
             if model._name == 'clouder.container':
                 name = path
+                cache = self.build_cache_name(model.server_id, expose_ports)
             else:
                 name = model.fullpath
 
             if salt:
-                build_dir = '/srv/salt/containers/build_' + model.name
+                build_dir = '/srv/salt/containers/build_' + \
+                    (build_name or model.name)
                 server = model.salt_master
             else:
                 build_dir = '/tmp/' + name
 
+            if cache and not salt and server.execute([
+                    'docker', 'images', '-q', cache]).strip():
+                _logger.info('Reuse the cached image %s', cache)
+                server.execute(['docker', 'tag', cache, name])
+                return name
+
             server.execute(['rm', '-rf', build_dir])
             server.execute(['mkdir', '-p', build_dir])
 
-            if self.type_id:
-                if self.type_id.name in \
-                        ['backup', 'salt-master', 'salt-minion']:
-                    sources_path = \
-                        modules.get_module_path('clouder') + '/sources'
-                else:
-                    module_path = modules.get_module_path(
-                        'clouder_template_' + self.type_id.name
-                    )
-                    sources_path = module_path and module_path + '/sources'
-                if sources_path and self.env['clouder.model']\
-                        .local_dir_exist(sources_path):
-                    server.send_dir(sources_path, build_dir + '/sources')
+            if self.sources_path:
+                server.send_dir(self.sources_path, build_dir + '/sources')
 
             server.execute([
                 'echo "' + self.computed_dockerfile.replace('"', r'\\"') +
@@ -84,10 +197,18 @@ class ClouderImage(models.Model):
                     'echo "' + 'EXPOSE ' + ' '.join(expose_ports) +
                     '" >> ' + build_dir + '/Dockerfile'])
 
-            if not salt:
-                server.execute(
-                    ['docker', 'build', '--pull', '-t', name, build_dir])
-                server.execute(['rm', '-rf', build_dir])
+            if salt:
+                # The minion skips the build if it already has the image
+                return cache or name
+
+            # The parent of a cached build was pulled by build_cache_name
+            server.execute(
+                ['docker', 'build'] + (not cache and ['--pull'] or []) +
+                ['-t', cache or name, build_dir])
+            server.execute(['rm', '-rf', build_dir])
+            if cache:
+                server.execute(['docker', 'tag', cache, name])
+                self.build_cache_clean(server)
 
             return name
         return res
@@ -187,16 +308,16 @@ class ClouderContainer(models.Model):
 
             if not self.application_id.check_tags(['no-salt']):
 
-                self.deploy_salt()
+                image = self.deploy_salt()
+                # Only rescan the roots backend for the new build directory
                 self.salt_master.execute([
-                    'rm', '-rf', '/var/cache/salt/master/file_lists/roots/'])
+                    'salt-run', 'fileserver.update', 'backend=roots'])
                 self.salt_master.execute([
                     'salt', self.server_id.fulldomain, 'state.apply',
                     'container_deploy',
                     "pillar=\"{'container_name': '" + self.name +
-                    "', 'image': '" + self.name + '-' +
-                    datetime.now().strftime('%Y%m%d.%H%M%S') +
-                    "', 'build': True}\""])
+                    "', 'image': '" + image + "', 'build': True}\""])
+                self.image_id.build_cache_clean(self.server_id)
 
             else:
 
@@ -230,6 +351,128 @@ class ClouderContainer(models.Model):
 
         return res
 
+    @api.multi
+    def hook_deploy_batch(self):
+        """
+        Deploy several containers with one salt state run per minion.
+
+        The containers sharing the same Dockerfile are built once, the
+        pillars of each minion are written with one command, and the
+        result of each container deploy is stored in its own clouder.job.
+        The containers which are not deployed with salt use hook_deploy.
+
+        Return the containers which failed.
+        """
+        salted = self.filtered(
+            lambda c: (not c.server_id.runner_id or
+                       c.server_id.runner_id.application_id.type_id.name ==
+                       'docker') and
+            not c.application_id.check_tags(['no-salt']))
+        failed = super(ClouderContainer, self - salted).hook_deploy_batch()
+        if not salted:
+            return failed
+
+        job_obj = self.env['clouder.job']
+        jobs = {}
+        builds = {}
+        deploys = {}
+        minions = {}
+        for container in salted:
+            jobs[container.id] = job_obj.create({
+                'name': 'deploy_batch', 'action': 'hook_deploy_batch',
+                'model_name': container._name, 'res_id': container.id,
+                'start_date': self.now, 'state': 'started'})
+            res = container.get_container_res()
+            key = hashlib.sha1((
+                str(container.image_id.id) + '\n' +
+                container.image_id.computed_dockerfile + '\n' +
+                ' '.join([str(p) for p in res['expose_ports']])
+            ).encode('utf-8')).hexdigest()[:12]
+            if key not in builds:
+                build_name = container.image_id.name + '-' + key
+                builds[key] = {
+                    'image': container.image_id.build_image(
+                        container, container.salt_master,
+                        expose_ports=res['expose_ports'],
+                        build_name=build_name),
+                    'dir': 'build_' + build_name,
+                    'from': container.image_id.parent_from}
+            deploys[container.id] = {
+                'container_name': container.name,
+                'image': builds[key]['image'], 'build': key}
+            minions.setdefault(container.server_id, self.browse())
+            minions[container.server_id] |= container
+        # Only rescan the roots backend for the new build directories
+        self.salt_master.execute([
+            'salt-run', 'fileserver.update', 'backend=roots'])
+
+        for server, containers in minions.iteritems():
+            # The output of the state run goes in the jobs of all the
+            # containers of the minion
+            batch = self.with_context(clouder_jobs=dict(
+                (c._name + '_' + str(c.id), jobs[c.id].id)
+                for c in containers))
+            pillars = {}
+            for container in containers:
+                pillars.update(container.salt_pillars())
+            pillar = {
+                'containers': [deploys[c.id] for c in containers],
+                'builds': dict((deploys[c.id]['build'],
+                                builds[deploys[c.id]['build']])
+                               for c in containers)}
+            states = {}
+            try:
+                server.write_salt_pillars(pillars)
+                states = json.loads(batch.salt_master.execute([
+                    'salt', server.fulldomain, 'state.apply',
+                    'containers_deploy', "pillar='" + json.dumps(pillar) + "'",
+                    '--out=json', '--static']) or '{}').get(
+                        server.fulldomain, {})
+            except Exception as e:
+                batch.log('Batch deploy failed : ' + str(e))
+            batch.log_flush()
+            for image in containers.mapped('image_id'):
+                image.build_cache_clean(server)
+
+            for container in containers:
+                # State keys are module_|-id_|-name_|-function
+                state = isinstance(states, dict) and [
+                    v for k, v in states.iteritems()
+                    if k.split('_|-')[1:2] == ['deploy_' + container.name]]
+                success = state and state[0].get('result') is True
+                log = container.with_context(clouder_jobs={
+                    container._name + '_' + str(container.id):
+                    jobs[container.id].id})
+                log.log('Deploy of ' + container.name +
+                        (success and ' succeeded' or ' failed') +
+                        (state and ' : ' + str(state[0].get('comment'))
+                         or ''))
+                log.log_flush()
+                jobs[container.id].write({
+                    'end_date': self.now,
+                    'state': success and 'done' or 'failed'})
+                if not success:
+                    failed |= container
+        return failed
+
+    @api.multi
+    def readiness_check(self):
+        """
+        Check the state of the docker container, before the check of the
+        application type.
+        """
+        if not self.server_id.runner_id or \
+                self.server_id.runner_id.application_id.type_id.name \
+                == 'docker':
+            check = self.readiness_type
+            state = self.server_id.execute([
+                'docker', 'inspect', '--format=' +
+                (check == 'health' and '{{.State.Health.Status}}' or
+                 '{{.State.Running}}'), self.name]).strip()
+            if state != (check == 'health' and 'healthy' or 'true'):
+                return False
+        return super(ClouderContainer, self).readiness_check()
+
     @api.multi
     def hook_purge(self):
         """
@@ -300,6 +543,6 @@ class ClouderContainer(models.Model):
             else:
                 self.server_id.execute(['docker', 'start', self.name])
 
-            time.sleep(3)
+            self.wait_ready()
 
         return res
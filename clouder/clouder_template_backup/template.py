@@ -53,17 +53,27 @@ class ClouderContainerLink(models.Model):
     @api.multi
     def deploy_link(self):
         """
-        Upload the whole backups to a distant container.
+        Upload the changes of the backups since the last upload to a distant
+        container.
+
+        The backup container keeps a manifest of the files already uploaded
+        to the target, with their size and mtime. Each upload packs the new
+        and modified files in a compressed tar, with the list of the removed
+        files next to it, so its cost depends on the changes and not on the
+        size of the backups. The bup packs are never modified, so only the
+        new ones are sent.
+
+        The increments are kept until they are transferred, rsync resuming
+        the interrupted transfers on the next upload. On the target, they
+        are applied in order to a copy of the backups, then removed, so the
+        target only stores the backups once. This copy is mirrored to the
+        ftp server if any, and can be restored with restore_upload.
         """
         if self.name.type_id.name == 'backup-upload' \
                 and self.container_id.application_id.type_id.name == 'backup':
-            filegz = self.container_id.fullname + '.tar.gz'
-            file_destination = '/opt/upload/' + filegz
-            tmp_file = '/tmp/backup-upload/' + filegz
 
             container = self.container_id
-            container.execute(['mkdir', '-p', '/tmp/backup-upload'])
-            container.execute(['tar', 'czf', tmp_file, '-C /opt/backup', '.'])
+            self.backup_upload_increment()
 
             container.send(
                 self.home_directory + '/.ssh/config',
@@ -82,17 +92,21 @@ class ClouderContainerLink(models.Model):
             container.execute([
                 'chmod', '-R', '700', '/home/backup/.ssh'], username='backup')
 
-            self.target.server_id.execute([
-                'mkdir', '-p', '/tmp/backup-upload'])
+            tmp_dir = '/tmp/backup-upload/' + container.name
+            directory = '/opt/upload/' + container.name
+            self.target.server_id.execute(['mkdir', '-p', tmp_dir])
             container.execute([
-                'rsync', "-e 'ssh -o StrictHostKeyChecking=no'", '-ra',
-                tmp_file, self.target.server_id.fulldomain + ':' + tmp_file],
+                'rsync', "-e 'ssh -o StrictHostKeyChecking=no'", '-r',
+                '--partial-dir=.rsync-partial', '--remove-source-files',
+                self.backup_upload_directory + '/pending/',
+                self.target.server_id.fulldomain + ':' + tmp_dir + '/'],
                 username='backup')
-            container.execute(['rm', tmp_file])
+            self.target.execute(['mkdir', '-p', directory])
             self.target.server_id.execute([
-                'docker', 'cp',
-                tmp_file, self.target.name + ':' + file_destination])
-            self.target.server_id.execute(['rm', tmp_file])
+                'docker', 'cp', tmp_dir + '/.',
+                self.target.name + ':' + directory, '&&',
+                'rm', '-rf', tmp_dir + '/*'])
+            self.backup_upload_apply()
 
 #            container.self.execute(['rm', '/home/backup/.ssh/keys/*'],
 #                                   username='backup')
@@ -103,16 +117,121 @@ class ClouderContainerLink(models.Model):
                     'ftp://' + self.target.options['login']['value'] +
                     ':' + self.target.options['password']['value'] + '@' +
                     self.target.options['host']['value'],
-                    '-e', '"rm ' + filegz + '; quit"'])
-                self.target.execute([
-                    'lftp',
-                    'ftp://' + self.target.options['login']['value'] +
-                    ':' + self.target.options['password']['value'] + '@' +
-                    self.target.options['host']['value'],
-                    '-e', '"put ' + file_destination + '; quit"'])
+                    '-e', '"mirror -R -c --delete ' +
+                    directory + '/current ' + container.name + '; quit"'])
 
         return super(ClouderContainerLink, self).deploy_link()
 
+    @property
+    def backup_upload_directory(self):
+        """
+        Property returning the directory of the backup container where the
+        manifest and the increments for the target are kept. It is in the
+        backup volume, so the increments survive a rebuild of the container.
+        """
+        return '/opt/backup/upload/' + self.target.name
+
+    @api.multi
+    def backup_upload_increment(self):
+        """
+        Pack the files of the backups which changed since the last upload
+        in a new increment, and update the upload manifest.
+        """
+        container = self.container_id
+        directory = self.backup_upload_directory
+        manifest = directory + '/manifest'
+        increment = directory + '/pending/' + self.now_bup
+
+        # The increments are decompressed on the target
+        compressor, extension = 'gzip', '.tar.gz'
+        if container.execute(['command', '-v', 'zstd']).strip() \
+                and self.target.execute(['command', '-v', 'zstd']).strip():
+            compressor, extension = 'zstd -q -T0', '.tar.zst'
+
+        container.execute([
+            'mkdir', '-p', directory + '/pending', '&&',
+            'rm', '-f', directory + '/pending/*.part', '&&',
+            'touch', manifest], username='backup')
+        container.execute([
+            'set -o pipefail;',
+            # The increments and the mirrors of the incremental saves are
+            # not uploaded
+            'find /opt/backup',
+            "'(' -path /opt/backup/upload -o -path /opt/backup/mirror ')'",
+            "-prune -o -type f -printf '%P\\t%s\\t%T@\\n'", '|',
+            'LC_ALL=C sort >', manifest + '.new', '&&',
+            'LC_ALL=C comm -13', manifest, manifest + '.new', '|',
+            'cut -f1 >', increment + '.list', '&&',
+            'LC_ALL=C comm -23',
+            '<(cut -f1 ' + manifest + ' | LC_ALL=C sort)',
+            '<(cut -f1 ' + manifest + '.new | LC_ALL=C sort)',
+            '>', increment + '.deleted', '&&',
+            'if [ -s ' + increment + '.list ];', 'then',
+            'tar cf - --no-recursion -C /opt/backup -T ' + increment + '.list',
+            '|', compressor, '>', increment + extension + '.part', '&&',
+            'mv', increment + extension + '.part', increment + extension,
+            ';', 'fi', '&&',
+            '{', '[ -s ' + increment + '.deleted ]', '||',
+            'rm', increment + '.deleted', ';', '}', '&&',
+            'mv', manifest + '.new', manifest, '&&',
+            'rm', increment + '.list'], username='backup')
+
+    @api.multi
+    def backup_upload_apply(self):
+        """
+        Apply the uploaded increments in order to the copy of the backups
+        on the target, and remove them once applied.
+        """
+        directory = '/opt/upload/' + self.container_id.name
+        # The script is interpreted by the host shell before docker exec
+        self.target.execute([
+            'cd', directory, '&&', 'mkdir', '-p', 'current', '&&',
+            'for increment in',
+            "\\$(ls | grep -E '[.](tar[.]gz|tar[.]zst|deleted)\\$'",
+            '| LC_ALL=C sort);', 'do',
+            'case \\$increment in',
+            '*.deleted)', "xargs -d '\\n' -r -I{} rm -f 'current/{}'",
+            '< \\$increment;;',
+            '*.zst)', 'zstd -dc \\$increment | tar xf - -C current;;',
+            '*)', 'tar xzf \\$increment -C current;;',
+            'esac', '&&', 'rm \\$increment', '||', 'exit 1;', 'done'])
+
+    @api.multi
+    def restore_upload(self):
+        self = self.with_context(no_enqueue=True)
+        self.do(
+            'restore_upload ' + self.name.name,
+            'restore_upload_exec', where=self.container_id)
+
+    @api.multi
+    def restore_upload_exec(self):
+        """
+        Restore the backups of the backup container from the copy kept on
+        the target.
+
+        The upload manifest is removed, so the next upload sends all the
+        backups again and the copy on the target stays complete.
+        """
+        if self.name.type_id.name != 'backup-upload' \
+                or self.container_id.application_id.type_id.name != 'backup':
+            self.raise_error(
+                'The link ' + self.name.name + ' is not a backup upload.')
+        container = self.container_id
+        directory = '/opt/upload/' + container.name
+        tmp_dir = '/tmp/backup-restore/' + container.name
+        self.target.server_id.execute([
+            'rm', '-rf', tmp_dir, '&&', 'mkdir', '-p', tmp_dir, '&&',
+            'docker', 'cp', self.target.name + ':' + directory + '/current/.',
+            tmp_dir])
+        container.execute([
+            'rsync', "-e 'ssh -o StrictHostKeyChecking=no'", '-rt',
+            self.target.server_id.fulldomain + ':' + tmp_dir + '/',
+            '/opt/backup/'], username='backup')
+        self.target.server_id.execute(['rm', '-rf', tmp_dir])
+        container.execute(
+            ['rm', '-f', self.backup_upload_directory + '/manifest'],
+            username='backup')
+
     @api.multi
     def purge_link(self):
         """
@@ -122,4 +241,7 @@ class ClouderContainerLink(models.Model):
                 and self.container_id.application_id.type_id.name == 'backup':
             directory = '/opt/upload/' + self.container_id.name
             self.target.execute(['rm', '-rf', directory])
+            self.container_id.execute(
+                ['rm', '-rf', self.backup_upload_directory],
+                username='backup')
         return super(ClouderContainerLink, self).purge_link()
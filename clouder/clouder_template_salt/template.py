@@ -21,8 +21,22 @@
 ##############################################################################
 
 from openerp import models, api
+import base64
 import yaml
-import time
+
+# The pillar top, including the pillars generated for each minion. The
+# minions without pillars directory, like the servers deployed before the
+# pillars were generated per minion, get no pillar instead of an error.
+SALT_PILLAR_TOP = """{%- set minion = grains['id'] | replace('.', '_') %}
+base:
+{%- if salt['file.file_exists'](
+    '/srv/pillar/minions/' ~ minion ~ '/init.sls') %}
+  '{{ grains['id'] }}':
+    - minions.{{ minion }}
+{%- else %}
+  {}
+{%- endif %}
+"""
 
 
 class ClouderServer(models.Model):
@@ -57,13 +71,14 @@ class ClouderServer(models.Model):
             'server_id': self.id,
         })
 
-        time.sleep(3)
-
+        # Wait for the minion to send its key
+        self.wait_until(
+            lambda: self.fulldomain in master.execute(
+                ['salt-key', '-l', 'all']),
+            60, 'Salt minion ' + self.fulldomain)
         master.execute(['salt-key', '-y', '--accept=' + self.fulldomain])
 
-        master.execute([
-            'echo "  \'' + self.fulldomain + '\':\n#END ' +
-            self.fulldomain + '" >> /srv/pillar/top.sls'])
+        self.write_salt_pillars({})
 
     @api.multi
     def purge(self):
@@ -73,10 +88,7 @@ class ClouderServer(models.Model):
         if master:
             try:
                 master.execute([
-                    'sed', '-i',
-                    '"/  \'' + self.fulldomain + r'\'/,/END\s' +
-                    self.fulldomain + '/d"',
-                    '/srv/pillar/top.sls'])
+                    'rm', '-rf', self.salt_pillar_directory])
                 master.execute([
                     'rm', '/etc/salt/pki/master/minions/' + self.fulldomain])
                 master.execute([
@@ -93,6 +105,77 @@ class ClouderServer(models.Model):
             pass
         super(ClouderServer, self).purge()
 
+    @property
+    def salt_pillar_directory(self):
+        """
+        Property returning the directory of the pillars of the server minion.
+        """
+        return '/srv/pillar/minions/' + self.fulldomain.replace('.', '_')
+
+    @api.multi
+    def regenerate_salt_pillars(self):
+        """
+        Write the pillars of all the containers and bases of the servers,
+        used to migrate the servers deployed when the pillars were listed in
+        the top file.
+        """
+        for server in self:
+            pillars = {}
+            containers = self.env['clouder.container'].search(
+                [('server_id', '=', server.id)]).filtered(
+                lambda c: not c.application_id.check_tags(['no-salt']))
+            for container in containers:
+                pillars.update(container.salt_pillars())
+            for base in self.env['clouder.base'].search(
+                    [('container_id', 'in', containers.ids)]):
+                pillars.update(base.salt_pillars())
+            server.write_salt_pillars(pillars)
+
+    @api.multi
+    def write_salt_pillars(self, pillars):
+        """
+        Write the pillars of the server minion with a single command, and
+        regenerate the sls including all of them.
+
+        Each file is written in a temporary file then renamed, so the salt
+        master never reads a partial pillar.
+
+        :param pillars: A dict with the pillar names as keys and the pillar
+        data as values, or False to remove the pillar.
+        """
+        master = self.salt_master
+        directory = self.salt_pillar_directory
+        sls = 'minions.' + self.fulldomain.replace('.', '_') + '.'
+
+        def _write(path, content):
+            return ['echo', base64.b64encode(content), '|',
+                    'base64', '-d', '>', path + '.tmp', '&&',
+                    'mv', path + '.tmp', path]
+
+        cmd = ['mkdir', '-p', directory, '&&']
+        cmd.extend(_write('/srv/pillar/top.sls', SALT_PILLAR_TOP))
+        for name, data in pillars.iteritems():
+            path = directory + '/' + name + '.sls'
+            cmd.append('&&')
+            if data is False:
+                cmd.extend(['rm', '-f', path])
+            else:
+                cmd.extend(_write(path, yaml.safe_dump(
+                    data, default_flow_style=False)))
+        cmd.extend([
+            '&&', 'cd', directory, '&&',
+            '(ls *.sls 2>/dev/null', '|', "grep -v '^init[.]sls'", '|',
+            "sed 's/[.]sls//;s/^/  - " + sls + "/'", '>', 'init.sls.tmp;',
+            'if [ -s init.sls.tmp ];',
+            "then sed -i '1i include:' init.sls.tmp;",
+            "else echo '{}' > init.sls.tmp;", 'fi)', '&&',
+            'mv', 'init.sls.tmp', 'init.sls'])
+        master.execute(cmd)
+
+        # Refreshed once at the end of the job
+        master.execute_reload(
+            ['salt', self.fulldomain, 'saltutil.refresh_pillar'])
+
 
 class ClouderContainer(models.Model):
     """
@@ -110,13 +193,19 @@ class ClouderContainer(models.Model):
     @api.multi
     def deploy_salt(self):
 
-        self.purge_salt()
-
         # if not self.childs_ids:
         res = self.get_container_res()
-        self.image_id.build_image(
+        image = self.image_id.build_image(
             self, self.salt_master, expose_ports=res['expose_ports'])
 
+        self.server_id.write_salt_pillars(self.salt_pillars())
+        return image
+
+    @api.multi
+    def salt_pillars(self):
+        """
+        Return the pillars of the container, by pillar name.
+        """
         data = {
             'name': self.name,
             'image': self.name,
@@ -150,18 +239,7 @@ class ClouderContainer(models.Model):
                 }
             }
 
-        data = yaml.safe_dump(data, default_flow_style=False)
-        self.salt_master.execute(
-            ['echo "' + data + '" > /srv/pillar/containers/' +
-             self.name + '.sls'])
-        self.salt_master.execute(
-            ['sed', '-i', '"/' + self.server_id.fulldomain +
-             '\':/a +++    - containers/' + self.name + '"',
-             '/srv/pillar/top.sls'])
-        self.salt_master.execute(
-            ['sed', '-i', '"s/+++//g"', '/srv/pillar/top.sls'])
-        self.salt_master.execute(
-            ['salt', self.server_id.fulldomain, 'saltutil.refresh_pillar'])
+        return {'container-' + self.name: data}
 
     @api.multi
     def deploy(self):
@@ -224,13 +302,10 @@ class ClouderContainer(models.Model):
     def purge_salt(self):
 
         if self.salt_master:
-            self.salt_master.execute([
-                'sed', '-i', r'"/containers\/' + self.name + '/d"',
-                '/srv/pillar/top.sls'])
             self.salt_master.execute([
                 'rm', '-rf', '/srv/salt/containers/build_' + self.name])
-            self.salt_master.execute([
-                'rm', '-rf', '/srv/pillar/containers/' + self.name + '.sls'])
+            self.server_id.write_salt_pillars(
+                {'container-' + self.name: False})
 
 
 class ClouderContainerLink(models.Model):
@@ -269,36 +344,25 @@ class ClouderBase(models.Model):
     _inherit = 'clouder.base'
 
     @api.multi
-    def deploy_salt(self):
-
-        self.purge_salt()
-
+    def salt_pillars(self):
+        """
+        Return the pillars of the base, by pillar name.
+        """
         data = {
             'name': self.fullname_,
             'host': self.fulldomain,
             'user': self.admin_name,
             'password': self.admin_password,
         }
-        data = yaml.safe_dump({self.fullname_: data}, default_flow_style=False)
-        self.salt_master.execute([
-            'echo "' + data + '" > /srv/pillar/bases/' +
-            self.fullname_ + '.sls'])
-        self.salt_master.execute([
-            'sed', '-i',
-            '"/' + self.container_id.server_id.name +
-            '\':/a +++    - bases/' + self.fullname_ +
-            '"',  '/srv/pillar/top.sls'])
-        self.salt_master.execute([
-            'sed', '-i', '"s/+++//g"', '/srv/pillar/top.sls'])
-        self.salt_master.execute([
-            'salt', self.container_id.server_id.fulldomain,
-            'saltutil.refresh_pillar'])
+        return {'base-' + self.fullname_: {self.fullname_: data}}
+
+    @api.multi
+    def deploy_salt(self):
+
+        self.container_id.server_id.write_salt_pillars(self.salt_pillars())
 
     @api.multi
     def purge_salt(self):
 
-        self.salt_master.execute([
-            'sed', '-i', r'"/bases\/' + self.name + '/d"',
-            '/srv/pillar/top.sls'])
-        self.salt_master.execute([
-            'rm', '-rf', '/srv/pillar/bases/' + self.name + '.sls'])
+        self.container_id.server_id.write_salt_pillars(
+            {'base-' + self.fullname_: False})
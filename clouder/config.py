@@ -22,10 +22,149 @@
 
 from openerp import models, fields, api, _
 from openerp.exceptions import except_orm
+import openerp
 import re
+import threading
+import time
+import traceback
 
 from datetime import datetime
 
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class SaveScheduler(object):
+    """
+    Run the saves of containers and bases with a pool of threads, without
+    running more than server_limit saves on the same server and
+    backup_limit saves on the same backup container at the same time.
+
+    Each save is executed in its own cursor, with its own clouder.job
+    recording its log and whether it failed.
+    """
+
+    def __init__(self, dbname, uid, context, tasks, workers=4,
+                 server_limit=2, backup_limit=1):
+        self.dbname = dbname
+        self.uid = uid
+        self.context = context
+        self.pending = list(tasks)
+        self.workers = workers
+        self.server_limit = server_limit
+        self.backup_limit = backup_limit
+        self.running = {'server': {}, 'backup': {}}
+        self.condition = threading.Condition()
+        self.done = 0
+        self.failed = 0
+        self.errors = []
+        self.threads = []
+
+    def _available(self, task):
+        if self.running['server'].get(task['server'], 0) >= \
+                self.server_limit:
+            return False
+        for backup in task['backups']:
+            if self.running['backup'].get(backup, 0) >= self.backup_limit:
+                return False
+        return True
+
+    def _reserve(self, task, count):
+        server = self.running['server']
+        server[task['server']] = server.get(task['server'], 0) + count
+        for backup in task['backups']:
+            self.running['backup'][backup] = \
+                self.running['backup'].get(backup, 0) + count
+
+    def _next_task(self):
+        """
+        Return the next task whose server and backups are available,
+        waiting for a running save to end if needed.
+        """
+        with self.condition:
+            while self.pending:
+                for task in self.pending:
+                    if self._available(task):
+                        self.pending.remove(task)
+                        self._reserve(task, 1)
+                        return task
+                self.condition.wait()
+        return False
+
+    def _run_task(self, task):
+        """
+        Save a record in a new cursor, and return the error message if the
+        save failed.
+        """
+        registry = openerp.registry(self.dbname)
+        with api.Environment.manage(), registry.cursor() as cr:
+            env = api.Environment(cr, self.uid, self.context)
+            record = env[task['model']].browse(task['id'])
+            job = env['clouder.job'].create({
+                'name': 'save', 'action': 'save_exec',
+                'model_name': record._name, 'res_id': record.id,
+                'start_date': record.now, 'state': 'started'})
+            # The job needs to exist for the logs flushed during the save
+            cr.commit()
+            record = record.with_context(clouder_jobs={
+                record._name + '_' + str(record.id): job.id})
+            try:
+                with record.delay_reloads():
+                    record.save_exec()
+            except Exception as e:
+                _logger.exception(
+                    'Save of %s %s failed', task['model'], task['id'])
+                cr.rollback()
+                record.log(traceback.format_exc())
+                record.log('FAIL!')
+                record.log_flush()
+                job.write({'end_date': record.now, 'state': 'failed'})
+                cr.commit()
+                return record._name + ' ' + record.name + ' : ' + str(e)
+            record.log_flush()
+            job.write({'end_date': record.now, 'state': 'done'})
+            cr.commit()
+        return False
+
+    def _worker(self):
+        while True:
+            task = self._next_task()
+            if not task:
+                return
+            try:
+                error = self._run_task(task)
+            except Exception as e:
+                _logger.exception(
+                    'Save of %s %s failed', task['model'], task['id'])
+                error = task['model'] + ' ' + str(task['id']) + ' : ' + \
+                    str(e)
+            success = not error
+            with self.condition:
+                self._reserve(task, -1)
+                if success:
+                    self.done += 1
+                else:
+                    self.failed += 1
+                    self.errors.append(error)
+                self.condition.notify_all()
+
+    def start(self):
+        for i in range(max(1, min(self.workers, len(self.pending)))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def wait(self, timeout):
+        """
+        Wait for the end of the saves, at most timeout seconds.
+        Return True when all saves are done.
+        """
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        return not any([thread.is_alive() for thread in self.threads])
+
 
 class ClouderConfigBackupMethod(models.Model):
     """
@@ -35,6 +174,7 @@ class ClouderConfigBackupMethod(models.Model):
 
     _name = 'clouder.config.backup.method'
     _description = 'Backup Method'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
 
@@ -58,6 +198,36 @@ class ClouderConfigSettings(models.Model):
     end_update_containers = fields.Datetime('Last Update Containers ended at')
     end_reset_bases = fields.Datetime('Last Reset Bases ended at')
     end_certs_renewal = fields.Datetime('Last Certs Renewal ended at')
+    save_stream = fields.Boolean(
+        'Stream saves?',
+        help="Pipe the saves from the containers to the backup store, "
+             "instead of copying them on the host and in the backup "
+             "container first.")
+    save_incremental = fields.Boolean(
+        'Incremental saves?',
+        help="Only send the files of the container volumes which changed "
+             "since the last save, and skip the unchanged volumes. Bases "
+             "are still fully saved. The backup container keeps a full "
+             "copy of the volumes of each container to compare them, so "
+             "it needs as much extra disk space as the saved volumes.")
+    save_workers = fields.Integer('Parallel saves', default=4)
+    save_server_limit = fields.Integer(
+        'Parallel saves per server', default=2)
+    save_backup_limit = fields.Integer(
+        'Parallel saves per backup container', default=1)
+    save_database_jobs = fields.Integer(
+        'Jobs per database dump', default=2,
+        help="Number of jobs used to dump and restore each database, "
+             "the databases of a base being dumped concurrently.")
+    child_deploy_jobs = fields.Integer(
+        'Parallel child containers per server', default=4,
+        help="Number of child containers of the same level created at the "
+             "same time on a server. With 1, the children are created in the "
+             "transaction of their parent and deployed together.")
+    save_total = fields.Integer('Saves planned', readonly=True)
+    save_done = fields.Integer('Saves done', readonly=True)
+    save_failed = fields.Integer('Saves failed', readonly=True)
+    save_throughput = fields.Float('Saves per minute', readonly=True)
 
     @property
     def now_date(self):
@@ -114,12 +284,8 @@ class ClouderConfigSettings(models.Model):
 
         containers = self.env['clouder.container'].search(
             [('autosave', '=', True)])
-        for container in containers:
-            container.save_exec()
-
         bases = self.env['clouder.base'].search([('autosave', '=', True)])
-        for base in bases:
-            base.save_exec()
+        errors = self.save_parallel(containers, bases)
 
         links = self.env['clouder.container.link'].search(
             [('container_id.application_id.type_id.name', '=', 'backup'),
@@ -127,9 +293,13 @@ class ClouderConfigSettings(models.Model):
         for link in links:
             link.deploy_exec()
 
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.env.ref('clouder.clouder_settings').end_save_all = now
-        self.env.cr.commit()
+        # Written like the progress, the settings record was updated by
+        # another cursor during the saves
+        self.save_progress({
+            'end_save_all': datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+        if errors:
+            self.raise_error(str(len(errors)) + ' saves failed.')
 
     @api.multi
     def purge_expired_saves(self):
@@ -142,7 +312,7 @@ class ClouderConfigSettings(models.Model):
         """
         self.env['clouder.save'].search([
             ('date_expiration', '!=', False),
-            ('date_expiration', '<', self.now_date)]).unlink()
+            ('date_expiration', '<', self.now_date)]).purge_bulk()
 
     @api.multi
     def launch_next_saves(self):
@@ -160,15 +330,94 @@ class ClouderConfigSettings(models.Model):
             ('date_next_save', '!=', False),
             ('date_next_save', '<',
              self.now_date + ' ' + self.now_hour_regular)])
-        for container in containers:
-            container.save_exec()
         bases = self.env['clouder.base'].search([
             ('autosave', '=', True),
             ('date_next_save', '!=', False),
             ('date_next_save', '<',
              self.now_date + ' ' + self.now_hour_regular)])
+        errors = self.save_parallel(containers, bases)
+        if errors:
+            self.raise_error(str(len(errors)) + ' saves failed.')
+
+    @api.multi
+    def save_progress(self, values):
+        """
+        Write the progress of the saves on the settings record in a
+        separate cursor, so it can be followed during the saves without
+        committing the job. The job cursor must not write the settings
+        record after it, the other cursor updated it.
+
+        :param values: The values to write.
+        """
+        if openerp.tools.config['test_enable'] or \
+                openerp.modules.module.current_test:
+            self.env.ref('clouder.clouder_settings').write(values)
+            return
+        registry = openerp.registry(self.env.cr.dbname)
+        with registry.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            env.ref('clouder.clouder_settings').write(values)
+
+    @api.multi
+    def save_parallel(self, containers, bases):
+        """
+        Save the containers and bases with a SaveScheduler, and report the
+        progress on the settings record. In test mode, the saves are made
+        one after another in the current transaction.
+
+        Return the error messages of the failed saves.
+
+        :param containers: The containers to save.
+        :param bases: The bases to save.
+        """
+        if openerp.tools.config['test_enable'] or \
+                openerp.modules.module.current_test:
+            for record in list(containers) + list(bases):
+                record.save_exec()
+            return []
+
+        tasks = []
+        for container in containers:
+            tasks.append({
+                'model': container._name, 'id': container.id,
+                'server': container.server_id.id,
+                'backups': container.backup_ids.ids})
         for base in bases:
-            base.save_exec()
+            tasks.append({
+                'model': base._name, 'id': base.id,
+                'server': base.container_id.server_id.id,
+                'backups': base.backup_ids.ids})
+        if not tasks:
+            return []
+
+        settings = self.env.ref('clouder.clouder_settings')
+        self.save_progress({
+            'save_total': len(tasks), 'save_done': 0, 'save_failed': 0,
+            'save_throughput': 0.0})
+
+        scheduler = SaveScheduler(
+            self.env.cr.dbname, self.env.uid, self.env.context, tasks,
+            workers=settings.save_workers or 1,
+            server_limit=settings.save_server_limit or 1,
+            backup_limit=settings.save_backup_limit or 1)
+        start = time.time()
+        scheduler.start()
+        finished = False
+        while not finished:
+            finished = scheduler.wait(10)
+            minutes = (time.time() - start) / 60
+            self.save_progress({
+                'save_done': scheduler.done,
+                'save_failed': scheduler.failed,
+                'save_throughput':
+                    minutes and scheduler.done / minutes or 0.0})
+        # The saves were made and committed in other cursors
+        self.invalidate_caches()
+        self.log(str(scheduler.done) + ' saves done, ' +
+                 str(scheduler.failed) + ' saves failed')
+        for error in scheduler.errors:
+            self.log('Save failed : ' + error)
+        return scheduler.errors
 
     @api.multi
     def update_containers(self):
@@ -23,20 +23,56 @@
 from openerp import models, fields, api, _
 from openerp.exceptions import except_orm
 from openerp import modules
+import openerp
+from . import model
 
+import psycopg2
 import socket
 import re
+import requests
 
-import time
+import threading
 from datetime import datetime, timedelta
 
 import logging
 _logger = logging.getLogger(__name__)
 
+# Number of hostports tried when an allocated one was taken concurrently
+PORT_ALLOCATION_RETRIES = 10
+
+
+def free_ports(start_port, end_port, used, count):
+    """
+    Return the first free ports of a range, with a bitmap of the range.
+
+    :param start_port: The first port of the range.
+    :param end_port: The end of the range, which is excluded.
+    :param used: The ports already used, the values which are not ports
+    or are outside of the range are ignored.
+    :param count: The number of ports to return.
+    """
+    size = max(end_port - start_port, 0)
+    bitmap = bytearray(size)
+    for port in used:
+        try:
+            index = int(port) - start_port
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < size:
+            bitmap[index] = 1
+
+    ports = []
+    index = bitmap.find('\x00')
+    while index != -1 and len(ports) < count:
+        ports.append(start_port + index)
+        index = bitmap.find('\x00', index + 1)
+    return ports
+
 
 class ClouderOneclick(models.Model):
 
     _name = 'clouder.oneclick'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Nom', required=True)
     code = fields.Char('Code', required=True)
@@ -185,6 +221,7 @@ class ClouderServer(models.Model):
     salt_minion_id = fields.Many2one(
         'clouder.container', 'Salt Minion', readonly=True)
     control_dns = fields.Boolean('Control DNS?')
+    dns_record = fields.Boolean('DNS record deployed?', readonly=True)
     oneclick_ids = fields.Many2many(
         'clouder.oneclick', 'clouder_server_oneclick_rel',
         'container_id', 'oneclick_id', 'Oneclick Deployment')
@@ -293,6 +330,51 @@ class ClouderServer(models.Model):
         for container in containers:
             container.stop()
 
+    @api.multi
+    def listening_ports(self):
+        """
+        Return the ports listened on the server, from a single ss snapshot.
+        When the ports are assigned with the public ip, the ports bound on
+        other ips are ignored.
+        """
+        ports = set()
+        for line in self.execute(['ss', '-ltnu']).split('\n')[1:]:
+            columns = line.split()
+            if len(columns) < 5 or ':' not in columns[4]:
+                continue
+            address, port = columns[4].rsplit(':', 1)
+            address = address.split('%')[0].strip('[]')
+            if self.public_ip \
+                    and address not in [self.ip, '*', '0.0.0.0', '::']:
+                continue
+            if port.isdigit():
+                ports.add(int(port))
+        return ports
+
+    @api.multi
+    def allocate_ports(self, count, exclude=()):
+        """
+        Allocate free hostports on the server.
+
+        A bitmap of the port range is built from the ports of the
+        containers and the ports listened on the server. Two transactions
+        can still get the same port, the unique constraint on the ports
+        then makes the second one retry, see ClouderContainerPort.create.
+
+        :param count: The number of ports to allocate.
+        :param exclude: Ports which shall not be allocated.
+        """
+        if not count:
+            return []
+
+        used = [port['hostport'] for port in
+                self.env['clouder.container.port'].search_read(
+                    [('container_id.server_id', '=', self.id),
+                     ('hostport', '!=', False)], ['hostport'])]
+        used.extend(self.listening_ports())
+        used.extend(exclude)
+        return free_ports(self.start_port, self.end_port, used, count)
+
     @api.multi
     def test_connection(self):
         """
@@ -321,13 +403,11 @@ class ClouderServer(models.Model):
 
     @api.multi
     def deploy_dns_exec(self):
-        self.purge_dns_exec()
+        self.control_dns = False
 
         if self.domain_id.dns_id:
-            self.domain_id.dns_id.execute([
-                'echo "' + self.name + ' IN A ' + self.ip +
-                '" >> ' + self.domain_id.configfile])
-            self.domain_id.refresh_serial(self.fulldomain)
+            self.dns_record = True
+            self.domain_id.update_zone()
             # self.control_dns = True
 
     @api.multi
@@ -339,11 +419,8 @@ class ClouderServer(models.Model):
     def purge_dns_exec(self):
         self.control_dns = False
         if self.domain_id.dns_id:
-            self.domain_id.dns_id.execute([
-                'sed', '-i',
-                '"/' + self.name + r'\sIN\sA/d"',
-                self.domain_id.configfile])
-            self.domain_id.refresh_serial()
+            self.dns_record = False
+            self.domain_id.update_zone()
 
     @api.multi
     def oneclick_deploy_element(
@@ -616,7 +693,7 @@ class ClouderContainer(models.Model):
     def base_backup_container(self):
         return self
 
-    @property
+    @model.cached_property
     def ports(self):
         """
         Property returning the ports linked to this container, in a dict.
@@ -631,7 +708,7 @@ class ClouderContainer(models.Model):
                 'hostport': port.hostport, 'localport': port.localport}
         return ports
 
-    @property
+    @model.cached_property
     def options(self):
         """
         Property returning a dictionary containing the value of all options
@@ -653,7 +730,7 @@ class ClouderContainer(models.Model):
                 'id': option.id, 'name': option.name.id, 'value': option.value}
         return options
 
-    @property
+    @model.cached_property
     def links(self):
         """
         Property returning a dictionary containing the value of all links
@@ -664,7 +741,7 @@ class ClouderContainer(models.Model):
             links[link.name.code] = link
         return links
 
-    @property
+    @model.cached_property
     def childs(self):
         """
         Property returning a dictionary containing childs.
@@ -675,7 +752,7 @@ class ClouderContainer(models.Model):
                 childs[child.child_id.application_id.code] = child.child_id
         return childs
 
-    @property
+    @model.cached_property
     def available_links(self):
         """
         """
@@ -1123,7 +1200,6 @@ class ClouderContainer(models.Model):
                             application.next_image_version_id.id
 
             ports = []
-            nextport = server.start_port
             # Getting sources for new port
             port_sources = {x.name: x for x in image.port_ids}
             sources_to_add = port_sources.keys()
@@ -1176,27 +1252,22 @@ class ClouderContainer(models.Model):
                 }
                 ports_to_process.append(port)
 
+            context = self.env.context
             for port in ports_to_process:
                 if not getattr(port, 'hostport', False):
                     port['hostport'] = False
-                context = self.env.context
                 if 'container_ports' in context:
                     name = port['name']
                     if not port['hostport'] \
                             and name in context['container_ports']:
                         port['hostport'] = context['container_ports'][name]
-                if not port['hostport']:
-                    while not port['hostport'] \
-                            and nextport != server.end_port:
-                        port_ids = self.env['clouder.container.port'].search(
-                            [('hostport', '=', nextport),
-                             ('container_id.server_id', '=', server.id)])
-                        if not port_ids and not server.execute([
-                                'netstat', '-an', '|', 'grep',
-                                (server.public_ip and server.ip + ':' or '') +
-                                str(nextport)]):
-                            port['hostport'] = nextport
-                        nextport += 1
+
+            # Allocating all the missing hostports at once
+            free_ports = server.allocate_ports(len(
+                [p for p in ports_to_process if not p['hostport']]))
+            for port in ports_to_process:
+                if not port['hostport'] and free_ports:
+                    port['hostport'] = free_ports.pop(0)
                 if not port['hostport']:
                     raise except_orm(
                         _('Data error!'),
@@ -1367,8 +1438,7 @@ class ClouderContainer(models.Model):
             self.env['clouder.container.child'].create(child_vals)
         # Ensure correct order
         res = self.browse(res.id)
-        for child in res.child_ids:
-            child.create_child_exec()
+        res.child_ids.create_childs_exec()
 
         for link in links:
             link_vals = link[2]
@@ -1600,6 +1670,66 @@ class ClouderContainer(models.Model):
         """
         return
 
+    @property
+    def readiness_type(self):
+        """
+        Property returning the readiness check of the container, only the
+        running state while the services are not configured yet.
+        """
+        if self.env.context.get('readiness_running'):
+            return 'running'
+        return self.application_id.type_id.readiness_type
+
+    @api.multi
+    def readiness_check(self):
+        """
+        Return True if the container is ready, with the readiness check of
+        its application type. The checks depending on the runner are
+        made by the runner modules.
+        """
+        app_type = self.application_id.type_id
+        check = self.readiness_type
+        port = self.ports.get(app_type.readiness_port or '')
+        if check in ['port', 'http'] and not port:
+            check = 'running'
+
+        if check == 'port':
+            # Checked inside the container, so the port needs not be public
+            return self.execute_batch([[
+                'exec 3<>/dev/tcp/127.0.0.1/' + str(port['localport'])
+            ]])[0]['status'] == 0
+
+        if check == 'http':
+            if not port['hostport']:
+                return False
+            try:
+                return self.request(
+                    'http://' + self.server_id.ip + ':' +
+                    str(port['hostport']) + (app_type.readiness_path or '/'),
+                    timeout=5).status_code == 200
+            except requests.RequestException:
+                return False
+
+        if check == 'command':
+            return self.execute_batch([[
+                app_type.readiness_command]])[0]['status'] == 0
+
+        return True
+
+    @api.multi
+    def wait_ready(self, running=False):
+        """
+        Wait until the readiness check of the container succeeds.
+
+        :param running: Only wait for the container to run, before
+        deploy_post configures its services.
+        """
+        self = self.with_context(readiness_running=running)
+        self.wait_until(
+            self.readiness_check,
+            self.application_id.type_id.readiness_timeout or 120,
+            'Container ' + self.name)
+
     @api.multi
     def deploy(self):
         """
@@ -1614,23 +1744,111 @@ class ClouderContainer(models.Model):
 
         if self.child_ids or 'container_childs' in self.env.context \
                 and self.env.context['container_childs']:
-            for child in self.child_ids:
-                child.create_child_exec()
+            self.child_ids.create_childs_exec()
+
+        elif self.batch_deployed:
+            # Deployed with the other children of its level by deploy_batch
+            return
 
         else:
             self.hook_deploy()
 
-            time.sleep(3)
+            self.deploy_finish()
 
-            self.deploy_post()
+        return
 
-            self.start()
+    @api.multi
+    def deploy_finish(self):
+        """
+        Start the container once deployed, then make its first save.
+        """
+        self.wait_ready(running=True)
 
-            # For shinken
-            self = self.with_context(save_comment='First save')
-            self.save_exec(no_enqueue=True)
+        self.deploy_post()
 
-        return
+        self.start()
+
+        self.wait_ready()
+
+        # For shinken
+        self = self.with_context(save_comment='First save')
+        self.save_exec(no_enqueue=True)
+
+    @property
+    def batch_deployed(self):
+        """
+        Property returning True if the container is a child listed in the
+        container_batch_children context, and is deployed by deploy_batch.
+
+        The context is inherited by the children of the container, which
+        are not listed and are deployed as usual.
+        """
+        return self.parent_id.id in \
+            self.env.context.get('container_batch_children', [])
+
+    @api.multi
+    def deploy_links(self):
+        """
+        The links of the containers deployed by deploy_batch are deployed
+        once the containers are started.
+        """
+        if self.batch_deployed:
+            return
+        return super(ClouderContainer, self).deploy_links()
+
+    @api.multi
+    def hook_deploy_batch(self):
+        """
+        Hook which can be called by submodules to deploy several containers
+        at once. Return the containers which failed.
+        """
+        for container in self:
+            container.hook_deploy()
+        return self.browse()
+
+    @api.multi
+    def deploy_batch(self):
+        """
+        Deploy the containers created with the container_batch_children
+        context together, then start them and deploy their links one by one.
+        """
+        self = self.with_context(container_batch_children=[])
+        failed = self.hook_deploy_batch()
+        for container in self - failed:
+            container.deploy_finish()
+            container.deploy_links()
+        if failed:
+            self.raise_error(
+                'The deploy of the containers ' +
+                ', '.join(failed.mapped('name')) + ' failed.')
+
+    @api.multi
+    def create_childs_enqueue(self):
+        """
+        Enqueue a job creating the children of the container, which runs
+        once the transaction creating the container is committed.
+        """
+        key = self._name + '_' + str(self.id)
+        clouder_job = self.env['clouder.job'].create({
+            'name': 'create_childs ' + self.name,
+            'action': 'create_childs_job', 'model_name': self._name,
+            'res_id': self.id, 'state': 'started'})
+        self.log('Children created by the job ' + str(clouder_job.id))
+        self.with_context(
+            clouder_jobs={key: clouder_job.id},
+            container_childs_job=self.id).enqueue(
+            'create_childs ' + self.name, 'create_childs_job',
+            clouder_job.id)
+
+    @api.multi
+    def create_childs_job(self):
+        """
+        Create the children of the container concurrently, from the job
+        enqueued by create_childs_enqueue. The links of the container were
+        deployed before its children existed, so they are deployed again.
+        """
+        self.child_ids.create_childs_exec()
+        self.deploy_links()
 
     @api.multi
     def hook_purge(self):
@@ -1754,6 +1972,7 @@ class ClouderContainerPort(models.Model):
     """
 
     _name = 'clouder.container.port'
+    _inherit = ['clouder.property.invalidation']
 
     container_id = fields.Many2one(
         'clouder.container', 'Container', ondelete="cascade", required=True)
@@ -1765,12 +1984,46 @@ class ClouderContainerPort(models.Model):
         required=True, default='local')
     udp = fields.Boolean('UDP?')
     use_hostport = fields.Boolean('Use hostpost?')
+    server_id = fields.Many2one('clouder.server', 'Server', readonly=True)
 
     _sql_constraints = [
         ('name_uniq', 'unique(container_id,name)',
          'Port name must be unique per container!'),
+        ('hostport_uniq', 'unique(server_id,hostport)',
+         'Hostport must be unique per server!'),
     ]
 
+    @api.model
+    def create(self, vals):
+        """
+        Allocate another hostport when the allocated one was saved by a
+        concurrent transaction in the meantime.
+        """
+        server = self.env['clouder.container'].browse(
+            vals['container_id']).server_id
+        vals['server_id'] = server.id
+        taken = []
+        for attempt in range(PORT_ALLOCATION_RETRIES):
+            try:
+                with self.env.cr.savepoint():
+                    return super(ClouderContainerPort, self).create(vals)
+            except psycopg2.IntegrityError as e:
+                # Only the ports allocated in the range are reallocated
+                if 'hostport_uniq' not in str(e) \
+                        or not vals.get('hostport') \
+                        or not server.start_port <= int(vals['hostport']) \
+                        < server.end_port:
+                    raise
+                taken.append(vals['hostport'])
+                hostports = server.allocate_ports(1, exclude=taken)
+                if not hostports:
+                    raise
+                if vals.get('use_hostport') \
+                        and vals.get('localport') == vals['hostport']:
+                    vals['localport'] = hostports[0]
+                vals['hostport'] = hostports[0]
+        return super(ClouderContainerPort, self).create(vals)
+
 
 class ClouderContainerVolume(models.Model):
     """
@@ -1780,6 +2033,7 @@ class ClouderContainerVolume(models.Model):
     """
 
     _name = 'clouder.container.volume'
+    _inherit = ['clouder.property.invalidation']
 
     container_id = fields.Many2one(
         'clouder.container', 'Container', ondelete="cascade", required=True)
@@ -1802,6 +2056,7 @@ class ClouderContainerOption(models.Model):
     """
 
     _name = 'clouder.container.option'
+    _inherit = ['clouder.property.invalidation']
 
     container_id = fields.Many2one(
         'clouder.container', 'Container', ondelete="cascade", required=True)
@@ -1926,6 +2181,33 @@ class ClouderContainerLink(models.Model):
         self.control() and self.purge_link()
 
 
+class ServerSlots(object):
+    """
+    Number of child containers being created on each server, shared by all
+    the threads of the process.
+    """
+
+    def __init__(self):
+        self.running = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, key, limit):
+        """
+        Wait until less than limit children are created on the server.
+        """
+        with self.condition:
+            while self.running.get(key, 0) >= limit:
+                self.condition.wait()
+            self.running[key] = self.running.get(key, 0) + 1
+
+    def release(self, key):
+        with self.condition:
+            self.running[key] -= 1
+            self.condition.notify_all()
+
+child_slots = ServerSlots()
+
+
 class ClouderContainerChild(models.Model):
     """
     Define the container.link object, used to specify the applications linked
@@ -1981,6 +2263,129 @@ class ClouderContainerChild(models.Model):
             self.save_id.container_id = self.child_id
             self.save_id.restore()
 
+    @api.multi
+    def child_levels(self):
+        """
+        Split the children in levels which can be created concurrently.
+
+        A level contains children of the same sequence, and a child linked
+        to the application of another child of its sequence goes in a
+        later level.
+        """
+        levels = []
+        for sequence in sorted(set(self.mapped('sequence'))):
+            remaining = self.filtered(lambda c: c.sequence == sequence)
+            while remaining:
+                applications = remaining.mapped('name')
+                level = remaining.filtered(
+                    lambda c: not c.name.link_ids.mapped('name') &
+                    (applications - c.name))
+                # Linked to each other, keep the sequence order
+                levels.append(level or remaining[0])
+                remaining -= level or remaining[0]
+        return levels
+
+    @api.multi
+    def create_childs_exec(self):
+        """
+        Create the child containers level by level, the children of a level
+        being created at the same time, at most child_deploy_jobs per
+        server.
+
+        The children created concurrently use their own cursor, so they can
+        only see the parent once its transaction is committed. They are
+        created by a job enqueued on the parent, which runs after the
+        commit, see create_childs_job. If a child fails, the children
+        already created are deleted. With one child per server at a time,
+        the children of a level are deployed together by deploy_batch.
+        """
+        if not self:
+            return
+        jobs = self.env.ref('clouder.clouder_settings').child_deploy_jobs
+        levels = self.child_levels()
+        parallel = jobs > 1 and not openerp.modules.module.current_test \
+            and [level for level in levels if len(level) > 1]
+        container = self.mapped('container_id')
+        if parallel and \
+                self.env.context.get('container_childs_job') != container.id:
+            container.create_childs_enqueue()
+            return
+
+        for level in levels:
+            if not parallel or len(level) == 1:
+                # The children restored from a save need a running container
+                batch = level.filtered(lambda c: not c.save_id)
+                if len(batch) > 1:
+                    for child in batch.with_context(
+                            container_batch_children=batch.ids):
+                        child.create_child_exec()
+                    batch.mapped('child_id').deploy_batch()
+                    level -= batch
+                for child in level:
+                    child.create_child_exec()
+            else:
+                level.create_childs_parallel(jobs, self)
+
+    @api.multi
+    def create_childs_parallel(self, jobs, siblings):
+        """
+        Create the child containers with one thread per child.
+
+        :param jobs: The maximum number of children created on a server.
+        :param siblings: The children to delete if a child fails.
+        """
+        # Only called from the job of create_childs_job, the children of
+        # the previous levels are committed for the threads
+        self.log_flush()
+        self.env.cr.commit()
+
+        dbname, uid = self.env.cr.dbname, self.env.uid
+        context = dict(self.env.context)
+        errors = {}
+
+        def _create(child_id, server_id):
+            child_slots.acquire((dbname, server_id), jobs)
+            try:
+                registry = openerp.registry(dbname)
+                with api.Environment.manage(), registry.cursor() as cr:
+                    # Each thread registers its own jobs in the context
+                    env = api.Environment(cr, uid, dict(
+                        context,
+                        clouder_jobs=dict(context.get('clouder_jobs', {}))))
+                    child = env['clouder.container.child'].browse(child_id)
+                    child.create_child_exec()
+                    child.log_flush()
+            except Exception as e:
+                _logger.exception('Creation of the child %s failed', child_id)
+                errors[child_id] = e
+            finally:
+                child_slots.release((dbname, server_id))
+
+        threads = []
+        for child in self:
+            server = child.server_id or child.container_id.server_id
+            thread = threading.Thread(
+                target=_create, args=(child.id, server.id))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.invalidate_caches()
+
+        if errors:
+            for child in siblings:
+                if child.child_id:
+                    child.delete_child_exec()
+            self.env.cr.commit()
+            self.log(
+                'The creation of the children ' + ', '.join([
+                    self.browse(child_id).name.name + ' (' + str(error) + ')'
+                    for child_id, error in errors.iteritems()]) +
+                ' failed, the other children were deleted.')
+            self.log_flush()
+            # The first error fails the job of the parent
+            raise errors[[c for c in self.ids if c in errors][0]]
+
     @api.multi
     def delete_child(self):
         self = self.with_context(no_enqueue=True)
@@ -1999,6 +2404,7 @@ class ClouderContainerMetadata(models.Model):
     """
 
     _name = 'clouder.container.metadata'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Many2one(
         'clouder.application.metadata', 'Application Metadata',
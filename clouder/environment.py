@@ -36,6 +36,7 @@ class ClouderEnvironment(models.Model):
     """
 
     _name = 'clouder.environment'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Name', required=True)
     partner_id = fields.Many2one('res.partner', 'Partner', required=True)
@@ -32,6 +32,7 @@ class ClouderImageTemplate(models.Model):
     """
 
     _name = 'clouder.image.template'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Image name', required=True)
     volume_ids = fields.One2many(
@@ -46,6 +47,7 @@ class ClouderImage(models.Model):
     """
 
     _name = 'clouder.image'
+    _inherit = ['clouder.property.invalidation']
 
     name = fields.Char('Image name', required=True)
     type_id = fields.Many2one('clouder.application.type', 'Application Type')
@@ -121,7 +123,8 @@ class ClouderImage(models.Model):
 
     @api.multi
     def build_image(
-            self, model, server, runner=False, expose_ports=None, salt=True):
+            self, model, server, runner=False, expose_ports=None, salt=True,
+            build_name=False):
         """
         """
 
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+def migrate(cr, version):
+    """
+    Move the log of the existing jobs in one clouder.job.log chunk per job.
+    """
+    if not version:
+        return
+    cr.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'clouder_job'
+        AND column_name = 'log_before_chunks'""")
+    if not cr.fetchone():
+        return
+    cr.execute("""
+        INSERT INTO clouder_job_log (job_id, content)
+        SELECT id, log_before_chunks FROM clouder_job
+        WHERE log_before_chunks IS NOT NULL AND log_before_chunks != ''
+        ORDER BY id""")
+    cr.execute("ALTER TABLE clouder_job DROP COLUMN log_before_chunks")
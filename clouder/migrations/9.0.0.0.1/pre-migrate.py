@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+def migrate(cr, version):
+    """
+    Keep the logs of the existing jobs, the log field of clouder.job is now
+    computed from the clouder.job.log chunks.
+    """
+    if not version:
+        return
+    cr.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'clouder_job' AND column_name = 'log'""")
+    if cr.fetchone():
+        cr.execute(
+            "ALTER TABLE clouder_job RENAME COLUMN log TO log_before_chunks")
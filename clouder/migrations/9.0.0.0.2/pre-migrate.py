@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    Fill the server of the existing container ports, used by the unique
+    constraint on the hostports of a server.
+
+    The ports sharing a hostport on the same server would prevent the
+    constraint from being added. The oldest one keeps the hostport, the
+    others get a free port of the range of the server, or no hostport when
+    the range is full, and their containers need to be redeployed.
+    """
+    if not version:
+        return
+    cr.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'clouder_container_port'
+        AND column_name = 'server_id'""")
+    if not cr.fetchone():
+        cr.execute(
+            "ALTER TABLE clouder_container_port ADD COLUMN server_id integer")
+    cr.execute("""
+        UPDATE clouder_container_port p SET server_id = c.server_id
+        FROM clouder_container c WHERE c.id = p.container_id""")
+    cr.execute("""
+        SELECT p.id, p.server_id, p.hostport, p.localport, p.use_hostport,
+            s.start_port, s.end_port
+        FROM clouder_container_port p
+        JOIN clouder_server s ON s.id = p.server_id
+        WHERE p.hostport IS NOT NULL AND EXISTS (
+            SELECT 1 FROM clouder_container_port o
+            WHERE o.server_id = p.server_id AND o.hostport = p.hostport
+            AND o.id < p.id)
+        ORDER BY p.id""")
+    duplicates = cr.fetchall()
+    for port_id, server_id, hostport, localport, use_hostport, \
+            start_port, end_port in duplicates:
+        cr.execute("""
+            SELECT hostport FROM clouder_container_port
+            WHERE server_id = %s AND hostport IS NOT NULL""", (server_id,))
+        taken = set(row[0] for row in cr.fetchall())
+        free = [str(port) for port in range(start_port or 0, end_port or 0)
+                if str(port) not in taken]
+        new_hostport = free and free[0] or None
+        if use_hostport and localport == hostport and new_hostport:
+            localport = new_hostport
+        cr.execute("""
+            UPDATE clouder_container_port SET hostport = %s, localport = %s
+            WHERE id = %s""", (new_hostport, localport, port_id))
+        _logger.warning(
+            'The hostport %s of the port %s is also used on the server %s, '
+            'moved to %s. Its container needs to be redeployed.',
+            hostport, port_id, server_id, new_hostport)
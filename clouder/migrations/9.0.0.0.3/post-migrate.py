@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp import api, SUPERUSER_ID
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    Regenerate the pillars of the existing containers and bases, which were
+    listed in the pillar top before it only included the pillars of each
+    minion.
+    """
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    if not env.ref('clouder.clouder_settings').salt_master_id:
+        return
+    for server in env['clouder.server'].search([]):
+        try:
+            server.regenerate_salt_pillars()
+        except Exception:
+            _logger.exception(
+                'The salt pillars of the server %s could not be regenerated, '
+                'call regenerate_salt_pillars once it is reachable.',
+                server.name)
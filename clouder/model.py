@@ -30,6 +30,9 @@ from openerp.addons.connector.queue.job import\
 from datetime import datetime
 import subprocess
 import os.path
+import collections
+import contextlib
+import uuid
 import string
 import copy_reg
 import errno
@@ -38,6 +41,14 @@ import re
 import requests
 import time
 import select
+import threading
+import functools
+import tarfile
+import StringIO
+import tempfile
+import hashlib
+import weakref
+import urlparse
 
 from os.path import expanduser
 
@@ -49,7 +60,219 @@ try:
 except ImportError:
     _logger.debug('Cannot `import paramiko`.')
 
-ssh_connections = {}
+# Size of the chunks read from the ssh channels.
+CHANNEL_BUFFER_SIZE = 32768
+# Seconds we wait for new data before checking the command status again.
+SELECT_TIMEOUT = 1.0
+# Maximum size of the stdout kept in memory by execute.
+MAX_OUTPUT_SIZE = 16 * 1024 * 1024
+# First and maximum delays in seconds between two readiness checks.
+READINESS_MIN_DELAY = 0.2
+READINESS_MAX_DELAY = 5.0
+# Size kept in memory by send_dir before the archive is spooled to disk.
+SEND_DIR_SPOOL_SIZE = 16 * 1024 * 1024
+# Number of characters of the http responses logged by request.
+REQUEST_LOG_SIZE = 1000
+
+
+class SSHConnectionPool(object):
+    """
+    Thread-safe pool of paramiko clients shared by all the connector workers.
+
+    Clients are grouped per host, a host can have up to max_size clients
+    which are chosen by their number of open channels. Dead transports are
+    reconnected, idle clients are closed, and the ~/.ssh/config file is only
+    parsed again when it was modified.
+    """
+
+    def __init__(self, max_size=4, max_channels=8,
+                 keepalive=30, idle_timeout=600):
+        self.max_size = max_size
+        self.max_channels = max_channels
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.pools = {}
+        # Notified when a client finished to connect
+        self.lock = threading.Condition(threading.RLock())
+        self.ssh_config = None
+        self.ssh_config_mtime = None
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0,
+                      'evictions': 0}
+
+    def lookup(self, server_name):
+        """
+        Return the ~/.ssh/config entry of a host, from the cached config.
+
+        :param server_name: The host we need to find in the ssh config.
+        """
+        user_config_file = os.path.expanduser("~/.ssh/config")
+        with self.lock:
+            mtime = os.path.exists(user_config_file) and \
+                os.path.getmtime(user_config_file) or None
+            if self.ssh_config is None or mtime != self.ssh_config_mtime:
+                ssh_config = paramiko.SSHConfig()
+                if mtime:
+                    with open(user_config_file) as f:
+                        ssh_config.parse(f)
+                self.ssh_config = ssh_config
+                self.ssh_config_mtime = mtime
+            return self.ssh_config.lookup(server_name)
+
+    def open_channels(self, client):
+        """
+        Return the number of channels opened by the pool on a client and
+        not closed yet.
+        """
+        client['channels'] = [c for c in client['channels'] if not c.closed]
+        return len(client['channels'])
+
+    def is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self, ssh):
+        try:
+            ssh.close()
+        except Exception:
+            pass
+
+    def evict(self):
+        """
+        Close the idle clients, and the clients whose transport died.
+        """
+        now = time.time()
+        with self.lock:
+            for key, clients in self.pools.items():
+                for client in list(clients):
+                    # Clients still connecting
+                    if client['ssh'] is None:
+                        continue
+                    if not self.open_channels(client) and \
+                            now - client['last_used'] > self.idle_timeout:
+                        self.close(client['ssh'])
+                        clients.remove(client)
+                        self.stats['evictions'] += 1
+                if not clients:
+                    del self.pools[key]
+
+    def get(self, key, connect, channel=False):
+        """
+        Return a live client for the key, calling the connect function to
+        open a new one if none can be reused.
+
+        The client is chosen and its channel opened under the lock, so the
+        threads never open more than max_channels channels on a client
+        which can be replaced, nor more than max_size clients per key.
+
+        :param key: The host identifier, including port and username.
+        :param connect: A function returning a connected paramiko client.
+        :param channel: Also open a session channel on the client, and
+        return the client and the channel.
+        """
+        self.evict()
+        with self.lock:
+            reconnect = False
+            while True:
+                clients = self.pools.setdefault(key, [])
+                for client in list(clients):
+                    if client['ssh'] is not None and \
+                            not self.is_alive(client['ssh']):
+                        self.close(client['ssh'])
+                        clients.remove(client)
+                        reconnect = True
+                live = [c for c in clients if c['ssh'] is not None]
+                if live:
+                    client = min(live, key=self.open_channels)
+                    if self.open_channels(client) < self.max_channels \
+                            or len(clients) >= self.max_size:
+                        client['last_used'] = time.time()
+                        self.stats['hits'] += 1
+                        return self._result(client, channel)
+                if len(clients) < self.max_size:
+                    break
+                # All the clients of the key are being connected
+                self.lock.wait(SELECT_TIMEOUT)
+            # Reserve the place of the new client
+            client = {'ssh': None, 'channels': [], 'last_used': time.time()}
+            clients.append(client)
+
+        # The handshake is done outside the lock, so a slow host
+        # doesn't block the connections to the other ones.
+        try:
+            ssh = connect()
+        except Exception:
+            with self.lock:
+                clients.remove(client)
+                self.lock.notify_all()
+            raise
+        transport = ssh.get_transport()
+        if transport and self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        with self.lock:
+            client['ssh'] = ssh
+            self.stats['misses'] += 1
+            if reconnect:
+                self.stats['reconnects'] += 1
+            self.lock.notify_all()
+            return self._result(client, channel)
+
+    def _result(self, client, channel):
+        """
+        Return the client, with a new channel if channel is True. Called
+        with the lock held.
+        """
+        if not channel:
+            return client['ssh']
+        session = client['ssh'].get_transport().open_session()
+        client['channels'].append(session)
+        return client['ssh'], session
+
+    def get_stats(self):
+        """
+        Return the pool counters, with the number of open clients
+        and channels.
+        """
+        with self.lock:
+            stats = self.stats.copy()
+            clients = [client for clients in self.pools.values()
+                       for client in clients if client['ssh'] is not None]
+            stats['clients'] = len(clients)
+            stats['channels'] = sum(
+                [self.open_channels(client) for client in clients])
+        return stats
+
+ssh_pool = SSHConnectionPool()
+
+
+class HTTPSessionPool(object):
+    """
+    Thread-safe pool of requests connection adapters, one per scheme and
+    host, so the connections are kept alive between the requests to the
+    same host. Each request gets its own session, so the cookies are never
+    shared between the threads and the callers.
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.adapters = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Return a new session using the connections of the host of the url.
+        """
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self.lock:
+            adapter = self.adapters.get(key)
+            if adapter is None:
+                adapter = self.adapters[key] = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_size)
+        session = requests.Session()
+        session.mount(parsed.scheme + '://' + parsed.netloc, adapter)
+        return session
+
+http_pool = HTTPSessionPool()
 
 
 @job
@@ -80,6 +303,7 @@ def connector_enqueue(
     # if 'clouder_unlink' in record.env.context:
     #     res = super(ClouderModel, record).unlink()
     record.log('===== END JOB ' + session.env.context['job_uuid'] + ' =====')
+    record.log_flush()
     job.search([('state', '=', 'failed')]).write({'state': 'pending'})
     return res
 
@@ -90,6 +314,233 @@ whitelist_unpickle_global(dict)
 whitelist_unpickle_global(connector_enqueue)
 
 
+class JobLogSink(object):
+    """
+    Buffer of the log lines waiting to be stored in the clouder.job.log
+    table, per database and per job.
+
+    The lines are flushed when a job buffer exceeds flush_lines or
+    flush_size, when the oldest line waited more than flush_delay seconds,
+    and at the end of each job.
+    """
+
+    def __init__(self, flush_lines=200, flush_size=65536, flush_delay=2.0):
+        self.flush_lines = flush_lines
+        self.flush_size = flush_size
+        self.flush_delay = flush_delay
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def append(self, dbname, job_id, line):
+        """
+        Add a line in the buffer of a job, and return True if the
+        buffers of the database need to be flushed.
+        """
+        with self.lock:
+            buf = self.buffers.setdefault(
+                (dbname, job_id),
+                {'lines': [], 'size': 0, 'since': time.time()})
+            buf['lines'].append(line)
+            buf['size'] += len(line)
+            return len(buf['lines']) >= self.flush_lines \
+                or buf['size'] >= self.flush_size
+
+    def due(self, dbname, job_ids=None):
+        """
+        Return True if a buffer of the database waited too long.
+
+        :param job_ids: Only check the buffers of these jobs.
+        """
+        now = time.time()
+        with self.lock:
+            for (db, job_id), buf in self.buffers.iteritems():
+                if db == dbname and now - buf['since'] >= self.flush_delay \
+                        and (job_ids is None or job_id in job_ids):
+                    return True
+        return False
+
+    def pop(self, dbname, job_ids=None):
+        """
+        Remove and return the buffered lines of a database, per job.
+
+        :param job_ids: Only return the buffers of these jobs.
+        """
+        res = {}
+        with self.lock:
+            for key in self.buffers.keys():
+                if key[0] == dbname \
+                        and (job_ids is None or key[1] in job_ids):
+                    res[key[1]] = self.buffers.pop(key)['lines']
+        return res
+
+log_sink = JobLogSink()
+
+
+class CursorRegistry(object):
+    """
+    Values kept per cursor, created on the first access and dropped with
+    the cursor.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: Function returning the initial value of a cursor.
+        """
+        self.factory = factory
+        self.values = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get(self, cr):
+        """
+        Return the value of a cursor.
+        """
+        with self.lock:
+            value = self.values.get(cr)
+            if value is None:
+                value = self.values[cr] = self.factory()
+            return value
+
+
+class PropertyCache(object):
+    """
+    Cache of the properties built from the one2many records of the clouder
+    objects, per cursor.
+
+    The cache of a cursor is cleared as soon as a record which can be used
+    by these properties is created, written or deleted, see
+    ClouderPropertyInvalidation.
+    """
+
+    def __init__(self):
+        self.caches = CursorRegistry(
+            lambda: {'values': {}, 'hits': 0, 'misses': 0})
+
+    def _cache(self, cr):
+        return self.caches.get(cr)
+
+    def get(self, cr, key, compute):
+        """
+        Return the cached value of key, calling compute if it is missing.
+        """
+        cache = self._cache(cr)
+        if key in cache['values']:
+            cache['hits'] += 1
+        else:
+            cache['misses'] += 1
+            cache['values'][key] = compute()
+        return cache['values'][key]
+
+    def clear(self, cr):
+        """
+        Drop the cached values of a cursor.
+        """
+        self._cache(cr)['values'].clear()
+
+    def get_stats(self, cr):
+        """
+        Return the hits and misses of the cache of a cursor.
+        """
+        cache = self._cache(cr)
+        return {'hits': cache['hits'], 'misses': cache['misses'],
+                'size': len(cache['values'])}
+
+property_cache = PropertyCache()
+
+
+class DelayedReloads(object):
+    """
+    Reload commands of services delayed until the end of the job, per
+    cursor.
+
+    When the configuration of a service is changed several times by a job,
+    the same reload command is only executed once at the end of the
+    outermost batch.
+    """
+
+    def __init__(self):
+        self.batches = CursorRegistry(lambda: {'depth': 0, 'reloads': []})
+
+    def _batch(self, cr):
+        return self.batches.get(cr)
+
+    def begin(self, cr):
+        """
+        Start a batch, batches can be nested.
+        """
+        self._batch(cr)['depth'] += 1
+
+    def add(self, cr, reload):
+        """
+        Delay a reload, given as a (model, id, command, username) tuple.
+        Return False if there is no batch and the command needs to be
+        executed now.
+        """
+        batch = self._batch(cr)
+        if not batch['depth']:
+            return False
+        if reload not in batch['reloads']:
+            batch['reloads'].append(reload)
+        return True
+
+    def end(self, cr):
+        """
+        End a batch, and return the reloads to execute if it was the
+        outermost one.
+        """
+        batch = self._batch(cr)
+        batch['depth'] -= 1
+        if batch['depth']:
+            return []
+        reloads = batch['reloads']
+        batch['reloads'] = []
+        return reloads
+
+delayed_reloads = DelayedReloads()
+
+
+def copy_cached(value, env):
+    """
+    Return a copy of a cached value, down to the nested dicts and lists, so
+    the caller can't modify the cache, with the records bound to env.
+    """
+    if isinstance(value, models.BaseModel):
+        return value.with_env(env)
+    if isinstance(value, dict):
+        return dict((key, copy_cached(item, env))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_cached(item, env) for item in value)
+    return value
+
+
+def cached_property(func):
+    """
+    Decorator used instead of property for the properties returning a dict
+    built from the one2many records, so they are computed once per cursor.
+
+    A copy of the dict is returned, with the records bound to the
+    environment of the caller. The values are cached per language and
+    active_test, the context keys which change what the records read.
+
+    The cache only sees the changes made by the cursor, invalidate_caches
+    needs to be called after other cursors changed the records, like the
+    threads of the parallel saves.
+    """
+    @functools.wraps(func)
+    def getter(self):
+        # The values of the new records may change without any write
+        if not isinstance(self.id, (int, long)):
+            return func(self)
+        context = self.env.context
+        value = property_cache.get(
+            self.env.cr, (self._name, self.id, self.env.uid, func.__name__,
+                          context.get('lang'),
+                          context.get('active_test', True)),
+            lambda: func(self))
+        return copy_cached(value, self.env)
+    return property(getter)
+
+
 class ClouderJob(models.Model):
     """
     Define the clouder.job,
@@ -98,7 +549,26 @@ class ClouderJob(models.Model):
 
     _name = 'clouder.job'
 
-    log = fields.Text('Log')
+    @api.multi
+    def _compute_log(self):
+        """
+        Concatenate the log chunks of the job.
+        """
+        for clouder_job in self:
+            clouder_job.log = ''.join(
+                [chunk.content for chunk in clouder_job.log_ids])
+
+    @api.multi
+    def _inverse_log(self):
+        """
+        Clearing the log remove the stored chunks.
+        """
+        for clouder_job in self:
+            if not clouder_job.log:
+                clouder_job.log_ids.unlink()
+
+    log = fields.Text('Log', compute='_compute_log', inverse='_inverse_log')
+    log_ids = fields.One2many('clouder.job.log', 'job_id', 'Log chunks')
     name = fields.Char('Description')
     action = fields.Char('Action')
     res_id = fields.Integer('Res ID')
@@ -122,6 +592,73 @@ class ClouderJob(models.Model):
     _order = 'create_date desc'
 
 
+class ClouderJobLog(models.Model):
+    """
+    Define the clouder.job.log, an append-only table storing the log of a
+    job by chunks of lines, so the log is never rewritten.
+    """
+
+    _name = 'clouder.job.log'
+    _log_access = False
+
+    job_id = fields.Many2one(
+        'clouder.job', 'Job', ondelete='cascade', required=True, select=True)
+    content = fields.Text('Content')
+
+    _order = 'id'
+
+    @api.model
+    def flush(self):
+        """
+        Store the buffered log lines of the jobs, and commit them so they
+        can be followed in the interface while the job runs. The jobs
+        already ended are flushed too, so the lines logged around their end
+        like the error trace are kept.
+        """
+        # Jobs created by another cursor may not be visible yet, so we only
+        # flush the jobs of the current context.
+        buffers = log_sink.pop(
+            self.env.cr.dbname,
+            self.env.context.get('clouder_jobs', {}).values())
+        if not buffers:
+            return
+        clouder_jobs = self.env['clouder.job'].search([
+            ('id', 'in', buffers.keys())])
+        for clouder_job in clouder_jobs:
+            self.create({
+                'job_id': clouder_job.id,
+                'content': ''.join(buffers[clouder_job.id])})
+        self.env.cr.commit()
+
+
+class ClouderPropertyInvalidation(models.AbstractModel):
+    """
+    Define the clouder.property.invalidation abstract object, inherited by
+    all the clouder objects except the jobs, to clear the property cache
+    when they change.
+    """
+
+    _name = 'clouder.property.invalidation'
+
+    @api.model
+    def create(self, vals):
+        res = super(ClouderPropertyInvalidation, self).create(vals)
+        property_cache.clear(self.env.cr)
+        return res
+
+    @api.multi
+    def write(self, vals):
+        res = super(ClouderPropertyInvalidation, self).write(vals)
+        property_cache.clear(self.env.cr)
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(ClouderPropertyInvalidation, self).unlink()
+        property_cache.clear(self.env.cr)
+        return res
+
+
 class ClouderModel(models.AbstractModel):
     """
     Define the clouder.model abstract object, which is inherited by most
@@ -129,6 +666,7 @@ class ClouderModel(models.AbstractModel):
     """
 
     _name = 'clouder.model'
+    _inherit = ['clouder.property.invalidation']
 
     _autodeploy = True
 
@@ -261,25 +799,39 @@ class ClouderModel(models.AbstractModel):
 
         :param message: The message which will be logged.
         """
-        job_obj = self.env['clouder.job']
         now = datetime.now()
         message = re.sub(r'$$$\w+$$$', '**********', message)
         message = filter(lambda x: x in string.printable, message)
         _logger.info(message)
 
+        flush = False
         if 'clouder_jobs' in self.env.context:
+            line = now.strftime('%Y-%m-%d %H:%M:%S') + ' : ' + message + '\n'
             for key, job_id in self.env.context['clouder_jobs'].iteritems():
-                if job_obj.search([('id', '=', job_id)]):
-                    job = job_obj.browse(job_id)
-                    if job.state == 'started':
-                        job.log = (job.log or '') +\
-                            now.strftime('%Y-%m-%d %H:%M:%S') + ' : ' +\
-                            message + '\n'
-        self.env.cr.commit()
+                if log_sink.append(self.env.cr.dbname, job_id, line):
+                    flush = True
+        if flush:
+            self.log_flush()
+        else:
+            self.log_flush(force=False)
+
+    @api.model
+    def log_flush(self, force=True):
+        """
+        Store the buffered log lines in the database.
+
+        :param force: If False, only flush when the oldest line waited
+        long enough.
+        """
+        if force or log_sink.due(
+                self.env.cr.dbname,
+                self.env.context.get('clouder_jobs', {}).values()):
+            self.env['clouder.job.log'].flush()
 
     def raise_error(self, message):
         self.log('Raising error :' + message)
         self.log('Version :' + str(self.version))
+        self.log_flush()
         if self.version >= 9:
             from openerp.exceptions import UserError
             raise UserError(message)
@@ -327,18 +879,109 @@ class ClouderModel(models.AbstractModel):
             job = self.env['clouder.job'].browse(job_id)
             job.write({'start_date': self.now})
 
+        stats = self.ssh_pool_stats()
         try:
-            getattr(self, action)()
+            with self.delay_reloads():
+                getattr(self, action)()
             if job_id:
+                self.log_ssh_pool_stats(stats)
+                _logger.debug(
+                    'property cache : %(hits)s hits, %(misses)s misses, '
+                    '%(size)s values', property_cache.get_stats(self.env.cr))
+                self.log_flush()
                 job.write({'end_date': self.now, 'state': 'done'})
         except:
             self.log('===================')
             self.log('FAIL!')
             self.log('===================')
+            self.log_flush()
             if job_id:
                 job.write({'end_date': self.now, 'state': 'failed'})
             raise
 
+    @api.multi
+    def invalidate_caches(self):
+        """
+        Drop the records and the properties cached by the cursor, after
+        other cursors changed them.
+        """
+        self.env.invalidate_all()
+        property_cache.clear(self.env.cr)
+
+    @api.multi
+    def wait_until(self, check, timeout, name):
+        """
+        Call check with an exponential backoff until it returns True, and
+        raise an error if it is still False after timeout seconds.
+
+        :param check: The function checking if we can continue.
+        :param timeout: The maximum number of seconds we wait.
+        :param name: The name of what we are waiting for, for the logs.
+        """
+        start = time.time()
+        delay = READINESS_MIN_DELAY
+        while not check():
+            if time.time() + delay > start + timeout:
+                self.raise_error(
+                    name + ' was not ready after ' + str(timeout) +
+                    ' seconds.')
+            time.sleep(delay)
+            delay = min(delay * 2, READINESS_MAX_DELAY)
+        self.log(name + ' ready after ' +
+                 str(round(time.time() - start, 1)) + ' seconds')
+
+    @contextlib.contextmanager
+    def delay_reloads(self):
+        """
+        Delay the reloads requested inside the block with execute_reload,
+        and execute each of them once at the end of the block.
+        """
+        delayed_reloads.begin(self.env.cr)
+        try:
+            yield
+        finally:
+            for model_name, res_id, cmd, username in \
+                    delayed_reloads.end(self.env.cr):
+                record = self.env[model_name].browse(res_id)
+                if record.exists():
+                    record.execute(list(cmd), username=username)
+
+    @api.multi
+    def execute_reload(self, cmd, username=False):
+        """
+        Execute a command reloading a service, or delay it until the end of
+        the job if we are in a job.
+
+        :param cmd: The command we need to execute.
+        :param username: The user who will execute the command.
+        """
+        if not delayed_reloads.add(
+                self.env.cr, (self._name, self.id, tuple(cmd), username)):
+            self.execute(cmd, username=username)
+
+    @api.model
+    def ssh_pool_stats(self):
+        """
+        Return the statistics of the ssh connection pool.
+        """
+        return ssh_pool.get_stats()
+
+    @api.model
+    def log_ssh_pool_stats(self, start_stats):
+        """
+        Log how many ssh handshakes were needed since the start stats.
+
+        :param start_stats: The pool statistics at the start of the job.
+        """
+        stats = self.ssh_pool_stats()
+        self.log(
+            'ssh pool : ' +
+            str(stats['misses'] - start_stats['misses']) + ' handshakes, ' +
+            str(stats['hits'] - start_stats['hits']) + ' reused, ' +
+            str(stats['reconnects'] - start_stats['reconnects']) +
+            ' reconnects, ' + str(stats['clients']) + ' clients, ' +
+            str(stats['channels']) + ' open channels')
+
     @api.multi
     def deploy_frame(self):
         try:
@@ -421,7 +1064,7 @@ class ClouderModel(models.AbstractModel):
         Override the default unlink function to create log and call purge hook.
         """
         for rec in self:
-            if self._autodeploy:
+            if self._autodeploy and not self.env.context.get('no_purge'):
                 try:
                     rec.purge()
                 except:
@@ -433,13 +1076,15 @@ class ClouderModel(models.AbstractModel):
         return res
 
     @api.multi
-    def connect(self, server_name='', port=False, username=False):
+    def connect(self, server_name='', port=False, username=False,
+                channel=False):
         """
         Method which can be used to get an ssh connection to execute command.
 
         :param host: The host we need to connect.
         :param port: The port we need to connect.
         :param username: The username we need to connect.
+        :param channel: Also open a session channel, returned in 'channel'.
         """
 
         server = self
@@ -450,104 +1095,128 @@ class ClouderModel(models.AbstractModel):
         if not server_name:
             server_name = server.fulldomain
 
-        global ssh_connections
         host_fullname = server_name + \
             (port and ('_' + port) or '') + \
             (username and ('_' + username) or '')
-        if host_fullname not in ssh_connections\
-                or not ssh_connections[host_fullname]._transport:
-
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            ssh_config = paramiko.SSHConfig()
-            user_config_file = os.path.expanduser("~/.ssh/config")
-            if os.path.exists(user_config_file):
-                with open(user_config_file) as f:
-                    ssh_config.parse(f)
-            user_config = ssh_config.lookup(server_name)
-
-            identityfile = None
-            if 'identityfile' in user_config:
-                host = user_config['hostname']
-                identityfile = user_config['identityfile']
-                if not username:
-                    username = user_config['user']
-                if not port:
-                    port = user_config['port']
-
-            if identityfile is None:
-                self.raise_error(
-                    "It seems Clouder have no record in the ssh config to "
-                    "connect to your server.\nMake sure there is a '" +
-                    self.name + ""
-                    "' record in the ~/.ssh/config of the Clouder "
-                    "system user.\n"
-                    "To easily add this record, depending if Clouder try to "
-                    "connect to a server or a container, you can click on the"
-                    " 'reinstall' button of the server record or 'reset key' "
-                    "button of the container record you try to access.")
-
-            # Security with latest version of Paramiko
-            # https://github.com/clouder-community/clouder/issues/11
-            if isinstance(identityfile, list):
-                identityfile = identityfile[0]
-
-            # Probably not useful anymore, to remove later
-            if not isinstance(identityfile, basestring):
-                raise except_orm(
-                    _('Data error!'),
-                    _("For unknown reason, it seems the variable identityfile "
-                      "in the connect ssh function is invalid. Please report "
-                      "this message.\n"
-                      "Identityfile : " + str(identityfile) +
-                      ", type : " + type(identityfile)))
-
-            self.log('connect: ssh ' + (username and username + '@' or '') +
-                     host + (port and ' -p ' + str(port) or ''))
-
-            try:
-                ssh.connect(
-                    host, port=int(port), username=username,
-                    key_filename=os.path.expanduser(identityfile))
-            except Exception as inst:
-                raise except_orm(
-                    _('Connect error!'),
-                    _("We were not able to connect to your server. Please "
-                      "make sure you add the public key in the "
-                      "authorized_keys file of your root user on your server."
-                      "\nIf you were trying to connect to a container, "
-                      "a click on the 'reset key' button on the container "
-                      "record may resolve the problem.\n"
-                      "Target : " + host + "\n"
-                      "Error : " + str(inst)))
-            ssh_connections[host_fullname] = ssh
+
+        def _connect():
+            return self._connect_ssh(server_name, port, username)
+
+        if channel:
+            ssh, channel = ssh_pool.get(host_fullname, _connect, channel=True)
         else:
-            ssh = ssh_connections[host_fullname]
+            ssh = ssh_pool.get(host_fullname, _connect)
+
+        return {'ssh': ssh, 'channel': channel, 'host': server_name,
+                'server': server}
+
+    @api.multi
+    def _connect_ssh(self, server_name, port=False, username=False):
+        """
+        Open a new ssh connection, used by the pool when no connection
+        can be reused.
+
+        :param server_name: The host we need to connect.
+        :param port: The port we need to connect.
+        :param username: The username we need to connect.
+        """
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        user_config = ssh_pool.lookup(server_name)
+
+        identityfile = None
+        if 'identityfile' in user_config:
+            host = user_config['hostname']
+            identityfile = user_config['identityfile']
+            if not username:
+                username = user_config['user']
+            if not port:
+                port = user_config['port']
+
+        if identityfile is None:
+            self.raise_error(
+                "It seems Clouder have no record in the ssh config to "
+                "connect to your server.\nMake sure there is a '" +
+                self.name + ""
+                "' record in the ~/.ssh/config of the Clouder "
+                "system user.\n"
+                "To easily add this record, depending if Clouder try to "
+                "connect to a server or a container, you can click on the"
+                " 'reinstall' button of the server record or 'reset key' "
+                "button of the container record you try to access.")
+
+        # Security with latest version of Paramiko
+        # https://github.com/clouder-community/clouder/issues/11
+        if isinstance(identityfile, list):
+            identityfile = identityfile[0]
+
+        # Probably not useful anymore, to remove later
+        if not isinstance(identityfile, basestring):
+            raise except_orm(
+                _('Data error!'),
+                _("For unknown reason, it seems the variable identityfile "
+                  "in the connect ssh function is invalid. Please report "
+                  "this message.\n"
+                  "Identityfile : " + str(identityfile) +
+                  ", type : " + type(identityfile)))
 
-        return {'ssh': ssh, 'host': server_name, 'server': server}
+        self.log('connect: ssh ' + (username and username + '@' or '') +
+                 host + (port and ' -p ' + str(port) or ''))
+
+        try:
+            ssh.connect(
+                host, port=int(port), username=username,
+                key_filename=os.path.expanduser(identityfile))
+        except Exception as inst:
+            raise except_orm(
+                _('Connect error!'),
+                _("We were not able to connect to your server. Please "
+                  "make sure you add the public key in the "
+                  "authorized_keys file of your root user on your server."
+                  "\nIf you were trying to connect to a container, "
+                  "a click on the 'reset key' button on the container "
+                  "record may resolve the problem.\n"
+                  "Target : " + host + "\n"
+                  "Error : " + str(inst)))
+        return ssh
 
     @api.multi
     def execute(self, cmd, stdin_arg=False,
                 path=False, ssh=False, server_name='',
-                username=False, executor='bash'):
+                username=False, executor='bash', timeout=False,
+                stdout_file=False, stdout_callback=False,
+                max_output=MAX_OUTPUT_SIZE, stdin_file=False):
         """
         Method which can be used with an ssh connection to execute command.
 
         :param ssh: The connection we need to use.
         :param cmd: The command we need to execute.
         :param stdin_arg: The command we need to execute in stdin.
+        :param stdin_file: A file object streamed to the stdin of the
+        command, which is closed at the end of the file.
         :param path: The path where the command need to be executed.
+        :param timeout: Number of seconds after which the command is killed.
+        :param stdout_file: A local path or a file object where the stdout
+        will be written instead of being returned.
+        :param stdout_callback: A function called with each stdout chunk,
+        instead of returning the stdout.
+        :param max_output: The maximum size of the returned stdout, only the
+        end of the output is kept beyond this size.
         """
 
         if self._name == 'clouder.container' \
                 and self.childs and 'exec' in self.childs:
             return self.childs['exec'].execute(
                 cmd, stdin_arg=stdin_arg, path=path, ssh=ssh,
-                server_name=server_name, username=username, executor=executor)
+                server_name=server_name, username=username, executor=executor,
+                timeout=timeout, stdout_file=stdout_file,
+                stdout_callback=stdout_callback, max_output=max_output,
+                stdin_file=stdin_file)
 
-        res_ssh = self.connect(server_name=server_name, username=username)
-        ssh, host = res_ssh['ssh'], res_ssh['host']
+        res_ssh = self.connect(
+            server_name=server_name, username=username, channel=True)
+        channel, host = res_ssh['channel'], res_ssh['host']
 
         if path:
             self.log('path : ' + path)
@@ -567,14 +1236,12 @@ class ClouderModel(models.AbstractModel):
             cmd.insert(0, self.name + ' ' + executor + ' -c ')
             if username:
                 cmd.insert(0, '-u ' + username)
-            cmd.insert(0, 'docker exec')
+            cmd.insert(0, 'docker exec' + (stdin_file and ' -i' or ''))
 
         self.log('host : ' + host)
         self.log('command : ' + ' '.join(cmd))
         cmd = [c.replace('$$$', '') for c in cmd]
 
-        transport = ssh.get_transport()
-        channel = transport.open_session()
         channel.exec_command(' '.join(cmd))
 
         # Pushing additional input
@@ -585,52 +1252,169 @@ class ClouderModel(models.AbstractModel):
                 chnl_stdin.write(arg)
                 chnl_stdin.flush()
 
-        # Reading outputs
-        stdout_read = ''
-        chnl_out = ''
-        chnl_err = ''
-        chnl_buffer_size = 4096
-        # As long as the command is running
-        while not channel.exit_status_ready():
-            rl, _, _ = select.select([channel], [], [], 0.0)
-            if len(rl) > 0:
-                # Polling and printing stdout
-                if channel.recv_ready():
-                    chnl_out += channel.recv(chnl_buffer_size)
-                    stdout_read += chnl_out
-                    chnl_pending_out = chnl_out.split('\n')
-                    chnl_out = chnl_pending_out[-1]
-                    for output_to_print in chnl_pending_out[:-1]:
-                        self.log('stdout : {0}'.format(output_to_print))
-                # Polling and printing stderr
-                if channel.recv_stderr_ready():
-                    chnl_err += channel.recv_stderr(chnl_buffer_size)
-                    chnl_pending_err = chnl_err.split('\n')
-                    chnl_err = chnl_pending_err[-1]
-                    for err_to_print in chnl_pending_err[:-1]:
-                        self.log('stderr : {0}'.format(err_to_print))
-
-        # Polling last outputs if any:
-        rl, _, _ = select.select([channel], [], [], 0.0)
-        if len(rl) > 0:
-            # Polling and printing stdout
-            if channel.recv_ready():
-                chnl_out += channel.recv(chnl_buffer_size)
-                stdout_read += chnl_out
-                chnl_pending_out = chnl_out.split('\n')
-                for output_to_print in chnl_pending_out:
-                    # The last one MAY be empty
-                    if output_to_print:
-                        self.log('stdout : {0}'.format(output_to_print))
-            # Polling and printing stderr
-            if channel.recv_stderr_ready():
-                chnl_err += channel.recv_stderr(chnl_buffer_size)
-                chnl_pending_err = chnl_err.split('\n')
-                for err_to_print in chnl_pending_err:
-                    # The last one MAY be empty
-                    if err_to_print:
-                        self.log('stderr : {0}'.format(err_to_print))
-        return stdout_read
+        if stdin_file:
+            for chunk in iter(
+                    lambda: stdin_file.read(CHANNEL_BUFFER_SIZE), ''):
+                channel.sendall(chunk)
+            channel.shutdown_write()
+
+        return self.read_channel(
+            channel, timeout=timeout, stdout_file=stdout_file,
+            stdout_callback=stdout_callback, max_output=max_output)
+
+    @api.multi
+    def read_channel(self, channel, timeout=False, stdout_file=False,
+                     stdout_callback=False, max_output=MAX_OUTPUT_SIZE):
+        """
+        Read the outputs of a channel until the command ends, waiting for
+        the data instead of polling the channel.
+
+        See execute for the parameters.
+        """
+        deadline = timeout and time.time() + timeout
+        stdout_read = OutputBuffer(max_output)
+        pending = {'stdout': '', 'stderr': ''}
+
+        out_file = stdout_file
+        if isinstance(stdout_file, basestring):
+            out_file = open(stdout_file, 'wb')
+
+        def _log_lines(stream, data, last=False):
+            lines = (pending[stream] + data).split('\n')
+            pending[stream] = not last and lines.pop() or ''
+            for line in lines:
+                # The last one MAY be empty
+                if line or not last:
+                    self.log(stream + ' : {0}'.format(line))
+
+        def _read(final=False):
+            read = False
+            while channel.recv_ready():
+                data = channel.recv(CHANNEL_BUFFER_SIZE)
+                if not data:
+                    break
+                read = True
+                if out_file:
+                    out_file.write(data)
+                elif stdout_callback:
+                    stdout_callback(data)
+                else:
+                    stdout_read.write(data)
+                    _log_lines('stdout', data)
+                if not final:
+                    break
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(CHANNEL_BUFFER_SIZE)
+                if not data:
+                    break
+                read = True
+                _log_lines('stderr', data)
+                if not final:
+                    break
+            return read
+
+        try:
+            # As long as the command is running
+            while not channel.exit_status_ready() \
+                    and not channel.eof_received:
+                select.select([channel], [], [], SELECT_TIMEOUT)
+                _read()
+                # Store the log of a silent command on time
+                self.log_flush(force=False)
+                if deadline and time.time() > deadline:
+                    channel.close()
+                    self.raise_error(
+                        'The command was killed after ' + str(timeout) +
+                        ' seconds.')
+            # Reading last outputs if any
+            _read(final=True)
+            channel.recv_exit_status()
+            _read(final=True)
+        finally:
+            # Frees the channel in the pool
+            channel.close()
+            if out_file and out_file is not stdout_file:
+                out_file.close()
+
+        _log_lines('stdout', '', last=True)
+        _log_lines('stderr', '', last=True)
+        if stdout_read.truncated:
+            self.log('stdout was truncated to its last ' +
+                     str(max_output) + ' bytes')
+        return stdout_read.getvalue()
+
+    @api.multi
+    def execute_batch(self, cmds, stop_on_error=False, server_name='',
+                      username=False, executor='bash'):
+        """
+        Method which execute several commands in a single ssh channel, and
+        return the exit status and the output of each command.
+
+        :param cmds: The list of commands, each command being a list of
+        arguments like in execute. A (command, path) tuple can be given to
+        execute the command in a specific path.
+        :param stop_on_error: Specify if the next commands shall be skipped
+        when a command fails.
+        """
+        if not cmds:
+            return []
+
+        # The script is interpreted by the host shell before docker exec,
+        # so the variables used by the markers need to be escaped.
+        dollar = self._name == 'clouder.container' and '\\$' or '$'
+        marker = 'CLOUDER_BATCH_' + uuid.uuid4().hex
+        script = []
+        for index, cmd in enumerate(cmds):
+            path = False
+            if isinstance(cmd, tuple):
+                cmd, path = cmd
+            # Each command is run in a subshell, so a cd or an export
+            # doesn't leak into the next commands.
+            script.append(
+                '(' + (path and 'cd ' + path + '; ' or '') +
+                ' '.join(cmd) + '\n)')
+            script.append(
+                'rc=' + dollar + '?; printf "\\n' + marker + ' ' +
+                str(index) + ' %s\\n" ' + dollar + 'rc' +
+                (stop_on_error and '; [ ' + dollar + 'rc -eq 0 ] || exit ' +
+                 dollar + 'rc' or ''))
+
+        out = self.execute(
+            ['\n'.join(script)], server_name=server_name,
+            username=username, executor=executor)
+
+        results = []
+        chunks = re.split(
+            '\n' + marker + r' (\d+) (\d+)\n', out)
+        statuses = {}
+        for i in range(1, len(chunks) - 1, 3):
+            statuses[int(chunks[i])] = (int(chunks[i + 1]), chunks[i - 1])
+        for index, cmd in enumerate(cmds):
+            if isinstance(cmd, tuple):
+                cmd = cmd[0]
+            status, output = statuses.get(index, (None, ''))
+            results.append({
+                'cmd': cmd, 'status': status, 'output': output})
+        return results
+
+    @contextlib.contextmanager
+    def batch(self, stop_on_error=False, server_name='',
+              username=False, executor='bash'):
+        """
+        Context manager collecting the commands given to the execute method
+        of the yielded object, and running them with execute_batch when the
+        block ends.
+
+            with target.batch() as batch:
+                batch.execute(['rm', file])
+                batch.execute(['/etc/init.d/nginx', 'reload'])
+            batch.results
+        """
+        batch = CommandBatch(self)
+        yield batch
+        batch.results = self.execute_batch(
+            batch.cmds, stop_on_error=stop_on_error, server_name=server_name,
+            username=username, executor=executor)
 
     @api.multi
     def get(self, source, destination, ssh=False):
@@ -702,24 +1486,100 @@ class ClouderModel(models.AbstractModel):
             server.execute(['rm', '-rf', tmp_dir])
 
     @api.multi
-    def send_dir(self, source, destination, ssh=False, username=False):
+    def send_dir(self, source, destination, ssh=False, username=False,
+                 checksum=False):
+        """
+        Method which send a local directory, with a single tar archive
+        extracted on the target.
+
+        :param source: The local path of the directory.
+        :param destination: The path where the directory is extracted.
+        :param username: The user who will own the files.
+        :param checksum: Specify if the files already present on the target
+        with the same md5sum shall be skipped.
+        """
         self.log('Send directory ' + source + ' to ' + destination)
-        self.execute(['mkdir', '-p', destination])
+
+        remote_sums = {}
+        if checksum:
+            out = self.execute([
+                '[ -d ' + destination + ' ] && cd ' + destination + ' &&',
+                'find . -type f -exec md5sum {} +'], username=username)
+            for line in out.splitlines():
+                remote_sum, sep, path = line.partition('  ')
+                if sep:
+                    remote_sums[os.path.normpath(path)] = remote_sum
+
+        archive = tempfile.SpooledTemporaryFile(SEND_DIR_SPOOL_SIZE)
+        tar = tarfile.open(fileobj=archive, mode='w|gz')
+        sent = skipped = 0
         for dirpath, dirnames, filenames in os.walk(source):
-            self.log('dirpath ' + str(dirpath))
-            self.log('dirnames ' + str(dirnames))
-            self.log('filenames ' + str(filenames))
             relpath = os.path.relpath(dirpath, source)
             for dirname in dirnames:
-                remote_path = os.path.join(
-                    destination, os.path.join(relpath, dirname))
-                self.execute(['mkdir', '-p', remote_path])
+                path = os.path.normpath(os.path.join(relpath, dirname))
+                tar.add(os.path.join(dirpath, dirname), arcname=path,
+                        recursive=False)
             for filename in filenames:
                 local_path = os.path.join(dirpath, filename)
-                remote_filepath = os.path.join(
-                    destination, os.path.join(relpath, filename))
-                self.send(
-                    local_path, remote_filepath, ssh=ssh, username=username)
+                path = os.path.normpath(os.path.join(relpath, filename))
+                if path in remote_sums:
+                    local_sum = hashlib.md5()
+                    with open(local_path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(65536), ''):
+                            local_sum.update(chunk)
+                    if local_sum.hexdigest() == remote_sums[path]:
+                        skipped += 1
+                        continue
+                tar.add(local_path, arcname=path, recursive=False)
+                sent += 1
+        tar.close()
+        self.log('Sending ' + str(sent) + ' files, ' + str(skipped) +
+                 ' files are unchanged')
+
+        if not sent and checksum:
+            archive.close()
+            return
+        archive.seek(0)
+        try:
+            self.execute([
+                'mkdir', '-p', destination, '&&',
+                'tar', 'xzf', '-', '--no-same-owner', '-C', destination],
+                username=username, stdin_file=archive)
+        finally:
+            archive.close()
+
+    @api.multi
+    def write_files(self, files, username=False):
+        """
+        Method which write several files on the target with a single tar
+        archive, instead of one command per file.
+
+        :param files: A dict with the absolute path of the files as keys,
+        and their content or a (content, mode) tuple as values.
+        :param username: The user who will own the files.
+        """
+        archive = tempfile.SpooledTemporaryFile(SEND_DIR_SPOOL_SIZE)
+        tar = tarfile.open(fileobj=archive, mode='w|gz')
+        for path, content in sorted(files.items()):
+            mode = 0644
+            if isinstance(content, tuple):
+                content, mode = content
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            self.log('write : ' + path)
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = time.time()
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+        archive.seek(0)
+        try:
+            self.execute(
+                ['tar', 'xzf', '-', '--no-same-owner', '-C', '/'],
+                username=username, stdin_file=archive)
+        finally:
+            archive.close()
 
     @api.multi
     def execute_local(self, cmd, path=False, shell=False):
@@ -783,6 +1643,26 @@ class ClouderModel(models.AbstractModel):
         """
         return os.path.isdir(localdir)
 
+    @api.multi
+    def local_dir_checksum(self, localdir):
+        """
+        Method which return a checksum of the content of a directory on
+        the local system, including the relative paths of its files.
+
+        :param localdir: The path to the dir we need to checksum.
+        """
+        checksum = hashlib.sha1()
+        for root, dirs, files in os.walk(localdir):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                checksum.update(os.path.relpath(path, localdir) + '\0')
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), ''):
+                        checksum.update(chunk)
+                checksum.update('\0')
+        return checksum.hexdigest()
+
     @api.multi
     def execute_write_file(self, localfile, value, operator='a'):
         """
@@ -797,7 +1677,15 @@ class ClouderModel(models.AbstractModel):
 
     def request(
             self, url, method='get', headers=None,
-            data=None, params=None, files=None):
+            data=None, params=None, files=None, log_result=False,
+            timeout=None):
+        """
+        Send an http request with the session of the host, and log the
+        beginning of the response.
+
+        :param log_result: Log the whole response instead.
+        :param timeout: Number of seconds after which the request fails.
+        """
 
         if not headers:
             headers = {}
@@ -817,17 +1705,77 @@ class ClouderModel(models.AbstractModel):
             self.log('params ' + str(params))
         if files:
             self.log('files ' + str(files))
-        result = requests.request(
+        result = http_pool.get(url).request(
             method, url, headers=headers, data=data,
-            params=params, files=files, verify=False)
+            params=params, files=files, verify=False, timeout=timeout)
         self.log('status ' + str(result.status_code) + ' ' + result.reason)
-        self.log('result ' + str(result.json()))
+        text = result.text
+        if not log_result and len(text) > REQUEST_LOG_SIZE:
+            text = text[:REQUEST_LOG_SIZE] + '... (' + \
+                str(len(result.text)) + ' characters)'
+        self.log('result ' + text)
         return result
 
 
+class OutputBuffer(object):
+    """
+    Buffer storing the output of a command, keeping only the last
+    max_size bytes when the output is bigger.
+    """
+
+    def __init__(self, max_size=False):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+        self.truncated = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.max_size and self.size > self.max_size:
+            extra = self.size - self.max_size
+            chunk = self.chunks.popleft()
+            if len(chunk) > extra:
+                self.chunks.appendleft(chunk[extra:])
+            self.size -= min(len(chunk), extra)
+            self.truncated = True
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class CommandBatch(object):
+    """
+    Commands collected by ClouderModel.batch.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.cmds = []
+        self.results = []
+
+    def execute(self, cmd, path=False):
+        """
+        Add a command to the batch.
+
+        :param cmd: The command we need to execute.
+        :param path: The path where the command need to be executed.
+        """
+        self.cmds.append(path and (cmd, path) or cmd)
+
+    @property
+    def failed(self):
+        """
+        Property returning the results of the commands which failed or
+        were skipped.
+        """
+        return [r for r in self.results if r['status'] != 0]
+
+
 class ClouderTemplateOne2many(models.AbstractModel):
 
     _name = 'clouder.template.one2many'
+    _inherit = ['clouder.property.invalidation']
 
     @api.multi
     def reset_template(self, records=None):
@@ -883,3 +1831,22 @@ def generate_random_password(size):
         random.choice(string.ascii_uppercase + string.ascii_lowercase +
                       string.digits)
         for _ in range(size))
+
+
+def render_config(paths, values):
+    """
+    Render a configuration file from local templates.
+
+    The templates are concatenated, then their placeholders, like DOMAIN or
+    PORT, are replaced in the order of values.
+
+    :param paths: The local paths of the templates.
+    :param values: A list of (placeholder, value) tuples.
+    """
+    config = ''
+    for path in paths:
+        with open(path) as f:
+            config += f.read().decode('utf-8')
+    for placeholder, value in values:
+        config = config.replace(placeholder, value)
+    return config
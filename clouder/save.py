@@ -27,11 +27,16 @@ from openerp.exceptions import except_orm
 from datetime import datetime
 import ast
 import os
+import re
+import time
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Number of paths removed by each command of a bulk purge
+PURGE_CHUNK_SIZE = 500
+
 
 class ClouderSave(models.Model):
     """
@@ -96,6 +101,18 @@ class ClouderSave(models.Model):
     base_restore_to_domain_id = fields.Many2one(
         'clouder.domain', 'Restore to (Domain)')
     create_date = fields.Datetime('Create Date')
+    save_format = fields.Selection(
+        [('tree', 'Files tree'), ('tar', 'Tar stream')], 'Save format',
+        default='tree', readonly=True)
+    bup_commit = fields.Char('Bup commit', readonly=True)
+    volumes_manifest = fields.Text('Volumes manifest', readonly=True)
+    bytes_transferred = fields.Float(
+        'Bytes transferred', digits=(16, 0), readonly=True,
+        help="Size of the data sent to the backup container, only measured "
+             "for incremental saves.")
+    dump_per_database = fields.Boolean('One dump per database', readonly=True)
+    dump_time = fields.Float('Dump time (s)', readonly=True)
+    restore_time = fields.Float('Restore time (s)', readonly=True)
 
     @property
     def now_epoch(self):
@@ -112,6 +129,15 @@ class ClouderSave(models.Model):
         """
         return self.base_fullname.replace('.', '_').replace('-', '_') + '.dump'
 
+    @api.multi
+    def database_dumpfile(self, key):
+        """
+        Return the dumpfile name of a database of the base.
+
+        :param key: The key of the database in the base databases.
+        """
+        return self.base_dumpfile[:-len('.dump')] + '_' + key + '.dump'
+
     @property
     def computed_restore_to_environment(self):
         """
@@ -254,6 +280,40 @@ class ClouderSave(models.Model):
         """
         return
 
+    @api.multi
+    def execute_databases(self, container, cmds, username=False):
+        """
+        Execute the dump or restore commands of the databases concurrently,
+        in a single command, and raise an error if one of them failed.
+
+        :param container: The container where the commands are executed.
+        :param cmds: A dict with the databases as keys and the commands as
+        values.
+        :param username: The user executing the commands.
+        """
+        # The exit status of each command is collected with its pid, and
+        # the result is printed on the last line, which is always kept
+        # when the output is truncated
+        cmd = []
+        databases = sorted(cmds.keys())
+        for i, database in enumerate(databases):
+            cmd.extend(['('] + cmds[database] +
+                       [')', '&', 'pid' + str(i) + '=\\$!;'])
+        cmd.append('failed=;')
+        for i, database in enumerate(databases):
+            cmd.extend(['wait', '\\$pid' + str(i), '||',
+                        'failed="\\$failed ' + database + '";'])
+        cmd.extend(['if [ -z "\\$failed" ]; then echo databases-ok;',
+                    'else echo failed:\\$failed; exit 1; fi'])
+        res = container.execute(cmd, username=username)
+        lines = res.strip().split('\n')
+        if lines[-1] != 'databases-ok':
+            failed = lines[-1].startswith('failed:') \
+                and lines[-1][len('failed:'):].split() or databases
+            self.raise_error(
+                'The command failed for the databases ' +
+                ', '.join(failed) + '.')
+
     @api.multi
     def deploy_base(self):
         """
@@ -280,30 +340,12 @@ class ClouderSave(models.Model):
 
             container.execute(['chmod', '-R', '777',
                                '/base-backup/' + self.name], username='root')
+            start = time.time()
             self.save_database()
+            self.write({'dump_time': time.time() - start})
+            self.log('Databases dumped in %.1fs' % self.dump_time)
             self.deploy_base()
 
-        directory = '/tmp/clouder/' + self.name
-        container.server_id.execute(['rm', '-rf', directory + '/*'])
-        container.server_id.execute(['mkdir', directory])
-        if self.base_fullname:
-            container.server_id.execute([
-                'docker', 'cp',
-                container.name + ':/base-backup/' + self.name,
-                '/tmp/clouder'])
-        else:
-            for volume in self.container_volumes_comma.split(','):
-                container.server_id.execute([
-                    'mkdir', '-p', directory + volume])
-                container.server_id.execute([
-                    'docker', 'cp',
-                    container.name + ':' + volume,
-                    directory + os.path.split(volume)[0]])
-
-        container.server_id.execute([
-            'echo "' + self.now_date + '" > ' + directory + '/backup-date'])
-        container.server_id.execute(['chmod', '-R', '777', directory + '*'])
-
         backup = self.backup_id
         if self.base_fullname:
             name = self.base_id.fullname_
@@ -332,6 +374,53 @@ class ClouderSave(models.Model):
         backup.execute(['chmod', '-R', '700', '/home/backup/.ssh'],
                        username='backup')
 
+        settings = self.env.ref('clouder.clouder_settings')
+        if settings.save_incremental and not self.base_fullname:
+            self.deploy_incremental(container)
+        elif settings.save_stream:
+            self.deploy_stream(container)
+        else:
+            self.deploy_staging(container)
+
+        # Should we delete the keys directory?
+        # More security, but may cause concurrency problems
+        # backup.execute(['rm', '/home/backup/.ssh/keys/*'], username='backup')
+
+        if self.base_fullname:
+            container.execute([
+                'rm', '-rf', '/base-backup/' + self.name], username='root')
+        return
+
+    @api.multi
+    def deploy_staging(self, container):
+        """
+        Copy the save on the host, then in the backup container, before
+        storing it.
+
+        :param container: The container we need to save.
+        """
+        directory = '/tmp/clouder/' + self.name
+        container.server_id.execute(['rm', '-rf', directory + '/*'])
+        container.server_id.execute(['mkdir', directory])
+        if self.base_fullname:
+            container.server_id.execute([
+                'docker', 'cp',
+                container.name + ':/base-backup/' + self.name,
+                '/tmp/clouder'])
+        else:
+            for volume in self.container_volumes_comma.split(','):
+                container.server_id.execute([
+                    'mkdir', '-p', directory + volume])
+                container.server_id.execute([
+                    'docker', 'cp',
+                    container.name + ':' + volume,
+                    directory + os.path.split(volume)[0]])
+
+        container.server_id.execute([
+            'echo "' + self.now_date + '" > ' + directory + '/backup-date'])
+        container.server_id.execute(['chmod', '-R', '777', directory + '*'])
+
+        backup = self.backup_id
         backup.execute(['rm', '-rf', directory], username='backup')
         backup.execute(['mkdir', '-p', directory], username='backup')
 
@@ -348,14 +437,7 @@ class ClouderSave(models.Model):
                 'cp', '-R', directory + '/*',
                 '/opt/backup/simple/' + self.repo_name + '/' + self.name],
                 username='backup')
-            backup.execute([
-                'rm', '/opt/backup/simple/' + self.repo_name + '/latest'],
-                username='backup')
-            backup.execute([
-                'ln', '-s',
-                '/opt/backup/simple/' + self.repo_name + '/' + self.name,
-                '/opt/backup/simple/' + self.repo_name + '/latest'],
-                username='backup')
+            self.deploy_simple_latest()
 
         if backup.backup_method == 'bup':
             backup.execute(['export BUP_DIR=/opt/backup/bup;',
@@ -371,16 +453,202 @@ class ClouderSave(models.Model):
 
         backup.execute(['rm', '-rf', directory + '*'], username='backup')
 
-        # Should we delete the keys directory?
-        # More security, but may cause concurrency problems
-        # backup.execute(['rm', '/home/backup/.ssh/keys/*'], username='backup')
-
         container.execute(['rm', '-rf', directory + '*'])
 
+    @api.multi
+    def deploy_stream(self, container):
+        """
+        Pipe a tar of the save from the container to the backup store over
+        ssh, without any copy on the host or in the backup container.
+
+        The simple store extracts the stream in the save directory, bup
+        stores the stream itself with bup split, so the save is restored
+        with bup join.
+
+        :param container: The container we need to save.
+        """
+        backup = self.backup_id
+        tmp_dir = '/tmp/clouder-save-' + self.name
         if self.base_fullname:
-            container.execute([
-                'rm', '-rf', '/base-backup/' + self.name], username='root')
-        return
+            paths = '-C /base-backup/' + self.name + ' .'
+        else:
+            paths = '-C / ' + ' '.join([
+                volume.lstrip('/') for volume
+                in self.container_volumes_comma.split(',') if volume])
+        # The backup-date file is created in a temporary directory of the
+        # container, so it is added at the end of the stream. The directory
+        # is removed by a trap, so the exit status stays the one of tar. The
+        # escaped spaces avoid another level of quotes.
+        source = \
+            'ssh -o StrictHostKeyChecking=no ' + \
+            self.container_id.server_id.fulldomain + \
+            ' "docker exec -u root ' + container.name + " sh -c '" + \
+            'trap rm\\ -rf\\ ' + tmp_dir + ' EXIT; ' + \
+            'mkdir -p ' + tmp_dir + ' && echo ' + self.now_date + ' > ' + \
+            tmp_dir + '/backup-date && tar cf - ' + paths + \
+            ' -C ' + tmp_dir + ' backup-date' + "'\""
+
+        if backup.backup_method == 'simple':
+            destination = \
+                '/opt/backup/simple/' + self.repo_name + '/' + self.name
+            backup.execute(['mkdir', '-p', destination], username='backup')
+            res = backup.execute([
+                'set -o pipefail;', source, '|',
+                'tar', 'xf', '-', '-C', destination, '&&',
+                'echo', 'stream-ok'], username='backup')
+            date = backup.execute(
+                ['cat', destination + '/backup-date'], username='backup')
+            if 'stream-ok' not in res.split() or \
+                    date.strip() != self.now_date:
+                backup.execute(['rm', '-rf', destination], username='backup')
+                self.raise_error(
+                    'The stream of the save ' + self.name + ' failed.')
+            self.deploy_simple_latest()
+
+        if backup.backup_method == 'bup':
+            # The stream is listed while it is stored, to check that it
+            # ends with the backup-date file
+            fifo = '/tmp/clouder-save-' + self.name + '.fifo'
+            res = backup.execute([
+                'export BUP_DIR=/opt/backup/bup;', 'set -o pipefail;',
+                'rm -f', fifo, '&&', 'mkfifo', fifo, ';',
+                '(tar tf - | grep -x backup-date; cat > /dev/null) <',
+                fifo, '&', source, '|', 'tee', fifo, '|',
+                'bup split -c -n ' + self.repo_name + ' -d ' +
+                str(int(self.now_epoch)), '&&', 'echo', 'stream-ok;',
+                'wait;', 'rm -f', fifo], username='backup')
+            lines = res.split()
+            commits = [line for line in lines
+                       if re.match(r'^[0-9a-f]{40}$', line)]
+            if 'stream-ok' not in lines or 'backup-date' not in lines or \
+                    not commits:
+                if commits:
+                    # Drop the partial save from the branch
+                    ref = 'refs/heads/' + self.repo_name
+                    backup.execute([
+                        'cd /opt/backup/bup &&',
+                        'git', 'update-ref', ref, commits[0] + '~1',
+                        commits[0], '||',
+                        'git', 'update-ref', '-d', ref, commits[0]],
+                        username='backup')
+                self.raise_error(
+                    'The stream of the save ' + self.name + ' failed.')
+            self.write({'save_format': 'tar', 'bup_commit': commits[0]})
+
+    @api.multi
+    def deploy_incremental(self, container):
+        """
+        Update a mirror of the container volumes, kept in the backup
+        container, with the files which changed since the last save, then
+        store the mirror.
+
+        Each volume has a manifest listing the size, mtime and ctime of its
+        files, kept next to the mirror. The ctime catches the files
+        rewritten with their mtime preserved. A volume whose manifest didn't
+        change is skipped, otherwise only the new and modified files are
+        sent and the removed ones are deleted from the mirror.
+
+        The mirror is a full copy of the volumes, so the backup container
+        needs as much extra disk space as the saved volumes. The simple
+        store hard links its saves to the mirror and doesn't copy it again.
+
+        :param container: The container we need to save.
+        """
+        backup = self.backup_id
+        mirror = '/opt/backup/mirror/' + self.repo_name
+        manifests = mirror + '.manifest'
+        remote = 'ssh -o StrictHostKeyChecking=no ' + \
+            self.container_id.server_id.fulldomain + \
+            ' "docker exec -i -u root ' + container.name + ' '
+
+        backup.execute(['mkdir', '-p', mirror, manifests], username='backup')
+
+        volumes_manifest = {}
+        transferred = 0
+        for volume in self.container_volumes_comma.split(','):
+            if not volume:
+                continue
+            manifest = manifests + '/' + volume.strip('/').replace('/', '_')
+            target = mirror + volume
+
+            res = backup.execute([
+                'set -o pipefail;', 'touch', manifest, '&&',
+                remote + 'find ' + volume + ' -xdev -mindepth 1 '
+                "-printf '%P\\t%s\\t%T@\\t%C@\\n'\"", '|',
+                'LC_ALL=C sort >', manifest + '.new', '&&',
+                'md5sum <', manifest + '.new', '&&',
+                'cmp -s', manifest, manifest + '.new', '&&',
+                'echo unchanged'], username='backup')
+            if not res.strip():
+                self.raise_error(
+                    'Could not list the files of the volume ' + volume + '.')
+            volumes_manifest[volume] = res.split()[0]
+            if 'unchanged' in res.split():
+                self.log('Volume ' + volume + ' unchanged, skipping')
+                continue
+
+            # Remove the deleted files, then send the new and modified ones
+            res = backup.execute([
+                'set -o pipefail;', 'mkdir', '-p', target, '&&',
+                'LC_ALL=C comm -23',
+                '<(cut -f1 ' + manifest + ' | LC_ALL=C sort)',
+                '<(cut -f1 ' + manifest + '.new | LC_ALL=C sort)',
+                '| (cd ' + target + " && xargs -r -d '\\n' rm -rf --)", '&&',
+                'LC_ALL=C comm -13', manifest, manifest + '.new', '|',
+                'cut -f1', '|',
+                remote + 'tar cf - --no-recursion -C ' + volume + ' -T -"',
+                '|', 'tar xf - --unlink-first --recursive-unlink --totals',
+                '-C', target, '2>&1', '&&',
+                'mv', manifest + '.new', manifest], username='backup')
+            totals = re.search(r'Total bytes read: (\d+)', res)
+            if not totals:
+                self.raise_error(
+                    'Could not send the changes of the volume ' + volume + '.')
+            transferred += int(totals.group(1))
+
+        # Replace the file instead of writing in it, the previous saves of
+        # the simple store may share it
+        backup.execute([
+            'rm', '-f', mirror + '/backup-date', '&&',
+            'echo "' + self.now_date + '" > ' + mirror + '/backup-date'],
+            username='backup')
+
+        if backup.backup_method == 'simple':
+            destination = \
+                '/opt/backup/simple/' + self.repo_name + '/' + self.name
+            backup.execute([
+                'mkdir', '-p', '/opt/backup/simple/' + self.repo_name, '&&',
+                'rm', '-rf', destination, '&&',
+                'cp', '-al', mirror, destination], username='backup')
+            self.deploy_simple_latest()
+
+        if backup.backup_method == 'bup':
+            backup.execute(['export BUP_DIR=/opt/backup/bup;',
+                            'bup index ' + mirror],
+                           username='backup')
+            backup.execute([
+                'export BUP_DIR=/opt/backup/bup;',
+                'bup save -n ' + self.repo_name + ' -d ' +
+                str(int(self.now_epoch)) + ' --strip ' + mirror],
+                username='backup')
+
+        self.log('Bytes transferred: ' + str(transferred))
+        self.write({'volumes_manifest': str(volumes_manifest),
+                    'bytes_transferred': transferred})
+
+    @api.multi
+    def deploy_simple_latest(self):
+        """
+        Point the latest link of the simple store to this save.
+        """
+        self.backup_id.execute([
+            'rm', '/opt/backup/simple/' + self.repo_name + '/latest'],
+            username='backup')
+        self.backup_id.execute([
+            'ln', '-s',
+            '/opt/backup/simple/' + self.repo_name + '/' + self.name,
+            '/opt/backup/simple/' + self.repo_name + '/latest'],
+            username='backup')
 
     @api.multi
     def purge(self):
@@ -401,10 +669,62 @@ class ClouderSave(models.Model):
         if flag:
             self.backup_id.execute(['rm', '-rf', '/opt/backup/simple/' +
                                     self.repo_name])
+            self.backup_id.execute([
+                'rm', '-rf', '/opt/backup/mirror/' + self.repo_name,
+                '/opt/backup/mirror/' + self.repo_name + '.manifest'])
             self.backup_id.execute(['git', '--git-dir=/opt/backup/bup',
                                     'branch', '-D', self.repo_name])
         return
 
+    @api.multi
+    def purge_bulk(self):
+        """
+        Remove the saves from the backup containers, then delete them.
+
+        The saves are grouped by backup container and repository, a single
+        query finds which repositories become empty, and each backup
+        container removes its saves in one command. The branches of the
+        empty bup repositories are deleted together and the bup store is
+        pruned once with bup gc.
+        """
+        # The repositories which still have saves, like in purge
+        remaining = set()
+        for field in ['base_fullname', 'container_fullname']:
+            for group in self.read_group(
+                    [('id', 'not in', self.ids), (field, '!=', False)],
+                    [field], [field]):
+                remaining.add(group[field])
+
+        repos = {}
+        for save in self:
+            repos.setdefault(save.backup_id.id, {}).setdefault(
+                save.repo_name, []).append(save.name)
+
+        for backup_id, saves_by_repo in repos.iteritems():
+            backup = self.env['clouder.container'].browse(backup_id)
+            paths = []
+            empty = []
+            for repo, names in saves_by_repo.iteritems():
+                if repo in remaining:
+                    paths.extend(['simple/' + repo + '/' + name
+                                  for name in names])
+                else:
+                    empty.append(repo)
+                    paths.extend(['simple/' + repo, 'mirror/' + repo,
+                                  'mirror/' + repo + '.manifest'])
+            # Keep each command under the size limit of an argument
+            for i in range(0, len(paths), PURGE_CHUNK_SIZE):
+                backup.execute(
+                    ['cd', '/opt/backup', '&&', 'rm', '-rf'] +
+                    paths[i:i + PURGE_CHUNK_SIZE])
+            if empty and backup.backup_method == 'bup':
+                backup.execute(
+                    ['git', '--git-dir=/opt/backup/bup', 'branch', '-D'] +
+                    empty + [';', 'export BUP_DIR=/opt/backup/bup;',
+                             'bup', 'gc', '--unsafe'])
+
+        return self.with_context(no_purge=True).unlink()
+
     @api.multi
     def restore_database(self, base):
         """
@@ -645,7 +965,10 @@ class ClouderSave(models.Model):
 
             self.restore_action(base)
 
+            start = time.time()
             self.restore_database(base)
+            self.write({'restore_time': time.time() - start})
+            self.log('Databases restored in %.1fs' % self.restore_time)
 
             self.restore_base(base)
 
@@ -702,7 +1025,14 @@ class ClouderSave(models.Model):
                 'cp', '-R', '/opt/backup/simple/' + self.repo_name +
                 '/' + self.name + '/*', directory], username='backup')
 
-        if self.backup_id.backup_method == 'bup':
+        if self.backup_id.backup_method == 'bup' \
+                and self.save_format == 'tar':
+            backup.execute([
+                'export BUP_DIR=/opt/backup/bup;', 'set -o pipefail;',
+                'bup join ' + self.bup_commit, '|',
+                'tar', 'xf', '-', '-C', directory], username='backup')
+
+        elif self.backup_id.backup_method == 'bup':
             backup.execute([
                 'export BUP_DIR=/opt/backup/bup;',
                 'bup restore -C ' + directory + ' ' + self.repo_name +
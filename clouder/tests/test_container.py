@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.tests.common import TransactionCase
+from openerp.addons.clouder.container import free_ports
+
+
+class TestPortAllocation(TransactionCase):
+    """
+    Check the allocation of the hostports of a server.
+    """
+
+    def test_free_ports(self):
+        self.assertEqual(
+            free_ports(8000, 8010, ['8000', '8002', 8003], 3),
+            [8001, 8004, 8005])
+
+    def test_ignored_ports(self):
+        self.assertEqual(
+            free_ports(8000, 8004, [False, '', 'http', '7999', '8004'], 10),
+            [8000, 8001, 8002, 8003])
+
+    def test_full_range(self):
+        self.assertEqual(free_ports(8000, 8002, ['8000', '8001'], 1), [])
+        self.assertEqual(free_ports(8000, 8000, [], 1), [])
+
+    def test_hostport_unique_per_server(self):
+        self.env.cr.execute("""
+            SELECT pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conname = 'clouder_container_port_hostport_uniq'""")
+        definition = self.env.cr.fetchone()
+        self.assertTrue(definition)
+        self.assertEqual(
+            definition[0].replace(' ', ''), 'UNIQUE(server_id,hostport)')
+
+
+class TestChildLevels(TransactionCase):
+    """
+    Check the levels of the children created concurrently.
+    """
+
+    def setUp(self):
+        super(TestChildLevels, self).setUp()
+        app_type = self.env['clouder.application.type'].create({
+            'name': 'clouder-test', 'system_user': 'root'})
+        self.apps = {}
+        for code in ['a', 'b', 'c', 'd']:
+            self.apps[code] = self.env['clouder.application'].create({
+                'name': 'Clouder test ' + code, 'code': 'clouder-test-' + code,
+                'type_id': app_type.id})
+        # a is linked to b, so it is created after it
+        self.env['clouder.application.link'].create({
+            'application_id': self.apps['a'].id, 'name': self.apps['b'].id})
+
+    def child(self, code, sequence):
+        return self.env['clouder.container.child'].new({
+            'name': self.apps[code].id, 'sequence': sequence})
+
+    def test_levels(self):
+        a, b, c, d = self.child('a', 1), self.child('b', 1), \
+            self.child('c', 1), self.child('d', 2)
+        levels = (a | b | c | d).child_levels()
+        self.assertEqual(levels, [b | c, a, d])
+
+    def test_linked_to_each_other(self):
+        self.env['clouder.application.link'].create({
+            'application_id': self.apps['b'].id, 'name': self.apps['a'].id})
+        a, b = self.child('a', 1), self.child('b', 1)
+        self.assertEqual((a | b).child_levels(), [a, b])
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.tests.common import TransactionCase
+from openerp.addons.clouder.model import OutputBuffer, JobLogSink, \
+    PropertyCache, copy_cached, property_cache
+
+import mock
+import subprocess
+
+
+def execute_locally(self, cmd, **kwargs):
+    """
+    Replace execute, running the command with the local bash.
+    """
+    process = subprocess.Popen(
+        ['bash', '-c', ' '.join(cmd)], stdout=subprocess.PIPE)
+    return process.communicate()[0]
+
+
+class TestExecuteBatch(TransactionCase):
+    """
+    Check the parsing of the outputs of execute_batch.
+    """
+
+    def setUp(self):
+        super(TestExecuteBatch, self).setUp()
+        self.server = self.env['clouder.server'].browse()
+        patcher = mock.patch.object(
+            type(self.server), 'execute', execute_locally)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_statuses_and_outputs(self):
+        results = self.server.execute_batch([
+            ['echo', 'first'],
+            ["printf 'no newline';", 'exit', '3'],
+            (['pwd'], '/tmp'),
+            ['echo', 'last']])
+        self.assertEqual(
+            [result['status'] for result in results], [0, 3, 0, 0])
+        self.assertEqual(results[0]['output'], 'first\n')
+        self.assertEqual(results[1]['output'], 'no newline')
+        self.assertEqual(results[2]['output'], '/tmp\n')
+        self.assertEqual(results[2]['cmd'], ['pwd'])
+        self.assertEqual(results[3]['output'], 'last\n')
+
+    def test_commands_are_isolated(self):
+        results = self.server.execute_batch([
+            ['cd', '/proc;', 'export', 'CLOUDER_TEST=1'],
+            ['pwd;', 'echo', '${CLOUDER_TEST:-unset}']])
+        self.assertNotEqual(results[1]['output'].split()[0], '/proc')
+        self.assertEqual(results[1]['output'].split()[1], 'unset')
+
+    def test_stop_on_error(self):
+        results = self.server.execute_batch(
+            [['true'], ['false'], ['echo', 'skipped']], stop_on_error=True)
+        self.assertEqual(
+            [result['status'] for result in results], [0, 1, None])
+        self.assertEqual(results[2]['output'], '')
+
+    def test_output_looking_like_a_marker(self):
+        results = self.server.execute_batch([
+            ['echo', 'CLOUDER_BATCH_0', '0', '5'], ['false']])
+        self.assertEqual(
+            [result['status'] for result in results], [0, 1])
+        self.assertEqual(results[0]['output'], 'CLOUDER_BATCH_0 0 5\n')
+
+    def test_batch(self):
+        with self.server.batch() as batch:
+            batch.execute(['true'])
+            batch.execute(['false'])
+        self.assertEqual(len(batch.results), 2)
+        self.assertEqual(batch.failed, [batch.results[1]])
+
+
+class TestOutputBuffer(TransactionCase):
+    """
+    Check that the output buffer of execute keeps the end of the output.
+    """
+
+    def test_unlimited(self):
+        buf = OutputBuffer()
+        for chunk in ['a' * 10, 'b' * 10]:
+            buf.write(chunk)
+        self.assertEqual(buf.getvalue(), 'a' * 10 + 'b' * 10)
+        self.assertFalse(buf.truncated)
+
+    def test_truncated(self):
+        buf = OutputBuffer(max_size=8)
+        for chunk in ['abc', 'defgh', 'ijklmn', 'o']:
+            buf.write(chunk)
+        self.assertEqual(buf.getvalue(), 'hijklmno')
+        self.assertEqual(buf.size, 8)
+        self.assertTrue(buf.truncated)
+
+    def test_chunk_bigger_than_the_buffer(self):
+        buf = OutputBuffer(max_size=4)
+        buf.write('ab')
+        buf.write('cdefghij')
+        self.assertEqual(buf.getvalue(), 'ghij')
+        self.assertEqual(buf.size, 4)
+
+
+class TestJobLogSink(TransactionCase):
+    """
+    Check when the buffered log lines need to be flushed.
+    """
+
+    def test_flush_lines_and_size(self):
+        sink = JobLogSink(flush_lines=3, flush_size=100, flush_delay=3600)
+        self.assertFalse(sink.append('db', 1, 'a\n'))
+        self.assertFalse(sink.append('db', 1, 'b\n'))
+        self.assertTrue(sink.append('db', 1, 'c\n'))
+        self.assertTrue(sink.append('db', 2, 'x' * 100))
+
+    def test_due(self):
+        sink = JobLogSink(flush_delay=3600)
+        sink.append('db', 1, 'a\n')
+        self.assertFalse(sink.due('db'))
+        sink.flush_delay = 0
+        self.assertTrue(sink.due('db'))
+        self.assertTrue(sink.due('db', job_ids=[1]))
+        self.assertFalse(sink.due('db', job_ids=[2]))
+        self.assertFalse(sink.due('other'))
+
+    def test_pop(self):
+        sink = JobLogSink()
+        sink.append('db', 1, 'a\n')
+        sink.append('db', 1, 'b\n')
+        sink.append('db', 2, 'c\n')
+        sink.append('other', 1, 'd\n')
+        self.assertEqual(sink.pop('db', job_ids=[1]), {1: ['a\n', 'b\n']})
+        self.assertEqual(sink.pop('db'), {2: ['c\n']})
+        self.assertEqual(sink.pop('db'), {})
+        self.assertEqual(sink.pop('other'), {1: ['d\n']})
+
+
+class TestPropertyCache(TransactionCase):
+    """
+    Check the cache of the properties and its invalidation.
+    """
+
+    def test_get(self):
+        cache = PropertyCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return {'value': len(calls)}
+        self.assertEqual(cache.get(self.cr, 'key', compute), {'value': 1})
+        self.assertEqual(cache.get(self.cr, 'key', compute), {'value': 1})
+        self.assertEqual(
+            cache.get_stats(self.cr), {'hits': 1, 'misses': 1, 'size': 1})
+        cache.clear(self.cr)
+        self.assertEqual(cache.get(self.cr, 'key', compute), {'value': 2})
+
+    def test_copy_cached(self):
+        users = self.env['res.users'].browse(self.uid)
+        cached = {'a': {'b': [1, 2]}, 'users': users}
+        env = self.env(context={'clouder_test': True})
+        value = copy_cached(cached, env)
+        value['a']['b'].append(3)
+        self.assertEqual(cached['a']['b'], [1, 2])
+        self.assertEqual(value['users'], users)
+        self.assertTrue(value['users'].env.context.get('clouder_test'))
+
+    def test_invalidation(self):
+        property_cache.get(self.cr, 'key', lambda: {})
+        app_type = self.env['clouder.application.type'].create({
+            'name': 'clouder-test', 'system_user': 'root'})
+        self.assertEqual(property_cache.get_stats(self.cr)['size'], 0)
+
+        property_cache.get(self.cr, 'key', lambda: {})
+        application = self.env['clouder.application'].create({
+            'name': 'Clouder test', 'code': 'clouder-test',
+            'type_id': app_type.id})
+        self.assertEqual(property_cache.get_stats(self.cr)['size'], 0)
+
+        property_cache.get(self.cr, 'key', lambda: {})
+        application.write({'code': 'clouder-test2'})
+        self.assertEqual(property_cache.get_stats(self.cr)['size'], 0)
@@ -23,6 +23,7 @@
 from openerp import models, fields, api, release, _
 from openerp.exceptions import except_orm
 from dateutil.relativedelta import relativedelta
+import collections
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -133,6 +134,28 @@ class ClouderInvoicingPricegridLine(models.Model):
 
         return metadata[0].value
 
+    @api.multi
+    def invoicing_units(self):
+        """
+        Returns the invoicing units of the pricegrid lines, read with one
+        search per type of link
+            Example: {('clouder.base', base id, metadata id): value}
+        """
+        links = {}
+        for pgl in self:
+            links.setdefault(pgl.link_type, set()).add(pgl.link.id)
+        metadata_ids = self.mapped('application_metadata').ids
+
+        units = {}
+        for link_type, link_ids in links.iteritems():
+            class_link = link_type.split('.')[-1] + "_id"
+            for metadata in self.env[link_type + ".metadata"].search([
+                    (class_link, 'in', list(link_ids)),
+                    ('name', 'in', metadata_ids)]):
+                units[(link_type, metadata[class_link].id,
+                       metadata.name.id)] = metadata.value
+        return units
+
     @api.multi
     def invoice_amount(self):
         """
@@ -151,54 +174,75 @@ class ClouderInvoicingPricegridLine(models.Model):
                           "records linked to the same container "
                           "OR base OR application.")
                     )
-        # Grouping lines by invoicing unit
+        if not self:
+            return 0.0
+        return self.invoice_amounts()[(self[0].link_type, self[0].link.id)]
+
+    @api.multi
+    def invoice_amounts(self):
+        """
+        Given pricegrid lines for any number of containers/bases:
+        computes the amount to invoice for each of them, with the
+        invoicing units read in bulk
+            Example: {('clouder.base', base id): amount}
+        """
+        units = self.invoicing_units()
+
+        # Grouping lines by link, then by invoicing unit and type
         invoicing_data = {}
         for pgl in self:
-            if pgl.application_metadata.id not in invoicing_data:
-                invoicing_data[pgl.application_metadata.id] = {}
-            if pgl.type not in invoicing_data[pgl.application_metadata.id]:
-                invoicing_data[pgl.application_metadata.id][pgl.type] = []
-            invoicing_data[pgl.application_metadata.id][pgl.type].append(pgl)
-
-        # Sorting resulting lists by threshold
-        for k, v in invoicing_data.iteritems():
-            for table in v:
-                v[table].sort(key=lambda x: x.threshold)
-
-        # Computing final value*
-        amount = 0.0
-        for tables in invoicing_data.values():
-            for k, lines in tables.iteritems():
-                compare_unit = lines[0].invoicing_unit
-                index = 0
-
-                # No amount to add if the first threshold
-                # is above current compare value
-                if lines[index].threshold > compare_unit:
-                    continue
-
-                # Searching for the right line
-                while (index+1) < len(lines) \
-                        and lines[index+1].threshold <= compare_unit:
-                    index += 1
-
-                # Computing and adding price
-                if lines[index].type == 'fixed':
-                    amount += lines[index].price
-                elif lines[index].type == 'mult':
-                    amount += lines[index].price * compare_unit
-                else:
-                    # Preventing possible future type errors
-                    raise except_orm(
-                        _('Pricegrid invoice_amount error!'),
-                        _("Unknown type '{0}' in pricegrid line for {1} '{2}'"
-                            ".".format(
-                                lines[index].type,
-                                lines[index].link_type,
-                                lines[index].link.name
-                            ))
-                    )
-        return amount
+            tables = invoicing_data.setdefault(
+                (pgl.link_type, pgl.link.id), {}).setdefault(
+                pgl.application_metadata.id, {})
+            tables.setdefault(pgl.type, []).append(pgl)
+
+        # Computing final value for each link
+        amounts = {}
+        for link_key, unit_tables in invoicing_data.iteritems():
+            amount = 0.0
+            for metadata_id, tables in unit_tables.iteritems():
+                for k, lines in tables.iteritems():
+                    # Sorting lines by threshold
+                    lines.sort(key=lambda x: x.threshold)
+
+                    if link_key + (metadata_id,) not in units:
+                        raise except_orm(
+                            _('Pricegrid invoicing_unit error!'),
+                            _("No linked metadata found for {0} '{1}'"
+                              .format(lines[0].link_type,
+                                      lines[0].link.name))
+                        )
+                    compare_unit = units[link_key + (metadata_id,)]
+                    index = 0
+
+                    # No amount to add if the first threshold
+                    # is above current compare value
+                    if lines[index].threshold > compare_unit:
+                        continue
+
+                    # Searching for the right line
+                    while (index+1) < len(lines) \
+                            and lines[index+1].threshold <= compare_unit:
+                        index += 1
+
+                    # Computing and adding price
+                    if lines[index].type == 'fixed':
+                        amount += lines[index].price
+                    elif lines[index].type == 'mult':
+                        amount += lines[index].price * compare_unit
+                    else:
+                        # Preventing possible future type errors
+                        raise except_orm(
+                            _('Pricegrid invoice_amount error!'),
+                            _("Unknown type '{0}' in pricegrid line for "
+                              "{1} '{2}'.".format(
+                                  lines[index].type,
+                                  lines[index].link_type,
+                                  lines[index].link.name
+                              ))
+                        )
+            amounts[link_key] = amount
+        return amounts
 
 
 class ClouderApplication(models.Model):
@@ -353,55 +397,46 @@ class ClouderContainer(models.Model):
 
     @api.multi
     def get_invoicing_data(self):
-        # Preparing results
-        results = {
-            'invoice_base_data': [],
-            'invoice_container_data': []
-        }
+        """
+        Returns the invoicing data of the containers, and of their bases,
+        which should be invoiced. The amounts of all the instances are
+        computed together from their pricegrid lines.
+        """
+        # Containers with bases are invoiced per base
+        bases = self.mapped('base_ids').filtered(
+            lambda b: b.pricegrid_ids and b.should_invoice())
+        containers = self.filtered(
+            lambda c: not c.base_ids and c.pricegrid_ids and
+            c.should_invoice())
 
-        for container in self:
-            if container.base_ids:
-                # Invoicing per base
-                for base in container.base_ids:
-                    if base.should_invoice() and base.pricegrid_ids:
-                        curr_res = {
-                            'id': base.id,
-                            'product_id':
-                                base.application_id.invoicing_product_id,
-                            'partner_id': base.environment_id.partner_id.id,
-                            'amount': base.pricegrid_ids.invoice_amount()
-                        }
-                        # property_account_income_id
-                        if self.version() >= 9.0:
-                            curr_res['account_id'] = \
-                                base.environment_id.partner_id\
-                                .property_account_receivable_id.id
-                        else:
-                            curr_res['account_id'] = \
-                                base.environment_id.partner_id\
-                                .property_account_receivable.id
-                        results['invoice_base_data'].append(curr_res)
-            elif container.should_invoice() and container.pricegrid_ids:
-                # Invoicing per container
-                curr_res = {
-                    'id': container.id,
-                    'product_id':
-                        container.application_id.invoicing_product_id,
-                    'partner_id': container.environment_id.partner_id.id,
-
-                    'amount': container.pricegrid_ids.invoice_amount()
-                }
+        amounts = (bases.mapped('pricegrid_ids') |
+                   containers.mapped('pricegrid_ids')).invoice_amounts()
+
+        accounts = {}
+
+        def instance_data(instance):
+            partner = instance.environment_id.partner_id
+            if partner.id not in accounts:
+                # property_account_income_id
                 if self.version() >= 9.0:
-                    curr_res['account_id'] = \
-                        container.environment_id.partner_id\
-                        .property_account_receivable_id.id
+                    accounts[partner.id] = \
+                        partner.property_account_receivable_id.id
                 else:
-                    curr_res['account_id'] = \
-                        container.environment_id\
-                        .partner_id.property_account_receivable.id
+                    accounts[partner.id] = \
+                        partner.property_account_receivable.id
+            return {
+                'id': instance.id,
+                'product_id': instance.application_id.invoicing_product_id.id,
+                'partner_id': partner.id,
+                'account_id': accounts[partner.id],
+                'amount': amounts[(instance._name, instance.id)]
+            }
 
-                results['invoice_container_data'].append(curr_res)
-        return results
+        return {
+            'invoice_base_data': [instance_data(base) for base in bases],
+            'invoice_container_data': [
+                instance_data(container) for container in containers]
+        }
 
 
 class ClouderBase(models.Model):
@@ -510,37 +545,56 @@ class AccountInvoice(models.Model):
         """
         Creates an invoice from clouder data
         """
-        orm_accline = self.env['account.invoice.line']
-
-        invoice = self.create({
-            'origin': data['origin'],
-            'partner_id': data['partner_id'],
-            'account_id': data['account_id']
-        })
-
-        product_tmpl = \
-            self.env['product.product'].browse(
-                [data['product_id']])[0].product_tmpl_id
+        return self.clouder_make_invoices([data])[0]
 
+    @api.model
+    def clouder_make_invoices(self, datas):
+        """
+        Creates the invoices from a list of clouder data, with one invoice
+        per partner and account holding one line per data.
+        Returns the invoice id of each data.
+        """
         if self.version() >= 9:
-            product_acc = product_tmpl.property_account_income_id
+            lines_field = 'invoice_line_ids'
         else:
-            product_acc = product_tmpl.property_account_income
-
-        line_data = {
-            'invoice_id': invoice.id,
-            'origin': data['origin'],
-            'product_id': data['product_id'],
-            'price_unit': data['amount'],
-            'account_id': product_acc.id
-        }
-
-        if 'name' in data:
-            line_data['name'] = data['name']
-
-        orm_accline.create(line_data)
-
-        return invoice.id
+            lines_field = 'invoice_line'
+
+        product_accounts = {}
+        invoices = collections.OrderedDict()
+        for index, data in enumerate(datas):
+            if data['product_id'] not in product_accounts:
+                product_tmpl = self.env['product.product'].browse(
+                    data['product_id']).product_tmpl_id
+                if self.version() >= 9:
+                    product_acc = product_tmpl.property_account_income_id
+                else:
+                    product_acc = product_tmpl.property_account_income
+                product_accounts[data['product_id']] = product_acc.id
+
+            invoice = invoices.setdefault(
+                (data['partner_id'], data['account_id']),
+                {'indexes': [], 'origins': [], 'lines': []})
+            invoice['indexes'].append(index)
+            invoice['origins'].append(data['origin'])
+            invoice['lines'].append((0, 0, {
+                'origin': data['origin'],
+                'name': data.get('name') or data['origin'],
+                'product_id': data['product_id'],
+                'price_unit': data['amount'],
+                'account_id': product_accounts[data['product_id']]
+            }))
+
+        invoice_ids = [False] * len(datas)
+        for (partner_id, account_id), invoice in invoices.iteritems():
+            invoice_id = self.create({
+                'origin': ', '.join(invoice['origins']),
+                'partner_id': partner_id,
+                'account_id': account_id,
+                lines_field: invoice['lines']
+            }).id
+            for index in invoice['indexes']:
+                invoice_ids[index] = invoice_id
+        return invoice_ids
 
     @api.model
     def clouder_invoice_containers(self, containers):
@@ -549,48 +603,34 @@ class AccountInvoice(models.Model):
         and their linked bases,
         the use that data to create relevant invoices.
         """
-        def make_invoice_and_update(orm_class, data):
-            instance = orm_class.browse([data['id']])[0]
-            origin = instance.name + "_" + fields.Date.today()
-
-            inv_data = {
-                'origin': origin,
-                'partner_id': data['partner_id'],
-                'product_id': data['product_id'],
-                'account_id': data['account_id'],
-                'amount': data['amount']
-            }
-            if 'name' in data:
-                inv_data['name'] = data['name'],
-
-            invoice = self.clouder_make_invoice(inv_data)
-
-            # Updating date for instance
-            instance.write({'last_invoiced': fields.Date.today()})
-
-            return invoice.id
-
-        orm_cont = self.env['clouder.container']
-        orm_base = self.env['clouder.base']
-
-        result = {
-            'containers': {},
-            'bases': {}
-        }
+        today = fields.Date.today()
 
         # Gathering invoice data from containers
         invoice_data = containers.get_invoicing_data()
 
-        # Processing containers
-        for container_data in invoice_data['invoice_container_data']:
-            invoice_id = make_invoice_and_update(orm_cont, container_data)
-            result['containers'][container_data['id']] = invoice_id
-
-        # Processing bases
-        for base_data in invoice_data['invoice_base_data']:
-            invoice_id = make_invoice_and_update(orm_base, base_data)
-            result['containers'][base_data['id']] = invoice_id
-        return result
+        datas = []
+        instances = []
+        for model_name, key in [
+                ('clouder.container', 'invoice_container_data'),
+                ('clouder.base', 'invoice_base_data')]:
+            records = self.env[model_name].browse(
+                [data['id'] for data in invoice_data[key]])
+            for record, data in zip(records, invoice_data[key]):
+                datas.append(dict(data, origin=record.name + "_" + today))
+            instances.append(records)
+
+        invoice_ids = self.clouder_make_invoices(datas)
+
+        # Updating date for the instances, with one write per model
+        for records in instances:
+            records.write({'last_invoiced': today})
+
+        containers, bases = instances
+        return {
+            'containers': dict(zip(containers.ids,
+                                   invoice_ids[:len(containers)])),
+            'bases': dict(zip(bases.ids, invoice_ids[len(containers):]))
+        }
 
     @api.model
     def clouder_invoicing(self):
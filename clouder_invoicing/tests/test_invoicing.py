@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Author: Yannick Buron
+# Copyright 2015, TODAY Clouder SASU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License with Attribution
+# clause as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License with
+# Attribution clause along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.tests.common import TransactionCase
+from openerp.exceptions import except_orm
+
+import mock
+
+
+class TestInvoiceAmounts(TransactionCase):
+    """
+    Check the amounts computed from the pricegrids.
+    """
+
+    def setUp(self):
+        super(TestInvoiceAmounts, self).setUp()
+        app_type = self.env['clouder.application.type'].create({
+            'name': 'clouder-test', 'system_user': 'root'})
+        self.apps = self.env['clouder.application']
+        self.metadata = self.env['clouder.application.metadata']
+        for code in ['a', 'b']:
+            application = self.env['clouder.application'].create({
+                'name': 'Clouder test ' + code, 'code': 'clouder-test-' + code,
+                'type_id': app_type.id})
+            self.apps |= application
+            self.metadata |= self.env['clouder.application.metadata'].create({
+                'application_id': application.id, 'name': 'users',
+                'clouder_type': 'container', 'value_type': 'int'})
+
+    def line(self, index, threshold, price, price_type):
+        return self.env['clouder.invoicing.pricegrid.line'].create({
+            'link_application': self.apps[index].id,
+            'application_metadata': self.metadata[index].id,
+            'threshold': threshold, 'price': price, 'type': price_type})
+
+    def units(self, values):
+        """
+        Replace the invoicing units read from the metadata.
+        """
+        units = dict(
+            (('clouder.application', self.apps[index].id,
+              self.metadata[index].id), value)
+            for index, value in values.iteritems())
+        patcher = mock.patch.object(
+            type(self.env['clouder.invoicing.pricegrid.line']),
+            'invoicing_units', return_value=units)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invoice_amounts(self):
+        lines = self.line(0, 0, 5.0, 'fixed') | \
+            self.line(0, 20, 12.0, 'fixed') | \
+            self.line(0, 5, 8.0, 'fixed') | \
+            self.line(0, 0, 1.5, 'mult') | \
+            self.line(1, 5, 4.0, 'fixed')
+        self.units({0: 10, 1: 3})
+        amounts = lines.invoice_amounts()
+        self.assertEqual(len(amounts), 2)
+        # The fixed line of threshold 5 and 10 units multiplied by 1.5
+        self.assertAlmostEqual(
+            amounts[('clouder.application', self.apps[0].id)], 23.0)
+        # Below the first threshold
+        self.assertAlmostEqual(
+            amounts[('clouder.application', self.apps[1].id)], 0.0)
+
+    def test_invoice_amount(self):
+        lines = self.line(0, 0, 5.0, 'fixed') | self.line(0, 0, 2.0, 'mult')
+        other = self.line(1, 0, 4.0, 'fixed')
+        self.units({0: 4, 1: 1})
+        self.assertAlmostEqual(lines.invoice_amount(), 13.0)
+        self.assertEqual(
+            self.env['clouder.invoicing.pricegrid.line'].invoice_amount(),
+            0.0)
+        with self.assertRaises(except_orm):
+            (lines | other).invoice_amount()
+
+    def test_missing_unit(self):
+        lines = self.line(0, 0, 5.0, 'fixed') | self.line(1, 0, 4.0, 'fixed')
+        self.units({0: 4})
+        with self.assertRaises(except_orm):
+            lines.invoice_amounts()
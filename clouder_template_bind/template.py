@@ -21,11 +21,14 @@
 ##############################################################################
 
 
-from openerp import models, api
+from openerp import models, fields, api
 from openerp import modules
 from datetime import datetime
 
-import socket
+import hashlib
+
+# File of the zones managed by clouder, included in named.conf
+NAMED_CONF = '/etc/bind/named.conf.clouder'
 
 
 class ClouderDomain(models.Model):
@@ -35,6 +38,9 @@ class ClouderDomain(models.Model):
 
     _inherit = 'clouder.domain'
 
+    zone_serial = fields.Integer('Zone serial', readonly=True)
+    zone_checksum = fields.Char('Zone checksum', readonly=True)
+
     @property
     def configfile(self):
         """
@@ -43,75 +49,145 @@ class ClouderDomain(models.Model):
         """
         return'/etc/bind/db.' + self.name
 
+    @property
+    def bind_managed(self):
+        """
+        Property returning True if the zone is managed by a bind container.
+        """
+        return self.dns_id and \
+            self.dns_id.application_id.type_id.name == 'bind'
+
     @api.multi
-    def refresh_serial(self, domain=False):
+    def bind_records(self):
         """
-        Refresh the serial number in the config file
+        Return the lines of the records of the zone, generated from the
+        servers and the bases of the domain.
         """
-        if self.dns_id and self.dns_id.application_id.type_id.name == 'bind':
-            self.dns_id.execute([
+        records = []
+        for server in self.env['clouder.server'].search([
+                ('domain_id', '=', self.id), ('dns_record', '=', True)]):
+            records.append(server.name + ' IN A ' + server.ip)
+        link_obj = self.env['clouder.base.link']
+        for link in link_obj.search([
+                ('base_id.domain_id', '=', self.id),
+                ('name.type_id.name', '=', 'bind'),
+                ('deployed', '=', True)]):
+            proxy_link = link_obj.search([
+                ('base_id', '=', link.base_id.id),
+                ('name.type_id.name', '=', 'proxy')])
+            ip = proxy_link and proxy_link[0].target.server_id.ip or \
+                link.base_id.container_id.server_id.ip
+            if link.base_id.is_root:
+                records.append('@ IN A ' + ip)
+            records.append(link.base_id.name + ' IN A ' + ip)
+        return records
+
+    @api.multi
+    def bind_zones_config(self, exclude=False):
+        """
+        Return the config of all the zones of the bind container of the
+        domain.
+
+        :param exclude: The domains which shall not be in the config.
+        """
+        config = ''
+        slave_ip = self.dns_id.options['slave_ip']['value']
+        for domain in self.search([('dns_id', '=', self.dns_id.id)]):
+            if exclude and domain in exclude:
+                continue
+            config += 'zone "' + domain.name + '" {\n'
+            config += 'type master;\n'
+            # Configure this only if the option is set
+            if slave_ip:
+                config += 'allow-transfer { ' + slave_ip + ';};\n'
+            config += 'file "' + domain.configfile + '";\n'
+            config += 'notify yes;\n'
+            config += '};\n'
+        return config
+
+    @api.multi
+    def update_zone(self, force=False, now=False):
+        """
+        Generate the zone file and upload it if its content changed, with a
+        new serial. The zone is reloaded at the end of the job.
+
+        :param force: Upload the zone even if its content did not change.
+        :param now: Reload the zone now, when the records are needed by
+        the next commands of the job.
+        """
+        if not self.bind_managed:
+            return
+        template = modules.get_module_path('clouder_template_bind') + \
+            '/res/bind.config'
+        with open(template) as f:
+            zone = f.read()
+        zone = zone.replace('DOMAIN', self.name)
+        zone = zone.replace('IP', self.dns_id.server_id.ip)
+        zone += ''.join([record + '\n' for record in self.bind_records()])
+
+        checksum = hashlib.sha1(zone).hexdigest()
+        if not force and checksum == self.zone_checksum:
+            self.log('Zone ' + self.name + ' is unchanged')
+            return
+
+        # Serial in the YYYYMMDDnn format from RFC 1912
+        serial = max(
+            int(datetime.now().strftime('%Y%m%d')) * 100,
+            self.zone_serial + 1)
+        zone = zone.replace('1234 ;serial', str(serial) + ' ;serial')
+        self.dns_id.write_files({self.configfile + '.new': zone})
+        self.dns_id.execute(
+            ['mv', self.configfile + '.new', self.configfile])
+        self.write({'zone_serial': serial, 'zone_checksum': checksum})
+        cmd = [
+            'rndc', 'reload', self.name, '||', '/etc/init.d/bind9', 'restart']
+        if now:
+            self.dns_id.execute(cmd)
+        else:
+            self.dns_id.execute_reload(cmd)
+
+    @api.multi
+    def update_zones_config(self):
+        """
+        Upload the config of the zones of the bind container, and include it
+        in named.conf. The config is reloaded at the end of the job.
+        """
+        self.dns_id.write_files({NAMED_CONF: self.bind_zones_config()})
+        with self.dns_id.batch() as batch:
+            # Remove the zone appended to named.conf by older versions
+            batch.execute([
                 'sed', '-i',
-                '"s/[0-9]* ;serial/' +
-                datetime.now().strftime('%m%d%H%M%S') + ' ;serial/g"',
-                self.configfile])
-            self.dns_id.execute(['/etc/init.d/bind9 reload'])
-
-            if domain:
-                try:
-                    socket.gethostbyname(domain)
-                except:
-                    self.dns_id.start()
-                    pass
+                r"'/zone\s\"" + self.name + r"\"/,/END\s" + self.name +
+                "/d'", '/etc/bind/named.conf'])
+            batch.execute([
+                'grep', '-q', NAMED_CONF, '/etc/bind/named.conf', '||',
+                "echo 'include \"" + NAMED_CONF + "\";'", '>>',
+                '/etc/bind/named.conf'])
+        self.dns_id.execute_reload([
+            'rndc', 'reconfig', '||', '/etc/init.d/bind9', 'restart'])
 
     @api.multi
     def deploy(self):
         """
         Configure the domain in the bind container, if configured.
         """
-        if self.dns_id and self.dns_id.application_id.type_id.name == 'bind':
-            self.dns_id.send(
-                modules.get_module_path('clouder_template_bind') +
-                '/res/bind.config', self.configfile)
-            self.dns_id.execute([
-                'sed', '-i', '"s/DOMAIN/' + self.name + '/g"',
-                self.configfile])
-            self.dns_id.execute([
-                'sed', '-i',
-                '"s/IP/' + self.dns_id.server_id.ip + '/g"',
-                self.configfile])
-            self.dns_id.execute([
-                "echo 'zone \"" + self.name + "\" {' >> /etc/bind/named.conf"])
-            self.dns_id.execute([
-                'echo "type master;" >> /etc/bind/named.conf'])
-
-            # Configure this only if the option is set
-            if self.dns_id.options['slave_ip']['value']:
-                self.dns_id.execute([
-                    'echo "allow-transfer { ' +
-                    self.dns_id.options['slave_ip']['value'] + ';};" '
-                    '>> /etc/bind/named.conf'])
-
-            self.dns_id.execute([
-                "echo 'file \"/etc/bind/db." +
-                self.name + "\";' >> /etc/bind/named.conf"])
-            self.dns_id.execute(['echo "notify yes;" >> /etc/bind/named.conf'])
-            self.dns_id.execute(['echo "};" >> /etc/bind/named.conf'])
-            self.dns_id.execute([
-                'echo "//END ' + self.name + '" >> /etc/bind/named.conf'])
-            self.refresh_serial()
+        if self.bind_managed:
+            self.update_zone(force=True)
+            self.update_zones_config()
 
     @api.multi
     def purge(self):
         """
         Remove the domain config in the bind container.
         """
-        if self.dns_id and self.dns_id.application_id.type_id.name == 'bind':
-            self.dns_id.execute([
-                'sed', '-i',
-                r"'/zone\s\"" + self.name + r"\"/,/END\s" + self.name + "/d'",
-                '/etc/bind/named.conf'])
+        if self.bind_managed:
+            # The domain is still linked to the bind container
+            self.dns_id.write_files({NAMED_CONF: self.bind_zones_config(
+                exclude=self)})
             self.dns_id.execute(['rm', self.configfile])
-            self.dns_id.execute(['/etc/init.d/bind9 reload'])
+            self.write({'zone_checksum': False})
+            self.dns_id.execute_reload([
+                'rndc', 'reconfig', '||', '/etc/init.d/bind9', 'restart'])
 
 
 class ClouderBaseLink(models.Model):
@@ -121,25 +197,6 @@ class ClouderBaseLink(models.Model):
 
     _inherit = 'clouder.base.link'
 
-    @api.multi
-    def deploy_bind_config(self, name):
-        proxy_link = self.search([('base_id', '=', self.base_id.id), (
-            'name.type_id.name', '=', 'proxy')])
-        self.target.execute([
-            'echo "' + name + ' IN A ' +
-            (proxy_link and proxy_link[0].target.server_id.ip or
-             self.base_id.container_id.server_id.ip) +
-            '" >> ' + self.base_id.domain_id.configfile])
-        self.base_id.domain_id.refresh_serial(self.base_id.fulldomain)
-
-    @api.multi
-    def purge_bind_config(self, name):
-        self.target.execute([
-            'sed', '-i',
-            '"/' + name + r'\sIN\sA/d"',
-            self.base_id.domain_id.configfile])
-        self.base_id.domain_id.refresh_serial()
-
     @api.multi
     def deploy_link(self):
         """
@@ -148,15 +205,14 @@ class ClouderBaseLink(models.Model):
         """
         super(ClouderBaseLink, self).deploy_link()
         if self.name.type_id.name == 'bind':
-            if self.base_id.is_root:
-                self.deploy_bind_config('@')
-            self.deploy_bind_config(self.base_id.name)
-
             proxy_link = self.search([
                 ('base_id', '=', self.base_id.id),
                 ('name.type_id.name', '=', 'proxy')])
-            if proxy_link and proxy_link.target and not self.base_id.cert_key \
-                    and not self.base_id.cert_cert:
+            generate_cert = proxy_link and proxy_link.target \
+                and not self.base_id.cert_key and not self.base_id.cert_cert
+            # The certificate authority needs to resolve the new records
+            self.base_id.domain_id.update_zone(now=generate_cert)
+            if generate_cert:
                 self.base_id.generate_cert_exec()
 
     @api.multi
@@ -166,6 +222,4 @@ class ClouderBaseLink(models.Model):
         """
         super(ClouderBaseLink, self).purge_link()
         if self.name.type_id.name == 'bind':
-            if self.base_id.is_root:
-                self.purge_bind_config('@')
-            self.purge_bind_config(self.base_id.name)
+            self.base_id.domain_id.update_zone()
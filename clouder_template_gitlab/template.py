@@ -23,6 +23,51 @@
 from openerp import models, api, modules
 from datetime import datetime
 from openerp.addons.clouder import model
+import threading
+import time
+
+# Seconds during which the groups and projects read from gitlab are reused.
+GITLAB_CACHE_TIMEOUT = 300
+
+
+class GitlabCache(object):
+    """
+    Short-lived cache of the groups and projects read from the gitlab
+    instances, shared by all the threads of the process.
+    """
+
+    def __init__(self, timeout=GITLAB_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value of key, or None if it is missing or
+        expired.
+        """
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                return None
+            if time.time() - value[0] > self.timeout:
+                del self.values[key]
+                return None
+            return value[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = (time.time(), value)
+
+    def evict(self, *keys):
+        """
+        Remove the cached values of keys.
+        """
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+gitlab_cache = GitlabCache()
 
 
 class ClouderApplicationTypeOption(models.Model):
@@ -114,45 +159,96 @@ class ClouderContainerLink(models.Model):
         return {'PRIVATE-TOKEN':
                 self.target.base_ids[0].options['token']['value']}
 
+    def gitlab_group(self, name, data=None):
+        """
+        Return the group with the path name, and create it if it doesn't
+        exist.
+        """
+        key = (self.gitlab_url, 'group', name)
+        group = gitlab_cache.get(key)
+        if group:
+            return group
+        result = self.request(
+            self.gitlab_url + '/groups/' + name, headers=self.gitlab_headers)
+        if result.status_code != 200:
+            data = dict(data or {}, path=name)
+            result = self.request(
+                self.gitlab_url + '/groups', headers=self.gitlab_headers,
+                method='post', data=data)
+        group = result.json()
+        # The errors are not cached, so the next call retries
+        if 200 <= result.status_code < 300:
+            gitlab_cache.set(key, group)
+        return group
+
+    def gitlab_project(self, namespace, name):
+        """
+        Return the project name of the namespace, or False if it doesn't
+        exist.
+        """
+        key = (self.gitlab_url, 'project', namespace + '/' + name)
+        project = gitlab_cache.get(key)
+        if project:
+            return project
+        result = self.request(
+            self.gitlab_url + '/projects/' + namespace + '%2F' + name,
+            headers=self.gitlab_headers)
+        if result.status_code != 200:
+            return False
+        project = result.json()
+        gitlab_cache.set(key, project)
+        return project
+
+    def gitlab_create_project(self, namespace, name, group_id):
+        """
+        Create the project name in the group.
+        """
+        result = self.request(
+            self.gitlab_url + '/projects', headers=self.gitlab_headers,
+            method='post',
+            data={'name': name, 'namespace_id': group_id})
+        project = result.json()
+        if 200 <= result.status_code < 300:
+            gitlab_cache.set(
+                (self.gitlab_url, 'project', namespace + '/' + name),
+                project)
+        return project
+
+    def gitlab_variables(self, project_id, variables, new=False):
+        """
+        Set the build variables of a project. The existing variables are
+        read in one request, and only the missing or changed ones are
+        written.
+
+        :param variables: A dict with the keys and values of the variables.
+        :param new: The project was just created and has no variables.
+        """
+        url = self.gitlab_url + '/projects/' + project_id + '/variables'
+        existing = {}
+        if not new:
+            existing = dict([
+                (variable['key'], variable['value'])
+                for variable in self.request(
+                    url, headers=self.gitlab_headers).json()])
+        for key, value in sorted(variables.items()):
+            if key not in existing:
+                self.request(url, headers=self.gitlab_headers,
+                             method='post', data={'key': key, 'value': value})
+            elif existing[key] != value:
+                self.request(url + '/' + key, headers=self.gitlab_headers,
+                             method='put', data={'value': value})
+
     def gitlab_ressource(self, type, name, project_id='', data=None):
 
         if not data:
             data = {}
 
-        path = ''
         if type == 'group':
-            path = '/groups'
-
-        if type == 'group':
-            flag = False
-            data['path'] = name
-            groups = self.request(
-                self.gitlab_url + path, headers=self.gitlab_headers).json()
-            for group in groups:
-                if group['path'] == name:
-                    res = group
-                    flag = True
-            if not flag:
-                res = self.request(
-                    self.gitlab_url + path, headers=self.gitlab_headers,
-                    method='post', data=data).json()
+            res = self.gitlab_group(name, data=data)
 
         if type == 'variable':
-            data['key'] = name
-            if self.request(
-                    self.gitlab_url + '/projects/' + project_id +
-                    '/variables/' + name,
-                    headers=self.gitlab_headers).status_code != 200:
-                res = self.request(
-                    self.gitlab_url + '/projects/' + project_id + '/variables',
-                    headers=self.gitlab_headers, method='post',
-                    data=data).json()
-            else:
-                res = self.request(
-                    self.gitlab_url + '/projects/' + project_id +
-                    '/variables/' + name,
-                    headers=self.gitlab_headers, method='put',
-                    data=data).json()
+            self.gitlab_variables(project_id, {name: data['value']})
+            res = {'key': name, 'value': data['value']}
 
         if type == 'file':
             with open(modules.get_module_path(
@@ -209,57 +305,35 @@ class ClouderContainerLink(models.Model):
                 and self.container_id.application_id.check_tags(['files']):
             if self.target.base_ids:
 
-                if not self.container_id.parent_id.container_id.from_id:
-
-                    group_id = self.gitlab_ressource(
-                        'group', self.container_id.environment_id.prefix,
-                        data={'name': self.container_id.environment_id.name}
-                    )['id']
-
-                    project = self.request(
-                        self.gitlab_url + '/projects/' +
-                        self.container_id.environment_id.prefix + '%2F' +
-                        self.container_id.name, headers=self.gitlab_headers,
-                        params={'name': self.container_id.fullname})
-                    if project.status_code != 200:
-                        project = self.request(
-                            self.gitlab_url + '/projects',
-                            headers=self.gitlab_headers, method='post',
-                            data={'name': self.container_id.name,
-                                  'namespace_id': group_id}).json()
-                        self.gitlab_ressource(
-                            'variable', 'REGISTRY_DOMAIN',
-                            project_id=str(project['id']),
-                            data={
-                                'value':
-                                    self.container_id.links['registry'].
-                                    target.base_ids[0].fulldomain +
-                                    ':' + self.container_id.links['registry'].
-                                        target.ports['http']['hostport']})
-                        self.gitlab_ressource(
-                            'variable', 'REGISTRY_PASSWORD',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.options[
-                                      'registry_password']['value']})
-                        self.gitlab_ressource(
-                            'variable', 'SALT_DOMAIN',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.salt_master.server_id.fulldomain +
-                                  ':' +
-                                  self.salt_master.ports['api']['hostport']})
-                        self.gitlab_ressource(
-                            'variable', 'PRODUCTION_SERVER',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.server_id.fulldomain})
-                        self.gitlab_ressource(
-                            'variable', 'PRODUCTION_PASSWORD',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.
-                                  options['registry_password']['value']})
+                container = self.container_id
+                if not container.parent_id.container_id.from_id:
+
+                    namespace = container.environment_id.prefix
+                    project = self.gitlab_project(namespace, container.name)
+                    registry = container.links['registry'].target
+                    variables = {
+                        'REGISTRY_DOMAIN':
+                            registry.base_ids[0].fulldomain + ':' +
+                            registry.ports['http']['hostport'],
+                        'REGISTRY_PASSWORD':
+                            container.options['registry_password']['value'],
+                        'PRODUCTION_PASSWORD':
+                            container.options['registry_password']['value']}
+                    if not project:
+                        group_id = self.gitlab_group(
+                            namespace,
+                            data={'name': container.environment_id.name}
+                        )['id']
+                        project = self.gitlab_create_project(
+                            namespace, container.name, group_id)
+                        variables.update({
+                            'SALT_DOMAIN':
+                                self.salt_master.server_id.fulldomain + ':' +
+                                self.salt_master.ports['api']['hostport'],
+                            'PRODUCTION_SERVER':
+                                container.server_id.fulldomain})
+                        self.gitlab_variables(
+                            str(project['id']), variables, new=True)
                         self.gitlab_ressource(
                             'file', '.gitignore',
                             project_id=str(project['id']))
@@ -270,53 +344,23 @@ class ClouderContainerLink(models.Model):
                             'file', '.gitlab-ci.yml',
                             project_id=str(project['id']))
                     else:
-                        project = project.json()
-                        self.gitlab_ressource(
-                            'variable', 'REGISTRY_DOMAIN',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.links['registry'].
-                                  target.base_ids[0].fulldomain +
-                                  ':' +
-                                  self.container_id.links['registry'].
-                                  target.ports['http']['hostport']})
-                        self.gitlab_ressource(
-                            'variable', 'REGISTRY_PASSWORD',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.
-                                  options['registry_password']['value']})
-                        self.gitlab_ressource(
-                            'variable', 'PRODUCTION_PASSWORD',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.
-                                  options['registry_password']['value']})
+                        self.gitlab_variables(str(project['id']), variables)
 
                 else:
-                    from_id = self.container_id.parent_id.container_id.from_id
+                    from_id = container.parent_id.container_id.from_id
                     link = 'files' in from_id.childs \
                            and 'gitlab' in from_id.childs['files'].links \
                            and from_id.childs['files'].links['gitlab']
                     self.log(str(link))
                     if link:
-                        project = link.request(
-                            self.gitlab_url + '/projects/' +
-                            link.container_id.environment_id.prefix + '%2F' +
-                            link.container_id.name,
-                            headers=link.gitlab_headers,
-                            params={'name': link.container_id.fullname}).json()
-                        link.gitlab_ressource(
-                            'variable', 'STAGING_SERVER',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.server_id.fulldomain})
-                        link.gitlab_ressource(
-                            'variable', 'STAGING_PASSWORD',
-                            project_id=str(project['id']),
-                            data={'value':
-                                  self.container_id.
-                                  options['registry_password']['value']})
+                        project = link.gitlab_project(
+                            link.container_id.environment_id.prefix,
+                            link.container_id.name)
+                        link.gitlab_variables(str(project['id']), {
+                            'STAGING_SERVER': container.server_id.fulldomain,
+                            'STAGING_PASSWORD':
+                                container.options[
+                                    'registry_password']['value']})
 
         if self.name.type_id.name == 'registry':
             if 'gitlab' in self.container_id.links:
@@ -340,6 +384,15 @@ class ClouderContainerLink(models.Model):
                     '-n', self.container_id.fullname,
                 ])
 
+        elif self.name.type_id.name == 'gitlab' \
+                and self.container_id.application_id.check_tags(['files']):
+            if self.target.base_ids:
+                namespace = self.container_id.environment_id.prefix
+                gitlab_cache.evict(
+                    (self.gitlab_url, 'project',
+                     namespace + '/' + self.container_id.name),
+                    (self.gitlab_url, 'group', namespace))
+
 
 class ClouderBase(models.Model):
     """
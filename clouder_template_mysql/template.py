@@ -187,44 +187,78 @@ class ClouderSave(models.Model):
     @api.multi
     def save_database(self):
         """
-
-        :return:
+        Dump each database of the base in its own dump, the databases being
+        dumped concurrently. mydumper is used when the container has it,
+        otherwise mysqldump.
         """
 
         res = super(ClouderSave, self).save_database()
 
         if self.base_id.container_id.db_type == 'mysql':
             container = self.base_id.container_id
+            jobs = str(self.env.ref(
+                'clouder.clouder_settings').save_database_jobs or 1)
+            cmds = {}
             for key, database in self.base_id.databases.iteritems():
-                container.execute([
+                dumpfile = '/base-backup/' + self.name + '/' + \
+                    self.database_dumpfile(key)
+                cmds[database] = [
+                    'if', 'command', '-v', 'mydumper', '>/dev/null;', 'then',
+                    'mydumper',
+                    '-h', container.db_server,
+                    '-u', container.db_user,
+                    '-p', container.db_password,
+                    '-B', database, '-t', jobs, '-o', dumpfile, ';',
+                    'else',
                     'mysqldump',
                     '-h', container.db_server,
                     '-u', container.db_user,
                     '-p' + container.db_password,
-                    database, '>', '/base-backup/' + self.name +
-                    '/' + self.base_dumpfile],
-                    username=self.base_id.application_id.type_id.system_user)
+                    database, '>', dumpfile, ';',
+                    'fi']
+            self.execute_databases(
+                container, cmds,
+                username=self.base_id.application_id.type_id.system_user)
+            self.write({'dump_per_database': True})
         return res
 
     @api.multi
     def restore_database(self, base):
         super(ClouderSave, self).restore_database(base)
         if base.container_id.db_type == 'mysql':
-
+            container = base.container_id
+            db = container.database
             for key, database in base.databases.iteritems():
-                db = base.container_id.database
                 db.execute([
                     "mysql -u root -p'" +
-                    database.root_password +
+                    db.root_password +
                     "' -se \"create database " + database + ";\""])
                 db.execute([
                     "mysql -u root -p'" +
-                    database.root_password +
+                    db.root_password +
                     "' -se \"grant all on " + database + ".* to '" +
-                    base.conteneur_id.db_user + "';\""])
-                base.conteneur_id.execute([
-                    'mysql', '-h', base.conteneur_id.db_server, '-u',
-                    base.conteneur_id.db_user,
-                    '-p' + base.conteneur_id.db_password, database,
-                    '<', '/base-backup/' + self.name + '/' +
-                    self.base_dumpfile])
+                    container.db_user + "';\""])
+
+            jobs = str(self.env.ref(
+                'clouder.clouder_settings').save_database_jobs or 1)
+            cmds = {}
+            for key, database in base.databases.iteritems():
+                dumpfile = '/base-backup/restore-' + self.name + '/' + (
+                    self.dump_per_database and self.database_dumpfile(key) or
+                    self.base_dumpfile)
+                # mydumper saves a directory, mysqldump a single file
+                cmds[database] = [
+                    'if', '[', '-d', dumpfile, '];', 'then',
+                    'myloader',
+                    '-h', container.db_server,
+                    '-u', container.db_user,
+                    '-p', container.db_password,
+                    '-B', database, '-t', jobs, '-o', '-d', dumpfile, ';',
+                    'else',
+                    'mysql',
+                    '-h', container.db_server,
+                    '-u', container.db_user,
+                    '-p' + container.db_password,
+                    database, '<', dumpfile, ';',
+                    'fi']
+            self.execute_databases(container, cmds)
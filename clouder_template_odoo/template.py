@@ -21,6 +21,7 @@
 ##############################################################################
 
 from openerp import models, api
+from openerp.addons.clouder.model import CursorRegistry
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -31,6 +32,36 @@ except ImportError:
     _logger.debug('Cannot `import erppeek`.')
 
 
+class OdooClients(object):
+    """
+    Authenticated erppeek clients of the odoo bases, per cursor, so all
+    the hooks of a job share the same client instead of login again.
+    """
+
+    def __init__(self):
+        self.clients = CursorRegistry(dict)
+
+    def _clients(self, cr):
+        return self.clients.get(cr)
+
+    def get(self, cr, key, connect):
+        """
+        Return the client of key, calling connect if there is none.
+        """
+        clients = self._clients(cr)
+        if key not in clients:
+            clients[key] = connect()
+        return clients[key]
+
+    def set(self, cr, key, client):
+        """
+        Store a client already logged in.
+        """
+        self._clients(cr)[key] = client
+
+odoo_clients = OdooClients()
+
+
 class ClouderContainer(models.Model):
     """
     Add methods to manage the postgres specificities.
@@ -99,6 +130,98 @@ class ClouderBase(models.Model):
         return self.container_id.childs['exec'] and \
             self.container_id.childs['exec'].ports['http']['hostport']
 
+    @property
+    def odoo_url(self):
+        return 'http://' + self.container_id.server_id.ip + ':' + \
+            self.odoo_port
+
+    @api.multi
+    def odoo_client(self, user=False):
+        """
+        Return the erppeek client of the base, logged in with user or the
+        admin of the base. The client is reused until the end of the job.
+
+        :param user: The login of the user.
+        """
+        user = user or self.admin_name
+
+        def _connect():
+            self.log(
+                "client = erppeek.Client('" + self.odoo_url + "', db=" +
+                self.fullname_ + ", user=" + user + ", password=$$$" +
+                self.admin_password + "$$$)")
+            return erppeek.Client(
+                self.odoo_url, db=self.fullname_, user=user,
+                password=self.admin_password)
+
+        return odoo_clients.get(
+            self.env.cr, (self.odoo_url, self.fullname_, user), _connect)
+
+    @api.multi
+    def odoo_xmlids(self, client, xmlids):
+        """
+        Return the ids of several xmlids with one call, in a dict.
+
+        :param client: The erppeek client.
+        :param xmlids: The list of 'module.name' xmlids.
+        """
+        domain = ['|'] * (len(xmlids) - 1)
+        for xmlid in xmlids:
+            module, name = xmlid.split('.', 1)
+            domain.extend(['&', ('module', '=', module), ('name', '=', name)])
+        self.log("client.model('ir.model.data').search_read(" +
+                 str(domain) + ")")
+        res = {}
+        for data in client.execute(
+                'ir.model.data', 'search_read', domain,
+                ['module', 'name', 'res_id']):
+            res[data['module'] + '.' + data['name']] = data['res_id']
+        return res
+
+    @api.multi
+    def odoo_install(self, client, modules):
+        """
+        Install the modules which are not installed yet, with one registry
+        reload.
+
+        :param client: The erppeek client.
+        :param modules: The list of the module names.
+        """
+        modules = [m.strip() for m in modules if m.strip()]
+        if not modules:
+            return
+        module_ids = client.execute('ir.module.module', 'search', [
+            ('name', 'in', modules),
+            ('state', 'not in', ['installed', 'to upgrade'])])
+        if module_ids:
+            self.log("client.model('ir.module.module')"
+                     ".button_immediate_install(" + str(modules) + ")")
+            client.execute(
+                'ir.module.module', 'button_immediate_install', module_ids)
+
+    @api.multi
+    def odoo_set_params(self, client, params):
+        """
+        Set several config parameters, with one call to read the existing
+        ones.
+
+        :param client: The erppeek client.
+        :param params: A dict of the values by key.
+        """
+        self.log("client.model('ir.config_parameter').set " + str(params))
+        existing = {}
+        for param in client.execute(
+                'ir.config_parameter', 'search_read',
+                [('key', 'in', params.keys())], ['key', 'value']):
+            existing[param['key']] = param
+        for key, value in params.iteritems():
+            if key not in existing:
+                client.execute('ir.config_parameter', 'create',
+                               {'key': key, 'value': value})
+            elif existing[key]['value'] != value:
+                client.execute('ir.config_parameter', 'write',
+                               [existing[key]['id']], {'value': value})
+
     @api.multi
     def deploy_database(self):
         """
@@ -112,12 +235,8 @@ class ClouderBase(models.Model):
                 username=self.application_id.type_id.system_user)
 
             if self.build == 'build':
-                self.log("client = erppeek.Client('http://" +
-                         self.container_id.server_id.ip + ":" +
-                         self.odoo_port + "')")
-                client = erppeek.Client(
-                    'http://' + self.container_id.server_id.ip +
-                    ':' + self.odoo_port)
+                self.log("client = erppeek.Client('" + self.odoo_url + "')")
+                client = erppeek.Client(self.odoo_url)
                 self.log(
                     "client.create_database('$$$" +
                     self.container_id.childs['data'].db_password + "$$$','" +
@@ -129,6 +248,10 @@ class ClouderBase(models.Model):
                     self.fullname_, demo=self.test,
                     lang=self.lang,
                     user_password=self.admin_password)
+                # The client is now logged in the new database
+                odoo_clients.set(
+                    self.env.cr, (self.odoo_url, self.fullname_, 'admin'),
+                    client)
                 self.container_id.childs['exec'].start_exec()
                 return True
         return super(ClouderBase, self).deploy_database()
@@ -140,47 +263,41 @@ class ClouderBase(models.Model):
         """
         res = super(ClouderBase, self).deploy_build()
         if self.application_id.type_id.name == 'odoo':
-            self.log(
-                "client = erppeek.Client('http://" +
-                self.container_id.server_id.ip + ":" +
-                self.odoo_port + "," +
-                "db=" + self.fullname_ + "," +
-                "user='admin', password=$$$" + self.admin_password + "$$$)")
-            client = erppeek.Client(
-                'http://' + self.container_id.server_id.ip + ':' +
-                self.odoo_port,
-                db=self.fullname_, user='admin',
-                password=self.admin_password)
+            client = self.odoo_client(user='admin')
 
-            self.log(
-                "admin_id = client.model('ir.model.data')"
-                ".get_object_reference('base', 'user_root')[1]")
-            admin_id = client.model('ir.model.data')\
-                .get_object_reference('base', 'user_root')[1]
+            xmlids = self.odoo_xmlids(
+                client, ['base.user_root', 'base.group_no_one'])
+            admin_id = xmlids['base.user_root']
             self.log("client.model('res.users').write([" + str(admin_id) +
-                     "], {'login': " + self.admin_name + "})")
-            client.model('res.users').write([admin_id],
-                                            {'login': self.admin_name})
-
-            self.log("extended_group_id = client.model('ir.model.data')"
-                     ".get_object_reference('base', 'group_no_one')[1]")
-            extended_group_id = client.model('ir.model.data')\
-                .get_object_reference('base', 'group_no_one')[1]
-            self.log(
-                "client.model('res.users').write([" + str(admin_id) +
-                "], {'groups_id': [(4, " + str(extended_group_id) + ")]})")
-            client.model('res.users').write(
-                [1], {'groups_id': [(4, extended_group_id)]})
-
-            if self.application_id.options['default_account_chart']['value']\
-                    or self.options['account_chart']['value']:
-                account_chart = self.options['account_chart']['value']\
-                    or self.application_id.options[
-                        'default_account_chart']['value']
-                self.log("client.install('account_accountant', "
-                         "'account_chart_install', '" + account_chart + "')")
-                client.install('account_accountant', 'account_chart_install',
-                               account_chart)
+                     "], {'login': " + self.admin_name + ", 'groups_id': "
+                     "[(4, " + str(xmlids['base.group_no_one']) + ")]})")
+            client.model('res.users').write([admin_id], {
+                'login': self.admin_name,
+                'groups_id': [(4, xmlids['base.group_no_one'])]})
+            # The session stays valid with the new login
+            odoo_clients.set(
+                self.env.cr, (self.odoo_url, self.fullname_, self.admin_name),
+                client)
+
+            # All the modules are installed with one registry reload
+            modules = []
+            account_chart = self.options['account_chart']['value'] or \
+                self.application_id.options['default_account_chart']['value']
+            if account_chart:
+                modules += [
+                    'account_accountant', 'account_chart_install',
+                    account_chart]
+            if self.application_id.options['install_modules']['value']:
+                modules += self.application_id.options['install_modules'][
+                    'value'].split(',')
+            if self.test and \
+                    self.application_id.options['test_install_modules'][
+                        'value']:
+                modules += self.application_id.options[
+                    'test_install_modules']['value'].split(',')
+            self.odoo_install(client, modules)
+
+            if account_chart:
                 self.log("client.execute('account.chart.template', "
                          "'install_chart', '" + account_chart + "', '" +
                          account_chart + "_pcg_chart_template', 1, 1)")
@@ -188,13 +305,6 @@ class ClouderBase(models.Model):
                                account_chart,
                                account_chart + '_pcg_chart_template', 1, 1)
 
-            if self.application_id.options['install_modules']['value']:
-                modules = self.application_id.options['install_modules'][
-                    'value'].split(',')
-                for module in modules:
-                    self.log("client.install(" + module + ")")
-                    client.install(module)
-
         return res
 
     @api.multi
@@ -204,63 +314,18 @@ class ClouderBase(models.Model):
         """
         res = super(ClouderBase, self).deploy_post()
         if self.application_id.type_id.name == 'odoo':
-            self.log(
-                "client = erppeek.Client('http://" +
-                self.container_id.server_id.ip + ":" +
-                self.odoo_port +
-                ", db=" + self.fullname_ +
-                ", user=" + self.admin_name +
-                ", password=$$$" + self.admin_password + "$$$)")
-            client = erppeek.Client(
-                'http://' + self.container_id.server_id.ip + ':' +
-                self.odoo_port,
-                db=self.fullname_, user=self.admin_name,
-                password=self.admin_password)
+            client = self.odoo_client()
 
-            self.log("company_id = client.model('ir.model.data')"
-                     ".get_object_reference('base', 'main_company')[1]")
-            company_id = client.model('ir.model.data')\
-                .get_object_reference('base', 'main_company')[1]
+            company_id = self.odoo_xmlids(
+                client, ['base.main_company'])['base.main_company']
             self.log("client.model('res.company').write([" + str(company_id) +
                      "], {'name':" + self.title + "})")
             client.model('res.company').write([company_id],
                                               {'name': self.title})
 
-            self.log("config_ids = client.model('ir.config_parameter')"
-                     ".search([('key','=','web.base.url')])")
-            config_ids = client.model('ir.config_parameter').search(
-                [('key', '=', 'web.base.url')])
-            if config_ids:
-                self.log("client.model('ir.config_parameter').write(" +
-                         str(config_ids) + ", {'value': 'http://" +
-                         self.fulldomain + "})")
-                client.model('ir.config_parameter').write(config_ids, {
-                    'value': 'http://' + self.fulldomain})
-            else:
-                self.log("client.model('ir.config_parameter')"
-                         ".create({'key': 'web.base.url', 'value': 'http://" +
-                         self.fulldomain + "})")
-                client.model('ir.config_parameter').create(
-                    {'key': 'web.base.url',
-                     'value': 'http://' + self.fulldomain})
-
-            self.log(
-                "config_ids = client.model('ir.config_parameter')"
-                ".search([('key','=','ir_attachment.location')])")
-            config_ids = client.model('ir.config_parameter').search(
-                [('key', '=', 'ir_attachment.location')])
-            if config_ids:
-                self.log("client.model('ir.config_parameter').write(" +
-                         str(config_ids) + ", {'value': 'file:///filestore'})")
-                client.model('ir.config_parameter').write(config_ids, {
-                    'value': 'file:///filestore'})
-            else:
-                self.log("client.model('ir.config_parameter')"
-                         ".create({'key': 'ir_attachment.location', "
-                         "'value': 'file:///filestore'})")
-                client.model('ir.config_parameter').create(
-                    {'key': 'ir_attachment.location',
-                     'value': 'file:///filestore'})
+            self.odoo_set_params(client, {
+                'web.base.url': 'http://' + self.fulldomain,
+                'ir_attachment.location': 'file:///filestore'})
         return res
 
     @api.multi
@@ -272,26 +337,19 @@ class ClouderBase(models.Model):
         if self.application_id.type_id.name == 'odoo':
             if self.poweruser_name and self.poweruser_email \
                     and self.admin_name != self.poweruser_name:
-                self.log(
-                    "client = erppeek.Client('http://" +
-                    self.container_id.server_id.ip + ":" +
-                    self.odoo_port + "," +
-                    "db=" + self.fullname_ + "," + "user=" +
-                    self.admin_name + ", password=$$$" +
-                    self.admin_password + "$$$)"
-                )
-                client = erppeek.Client(
-                    'http://' + self.container_id.server_id.name +
-                    ':' + self.odoo_port,
-                    db=self.fullname_, user=self.admin_name,
-                    password=self.admin_password)
+                client = self.odoo_client()
 
+                xmlids = []
                 if self.test:
-                    self.log(
-                        "demo_id = client.model('ir.model.data')"
-                        ".get_object_reference('base', 'user_demo')[1]")
-                    demo_id = client.model('ir.model.data')\
-                        .get_object_reference('base', 'user_demo')[1]
+                    xmlids.append('base.user_demo')
+                group = self.application_id.options['poweruser_group'][
+                    'value']
+                if group:
+                    xmlids.append(group)
+                xmlids = xmlids and self.odoo_xmlids(client, xmlids) or {}
+
+                if self.test:
+                    demo_id = xmlids['base.user_demo']
                     self.log("client.model('res.users').write([" +
                              str(demo_id) + "], {'login': 'demo_odoo', "
                                             "'password': 'demo_odoo'})")
@@ -299,30 +357,20 @@ class ClouderBase(models.Model):
                                                     {'login': 'demo_odoo',
                                                      'password': 'demo_odoo'})
 
+                vals = {'login': self.poweruser_email,
+                        'name': self.poweruser_name,
+                        'email': self.poweruser_email,
+                        'password': self.poweruser_password}
+                if group:
+                    vals['groups_id'] = [(4, xmlids[group])]
                 self.log("user_id = client.model('res.users')"
                          ".create({'login':'" + self.poweruser_email +
                          "', 'name':'" + self.poweruser_name + "', 'email':'" +
                          self.poweruser_email + "', 'password':'$$$" +
-                         self.poweruser_password + "$$$'})")
-                user = client.model('res.users').create(
-                    {'login': self.poweruser_email,
-                     'name': self.poweruser_name,
-                     'email': self.poweruser_email,
-                     'password': self.poweruser_password})
-
-                if self.application_id.options['poweruser_group']['value']:
-                    group = self.application_id.options['poweruser_group'][
-                        'value'].split('.')
-                    self.log("group_id = client.model('ir.model.data')"
-                             ".get_object_reference('" + group[0] + "','" +
-                             group[1] + "')[1]")
-                    group_id = client.model('ir.model.data')\
-                        .get_object_reference(group[0], group[1])[1]
-                    self.log("client.model('res.groups').write([" +
-                             str(group_id) + "], {'users': [(4, " +
-                             str(user.id) + ")]})")
-                    client.model('res.groups').write([group_id],
-                                                     {'users': [(4, user.id)]})
+                         self.poweruser_password + "$$$'" +
+                         (group and ", 'groups_id': [(4, " +
+                          str(xmlids[group]) + ")]" or '') + "})")
+                client.model('res.users').create(vals)
         return res
 
     @api.multi
@@ -332,26 +380,12 @@ class ClouderBase(models.Model):
         """
         res = super(ClouderBase, self).deploy_test()
         if self.application_id.type_id.name == 'odoo':
-            self.log(
-                "client = erppeek.Client('http://" +
-                self.container_id.server_id.ip + ":" +
-                self.odoo_port + "," +
-                "db=" + self.fullname_ + "," + "user=" +
-                self.admin_name + ", password=$$$" +
-                self.admin_password + "$$$)"
-            )
-            client = erppeek.Client(
-                'http://' + self.container_id.server_id.ip + ':' +
-                self.odoo_port,
-                db=self.fullname_, user=self.admin_name,
-                password=self.admin_password)
-
+            # Already installed with the other modules on a new base
             if self.application_id.options['test_install_modules']['value']:
-                modules = self.application_id.options[
-                    'test_install_modules']['value'].split(',')
-                for module in modules:
-                    self.log("client.install(" + module + ")")
-                    client.install(module)
+                self.odoo_install(
+                    self.odoo_client(),
+                    self.application_id.options[
+                        'test_install_modules']['value'].split(','))
 
         return res
 
@@ -362,22 +396,10 @@ class ClouderBase(models.Model):
         """
         res = super(ClouderBase, self).post_reset()
         if self.application_id.type_id.name == 'odoo':
-            self.log("client = erppeek.Client('http://" +
-                     self.container_id.server_id.ip + ":" +
-                     self.odoo_port +
-                     ", db=" + self.fullname_ +
-                     ", user=" + self.admin_name +
-                     ", password=$$$" + self.admin_password + "$$$)")
-            client = erppeek.Client(
-                'http://' + self.container_id.server_id.ip + ':' +
-                self.odoo_port,
-                db=self.fullname_, user=self.admin_name,
-                password=self.admin_password)
-            self.log("server_id = client.model('ir.model.data')"
-                     ".get_object_reference('base', "
-                     "'ir_mail_server_localhost0')[1]")
-            server_id = client.model('ir.model.data')\
-                .get_object_reference('base', 'ir_mail_server_localhost0')[1]
+            client = self.odoo_client()
+            server_id = self.odoo_xmlids(
+                client, ['base.ir_mail_server_localhost0'])[
+                    'base.ir_mail_server_localhost0']
             self.log("client.model('ir.mail_server').write([" +
                      str(server_id) + "], {'smtp_host': 'mail.disabled.lol'})")
             client.model('ir.mail_server').write([server_id], {
@@ -445,16 +467,15 @@ class ClouderBaseLink(models.Model):
     _inherit = 'clouder.base.link'
 
     @api.multi
-    def nginx_config_update(self, target):
-        res = super(ClouderBaseLink, self).nginx_config_update(target)
+    def nginx_config_values(self):
+        res = super(ClouderBaseLink, self).nginx_config_values()
 
         if self.name.type_id.name == 'proxy' \
                 and self.base_id.application_id.type_id.name == 'odoo':
 
-            target.execute([
-                'sed', '-i', '"s/LONGPOLLING/' +
-                self.base_id.container_id.ports['longpolling']['hostport'] +
-                '/g"', self.base_id.nginx_configfile])
+            res.append((
+                'LONGPOLLING',
+                self.base_id.container_id.ports['longpolling']['hostport']))
         return res
 
     @api.multi
@@ -471,26 +492,10 @@ class ClouderBaseLink(models.Model):
                     and self.env.context['base_restoration']:
                 return
 
-            self.log("client = erppeek.Client('http://" +
-                     self.base_id.container_id.server_id.ip +
-                     ":" +
-                     self.base_id.odoo_port +
-                     "," + "db=" + self.base_id.fullname_ + "," +
-                     "user=" + self.base_id.admin_name + ", password=$$$" +
-                     self.base_id.admin_password + "$$$)")
-            client = erppeek.Client(
-                'http://' +
-                self.base_id.container_id.server_id.ip + ':' +
-                self.base_id.odoo_port,
-                db=self.base_id.fullname_,
-                user=self.base_id.admin_name,
-                password=self.base_id.admin_password)
-            self.log("server_id = client.model('ir.model.data')"
-                     ".get_object_reference('base', "
-                     "'ir_mail_server_localhost0')[1]")
-            server_id = client.model('ir.model.data')\
-                .get_object_reference('base',
-                                      'ir_mail_server_localhost0')[1]
+            client = self.base_id.odoo_client()
+            server_id = self.base_id.odoo_xmlids(
+                client, ['base.ir_mail_server_localhost0'])[
+                    'base.ir_mail_server_localhost0']
             self.log("client.model('ir.mail_server').write([" +
                      str(server_id) +
                      "], {'name': 'postfix', 'smtp_host': 'postfix'})")
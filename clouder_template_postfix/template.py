@@ -20,7 +20,7 @@
 #
 ##############################################################################
 
-from openerp import models, api
+from openerp import models, fields, api
 
 
 class ClouderContainer(models.Model):
@@ -164,6 +164,32 @@ class ClouderContainerLink(models.Model):
                 ['/etc/init.d/postfix', 'reload'])
 
 
+class ClouderDomain(models.Model):
+    """
+    Add the mail records of the bases in the zone of the domain.
+    """
+
+    _inherit = 'clouder.domain'
+
+    @api.multi
+    def bind_records(self):
+        records = super(ClouderDomain, self).bind_records()
+        link_obj = self.env['clouder.base.link']
+        for link in link_obj.search([
+                ('base_id.domain_id', '=', self.id),
+                ('name.type_id.name', '=', 'postfix'),
+                ('deployed', '=', True), ('dkim_key', '!=', False)]):
+            if not link_obj.search([
+                    ('base_id', '=', link.base_id.id),
+                    ('name.type_id.name', '=', 'bind'),
+                    ('deployed', '=', True)]):
+                continue
+            if link.base_id.is_root:
+                records.extend(link.bind_postfix_records('@'))
+            records.extend(link.bind_postfix_records(link.base_id.name))
+        return records
+
+
 class ClouderBaseLink(models.Model):
     """
     Add methods to manage the shinken specificities.
@@ -171,57 +197,31 @@ class ClouderBaseLink(models.Model):
 
     _inherit = 'clouder.base.link'
 
+    dkim_key = fields.Text('DKIM Key', readonly=True)
+
     @api.multi
-    def deploy_bind_postfix_config(self, dns_link, key, name):
-        dns_link.purge_bind_config(name)
-        dns_link.deploy_bind_config(name)
+    def bind_postfix_records(self, name):
+        """
+        Return the mail records of the base in the zone of its domain.
+
+        :param name: The name of the record.
+        """
         base = self.base_id
-        dns = dns_link.target
-        dns.execute([
-            'echo "' + name + ' IN MX 1 ' +
-            base.name +
-            ' ; mx:' + base.fulldomain + '" >> ' +
-            base.domain_id.configfile])
         smtp_relayhost = ''
         if self.target.options['smtp_relayhost']['value']:
             smtp_relayhost = \
                 ' a:' + self.target.options['smtp_relayhost']['value'] + ' '
-        dns.execute([
-            'echo \'' + name + ' IN TXT "v=spf1 a mx ptr mx:' +
-            base.fulldomain + ' ip4:10.0.0.0/8 ip4:127.0.0.0/8 ip4:' +
-            self.target.server_id.ip + smtp_relayhost + ' ~all"\' >> ' +
-            base.domain_id.configfile])
-        dns.execute([
-            'echo \'' + name + ' IN SPF "v=spf1 a mx ptr mx:' +
-            base.fulldomain + ' ip4:10.0.0.0/8 ip4:127.0.0.0/8 ip4:' +
-            self.target.server_id.ip + smtp_relayhost + ' ~all"\' >> ' +
-            base.domain_id.configfile])
-        dns.execute([
-            'echo \'' +
-            key.replace('(', '').replace(')', '').replace('"\n', '')
-            .replace('"p', 'p').replace('\n', '')
-            .replace('_domainkey', '_domainkey.' + name) +
-            '\' >> ' + base.domain_id.configfile])
-        base.domain_id.refresh_serial()
-
-    @api.multi
-    def purge_bind_postfix_config(self, dns_link, name):
-        dns_link.purge_bind_config(name)
-        base = self.base_id
-        dns = dns_link.target
-        dns.execute([
-            'sed', '-i',
-            '"/mail._domainkey.' + name + '/d"',
-            base.domain_id.configfile])
-        dns.execute([
-            'sed', '-i',
-            '"/' + base.name + ' for ' + base.domain_id.name + '/d"',
-            base.domain_id.configfile])
-        dns.execute([
-            'sed', '-i',
-            '"/mx:' + base.fulldomain + '/d"',
-            base.domain_id.configfile])
-        base.domain_id.refresh_serial()
+        spf = 'v=spf1 a mx ptr mx:' + base.fulldomain + \
+            ' ip4:10.0.0.0/8 ip4:127.0.0.0/8 ip4:' + \
+            self.target.server_id.ip + smtp_relayhost + ' ~all'
+        return [
+            name + ' IN MX 1 ' + base.name + ' ; mx:' + base.fulldomain,
+            name + ' IN TXT "' + spf + '"',
+            name + ' IN SPF "' + spf + '"',
+            self.dkim_key.replace('(', '').replace(')', '')
+            .replace('"\n', '').replace('"p', 'p').replace('\n', '')
+            .replace('_domainkey', '_domainkey.' + name),
+        ]
 
     @api.multi
     def deploy_link(self):
@@ -267,10 +267,8 @@ class ClouderBaseLink(models.Model):
                     'cat', '/opt/opendkim/keys/' +
                     base.fullname + '/mail.txt'])
 
-                if self.base_id.is_root:
-                    self.deploy_bind_postfix_config(dns_link, key, '@')
-                self.deploy_bind_postfix_config(
-                    dns_link, key, self.base_id.name)
+                self.dkim_key = key
+                base.domain_id.update_zone()
 
     @api.multi
     def purge_link(self):
@@ -300,6 +298,5 @@ class ClouderBaseLink(models.Model):
                 self.target.execute(
                     ['/etc/init.d/opendkim', 'start'])
 
-                if self.base_id.is_root:
-                    self.purge_bind_postfix_config(dns_link, '@')
-                self.purge_bind_postfix_config(dns_link, self.base_id.name)
+                self.dkim_key = False
+                base.domain_id.update_zone()
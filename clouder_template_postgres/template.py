@@ -163,22 +163,28 @@ class ClouderSave(models.Model):
     @api.multi
     def save_database(self):
         """
-
-        :return:
+        Dump each database of the base in its own directory, with
+        pg_dump -j, the databases being dumped concurrently.
         """
 
         res = super(ClouderSave, self).save_database()
 
         if self.base_id.container_id.db_type == 'pgsql':
             container = self.base_id.container_id.base_backup_container
+            jobs = str(self.env.ref(
+                'clouder.clouder_settings').save_database_jobs or 1)
+            cmds = {}
             for key, database in self.base_id.databases.iteritems():
-                container.execute([
-                    'pg_dump', '-O', ''
+                cmds[database] = [
+                    'pg_dump', '-O', '-Fd', '-j', jobs,
                     '-h', self.container_id.db_server,
-                    '-U', self.container_id.db_user, database,
-                    '>', '/base-backup/' + self.name + '/' +
-                    self.base_dumpfile],
-                    username=self.base_id.application_id.type_id.system_user)
+                    '-U', self.container_id.db_user,
+                    '-f', '/base-backup/' + self.name + '/' +
+                    self.database_dumpfile(key), database]
+            self.execute_databases(
+                container, cmds,
+                username=self.base_id.application_id.type_id.system_user)
+            self.write({'dump_per_database': True})
         return res
 
     @api.multi
@@ -191,11 +197,27 @@ class ClouderSave(models.Model):
                                    base.container_id.db_server, '-U',
                                    base.container_id.db_user,
                                    database])
-                container.execute([
-                    'cat',
-                    '/base-backup/restore-' + self.name +
-                    '/' + self.base_dumpfile,
-                    '|', 'psql', '-q', '-h',
-                    base.container_id.db_server, '-U',
-                    base.container_id.db_user,
-                    database])
+            if not self.dump_per_database:
+                # Saves made before the databases had their own dump
+                for key, database in base.databases.iteritems():
+                    container.execute([
+                        'cat',
+                        '/base-backup/restore-' + self.name +
+                        '/' + self.base_dumpfile,
+                        '|', 'psql', '-q', '-h',
+                        base.container_id.db_server, '-U',
+                        base.container_id.db_user,
+                        database])
+                return
+
+            jobs = str(self.env.ref(
+                'clouder.clouder_settings').save_database_jobs or 1)
+            cmds = {}
+            for key, database in base.databases.iteritems():
+                cmds[database] = [
+                    'pg_restore', '-O', '-j', jobs,
+                    '-h', base.container_id.db_server,
+                    '-U', base.container_id.db_user, '-d', database,
+                    '/base-backup/restore-' + self.name + '/' +
+                    self.database_dumpfile(key)]
+            self.execute_databases(container, cmds)
@@ -22,8 +22,12 @@
 
 from openerp import modules
 from openerp import models, api
+from openerp.addons.clouder.model import render_config
 from datetime import datetime, timedelta
 
+# Command checking the nginx configuration before reloading it
+NGINX_RELOAD = ['nginx', '-t', '&&', '/etc/init.d/nginx', 'reload']
+
 
 class ClouderBase(models.Model):
     """
@@ -54,27 +58,20 @@ class ClouderBase(models.Model):
             proxy = proxy_link.target
             proxy_link.purge_link()
             webroot = '/var/www/' + self.fullname + '-certs'
-            proxy.execute(['mkdir -p ' + webroot])
-            proxy.send(
-                modules.get_module_path(
-                    'clouder_template_proxy'
-                ) + '/res/nginx.config', self.nginx_configfile)
-            proxy.execute([
-                'ln', '-s', self.nginx_configfile,
-                '/etc/nginx/sites-enabled/' + self.fullname])
-            proxy.execute([
-                'sed', '-i', '"s/BASE/' + self.name + '/g"',
-                self.nginx_configfile])
             domain = self.fulldomain
             if self.is_root:
                 domain = domain + ' ' + self.name + '.' + self.fulldomain
+            proxy.write_files({self.nginx_configfile: render_config(
+                [modules.get_module_path('clouder_template_proxy') +
+                 '/res/nginx.config'],
+                [('BASE', self.name), ('DOMAIN', domain),
+                 ('REPO', self.fullname)])})
+            # The webroot needs to be served before asking the certificate
             proxy.execute([
-                'sed', '-i', '"s/DOMAIN/' + domain +
-                '/g"', self.nginx_configfile])
-            proxy.execute([
-                'sed', '-i', '"s/REPO/' + self.fullname +
-                '/g"', self.nginx_configfile])
-            proxy.execute(['/etc/init.d/nginx', 'reload'])
+                'mkdir -p ' + webroot, '&&', 'ln', '-sf',
+                self.nginx_configfile,
+                '/etc/nginx/sites-enabled/' + self.fullname, '&&'] +
+                NGINX_RELOAD)
             domain = self.fulldomain
             if self.is_root:
                 domain = domain + ' -d ' + self.name + '.' + self.fulldomain
@@ -95,11 +92,9 @@ class ClouderBase(models.Model):
                         (datetime.now() +
                          timedelta(days=45)).strftime("%Y-%m-%d")})
             proxy.execute([
-                'rm',
-                '/etc/nginx/sites-enabled/' + self.fullname])
-            proxy.execute(['rm', self.nginx_configfile])
-            proxy.execute(['/etc/init.d/nginx', 'reload'])
-            proxy.execute(['rm -rf ' + webroot])
+                'rm', '/etc/nginx/sites-enabled/' + self.fullname,
+                self.nginx_configfile, ';', 'rm -rf ' + webroot])
+            proxy.execute_reload(NGINX_RELOAD)
             proxy_link.deploy_link()
         return res
 
@@ -113,13 +108,11 @@ class ClouderBase(models.Model):
         if proxy_links:
             proxy_link = proxy_links[0]
             proxy = proxy_link.target
-            proxy.execute([
-                'echo', '"' + self.cert_cert + '"', '>',
-                '/etc/letsencrypt/live/' + self.fulldomain + '/fullchain.pem'
-            ])
-            proxy.execute([
-                'echo', '"' + self.cert_key + '"', '>',
-                '/etc/letsencrypt/live/' + self.fulldomain + '/privkey.pem'])
+            proxy.write_files({
+                '/etc/letsencrypt/live/' + self.fulldomain +
+                '/fullchain.pem': self.cert_cert,
+                '/etc/letsencrypt/live/' + self.fulldomain +
+                '/privkey.pem': (self.cert_key, 0600)})
             proxy.execute([
                 '/opt/letsencrypt/letsencrypt-auto renew --force-renew'])
             key = proxy.execute([
@@ -144,8 +137,48 @@ class ClouderBaseLink(models.Model):
     _inherit = 'clouder.base.link'
 
     @api.multi
-    def nginx_config_update(self, target):
-        return
+    def nginx_config_values(self):
+        """
+        Return the (placeholder, value) tuples used to render the nginx
+        config of the base, in the order they are replaced.
+        """
+        container = self.base_id.container_id
+        protocol = port = ''
+        if 'http' in container.ports:
+            protocol = 'http'
+            port = container.ports['http']['hostport']
+        if 'https' in container.ports:
+            protocol = 'https'
+            port = container.ports['https']['hostport']
+        return [
+            ('BASE', self.base_id.name),
+            ('DOMAIN', self.base_id.fulldomain),
+            ('SERVER', container.server_id.ip),
+            ('PORT', port),
+            ('PROTOCOL', protocol),
+        ]
+
+    @api.multi
+    def nginx_config(self):
+        """
+        Render the nginx config of the base from the template of its
+        application, or the default one of the proxy.
+        """
+        if not self.base_id.ssl_only:
+            configfile = 'proxy.config'
+        else:
+            configfile = 'proxy-sslonly.config'
+        proxy_path = modules.get_module_path('clouder_template_proxy')
+        templates = [proxy_path + '/res/' + configfile]
+        module_path = modules.get_module_path(
+            'clouder_template_' + self.base_id.application_id.type_id.name)
+        if module_path:
+            configtemplate = module_path + '/res/' + configfile
+            if self.local_file_exist(configtemplate):
+                templates = [configtemplate]
+        if self.base_id.is_root:
+            templates.append(proxy_path + '/res/proxy-root.config')
+        return render_config(templates, self.nginx_config_values())
 
     @api.multi
     def deploy_link(self):
@@ -154,92 +187,33 @@ class ClouderBaseLink(models.Model):
         """
         super(ClouderBaseLink, self).deploy_link()
         if self.name.type_id.name == 'proxy':
-            if not self.base_id.ssl_only:
-                configfile = 'proxy.config'
-            else:
-                configfile = 'proxy-sslonly.config'
             target = self.target
-            module_path = modules.get_module_path(
-                'clouder_template_' + self.base_id.application_id.type_id.name)
-            flag = True
-            if module_path:
-                configtemplate = module_path + '/res/' + configfile
-                if self.local_file_exist(configtemplate):
-                    target.send(
-                        configtemplate, self.base_id.nginx_configfile)
-                    flag = False
-            if flag:
-                target.send(
-                    modules.get_module_path(
-                        'clouder_template_proxy'
-                    ) + '/res/' + configfile, self.base_id.nginx_configfile)
-
-            if self.base_id.is_root:
-                target.send(
-                    modules.get_module_path(
-                        'clouder_template_proxy'
-                    ) + '/res/proxy-root.config',
-                    self.base_id.nginx_configfile + '-root')
-                target.execute([
-                    'cat', self.base_id.nginx_configfile + '-root',
-                    '>>',  self.base_id.nginx_configfile])
-                target.execute(['rm', self.base_id.nginx_configfile + '-root'])
-            target.execute([
-                'sed', '-i', '"s/BASE/' + self.base_id.name + '/g"',
-                self.base_id.nginx_configfile])
-            target.execute([
-                'sed', '-i', '"s/DOMAIN/' + self.base_id.fulldomain +
-                '/g"', self.base_id.nginx_configfile])
-            target.execute([
-                'sed', '-i', '"s/SERVER/' +
-                self.base_id.container_id.server_id.ip + '/g"',
-                self.base_id.nginx_configfile])
-            if 'http' in self.base_id.container_id.ports:
-                protocol = 'http'
-                port = self.base_id.container_id.ports['http']['hostport']
-            if 'https' in self.base_id.container_id.ports:
-                protocol = 'https'
-                port = self.base_id.container_id.ports['https']['hostport']
-            target.execute([
-                'sed', '-i', '"s/PORT/' +
-                port +
-                '/g"', self.base_id.nginx_configfile])
-            target.execute([
-                'sed', '-i', '"s/PROTOCOL/' +
-                protocol +
-                '/g"', self.base_id.nginx_configfile])
-
-            self.nginx_config_update(target)
-            # self.deploy_prepare_apache(cr, uid, vals, context)
-            cert_file = '/etc/ssl/certs/' + self.base_id.fulldomain + '.crt'
-            key_file = '/etc/ssl/private/' + self.base_id.fulldomain + '.key'
-            if self.base_id.cert_cert and self.base_id.cert_key:
-                target.execute([
-                    'echo', '"' + self.base_id.cert_cert + '"', '>', cert_file
-                ])
-                target.execute([
-                    'echo', '"' + self.base_id.cert_key + '"', '>', key_file])
-            elif self.base_id.domain_id.cert_cert\
-                    and self.base_id.domain_id.cert_key:
-                target.execute([
-                    'echo', '"' + self.base_id.domain_id.cert_cert + '"',
-                    '>', cert_file])
-                target.execute([
-                    'echo', '"' + self.base_id.domain_id.domain_cert_key + '"',
-                    '>', key_file])
-            else:
-                target.execute([
-                    'openssl', 'req', '-x509', '-nodes', '-days', '365',
-                    '-newkey', 'rsa:2048', '-out', cert_file,
-                    ' -keyout', key_file, '-subj', '"/C=FR/L=Paris/O=' +
-                    self.base_id.domain_id.organisation +
-                    '/CN=' + self.base_id.name +
-                    '.' + self.base_id.domain_id.name + '"'])
-
-            target.execute([
-                'ln', '-s', self.base_id.nginx_configfile,
-                '/etc/nginx/sites-enabled/' + self.base_id.fullname])
-            target.execute(['/etc/init.d/nginx', 'reload'])
+            base = self.base_id
+            cert_file = '/etc/ssl/certs/' + base.fulldomain + '.crt'
+            key_file = '/etc/ssl/private/' + base.fulldomain + '.key'
+
+            files = {base.nginx_configfile: self.nginx_config()}
+            if base.cert_cert and base.cert_key:
+                files[cert_file] = base.cert_cert
+                files[key_file] = (base.cert_key, 0600)
+            elif base.domain_id.cert_cert and base.domain_id.cert_key:
+                files[cert_file] = base.domain_id.cert_cert
+                files[key_file] = (base.domain_id.cert_key, 0600)
+            target.write_files(files)
+
+            with target.batch() as batch:
+                if key_file not in files:
+                    batch.execute([
+                        'openssl', 'req', '-x509', '-nodes', '-days', '365',
+                        '-newkey', 'rsa:2048', '-out', cert_file,
+                        ' -keyout', key_file, '-subj', '"/C=FR/L=Paris/O=' +
+                        base.domain_id.organisation +
+                        '/CN=' + base.name +
+                        '.' + base.domain_id.name + '"'])
+                batch.execute([
+                    'ln', '-sf', base.nginx_configfile,
+                    '/etc/nginx/sites-enabled/' + base.fullname])
+            target.execute_reload(NGINX_RELOAD)
 
     @api.multi
     def purge_link(self):
@@ -249,12 +223,14 @@ class ClouderBaseLink(models.Model):
         super(ClouderBaseLink, self).purge_link()
         if self.name.type_id.name == 'proxy':
             target = self.target
-            target.execute([
-                'rm',
-                '/etc/nginx/sites-enabled/' + self.base_id.fullname])
-            target.execute(['rm', self.base_id.nginx_configfile])
-            target.execute([
-                'rm', '/etc/ssl/certs/' + self.base_id.fulldomain + '.*'])
-            target.execute([
-                'rm', '/etc/ssl/private/' + self.base_id.fulldomain + '.*'])
-            target.execute(['/etc/init.d/nginx', 'reload'])
+            with target.batch() as batch:
+                batch.execute([
+                    'rm',
+                    '/etc/nginx/sites-enabled/' + self.base_id.fullname])
+                batch.execute(['rm', self.base_id.nginx_configfile])
+                batch.execute([
+                    'rm', '/etc/ssl/certs/' + self.base_id.fulldomain + '.*'])
+                batch.execute([
+                    'rm',
+                    '/etc/ssl/private/' + self.base_id.fulldomain + '.*'])
+            target.execute_reload(NGINX_RELOAD)
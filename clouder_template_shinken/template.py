@@ -21,7 +21,24 @@
 ##############################################################################
 
 from openerp import modules
-from openerp import models, api
+from openerp import models, fields, api
+from openerp.addons.clouder.model import render_config
+import base64
+from datetime import datetime
+
+SHINKEN_ETC = '/usr/local/shinken/etc'
+SHINKEN_RELOAD = ['/usr/local/shinken/bin/init.d/shinken', 'reload']
+SHINKEN_COMMAND_FILE = '/usr/local/shinken/var/rw/nagios.cmd'
+# The check called by nrpe in the backup containers
+BACKUP_CHECK = '/usr/lib/nagios/plugins/check_backup'
+
+
+def shinken_template(name):
+    """
+    Return the local path of a shinken configuration template.
+    """
+    return modules.get_module_path('clouder_template_shinken') + \
+        '/res/' + name + '.config'
 
 
 class ClouderServer(models.Model):
@@ -36,7 +53,7 @@ class ClouderServer(models.Model):
         """
         Property returning the shinken config file.
         """
-        return '/usr/local/shinken/etc/hosts/' + self.fulldomain + '.cfg'
+        return SHINKEN_ETC + '/hosts/' + self.fulldomain + '.cfg'
 
 
 class ClouderContainer(models.Model):
@@ -46,12 +63,152 @@ class ClouderContainer(models.Model):
 
     _inherit = 'clouder.container'
 
+    @api.multi
+    def _compute_is_shinken(self):
+        for container in self:
+            container.is_shinken = \
+                container.application_id.type_id.name == 'shinken'
+
+    is_shinken = fields.Boolean(
+        'Is shinken?', compute='_compute_is_shinken')
+
     @property
     def shinken_configfile(self):
         """
         Property returning the shinken config file.
         """
-        return '/usr/local/shinken/etc/services/' + self.fullname + '.cfg'
+        return SHINKEN_ETC + '/services/' + self.fullname + '.cfg'
+
+    @property
+    def shinken_container(self):
+        """
+        Property returning the shinken container targeted by the links, the
+        parent of the data and exec containers.
+        """
+        return self.parent_id and self.parent_id.container_id or self
+
+    @api.multi
+    def shinken_general_config(self):
+        """
+        Return the general configuration file of shinken, with the domain
+        of the shinken base sending the notifications if it is deployed.
+        """
+        values = [('SYSADMIN_MAIL', self.email_sysadmin)]
+        base = self.env['clouder.base'].search([
+            ('container_id', '=', self.shinken_container.id),
+            ('application_id.type_id.name', '=', 'shinken')], limit=1)
+        if base and not self.env.context.get('shinken_purge_base'):
+            values.append(('SHINKENDOMAIN', base.fulldomain))
+        return render_config([shinken_template('general-shinken')], values)
+
+    @api.multi
+    def shinken_services(self):
+        """
+        Return the files of the services directory, by file name, generated
+        from the deployed links to the shinken container.
+        """
+        container = self.shinken_container
+        services = {'clouder.cfg': self.shinken_general_config()}
+        for link in self.env['clouder.container.link'].search([
+                ('target', '=', container.id),
+                ('name.type_id.name', '=', 'shinken'),
+                ('deployed', '=', True)]):
+            if link.container_id.autosave:
+                services[link.container_id.fullname + '.cfg'] = \
+                    link.shinken_config()
+        for link in self.env['clouder.base.link'].search([
+                ('target', '=', container.id),
+                ('name.type_id.name', '=', 'shinken'),
+                ('deployed', '=', True)]):
+            services[link.base_id.fullname + '.cfg'] = link.shinken_config()
+        return services
+
+    @api.multi
+    def shinken_regenerate(self):
+        self = self.with_context(no_enqueue=True)
+        self.do('shinken_regenerate', 'shinken_regenerate_exec')
+
+    @api.multi
+    def shinken_regenerate_exec(self):
+        """
+        Rebuild the services directory from the database. The files are
+        written in a new versioned directory, then the services symlink is
+        renamed over to point to it, so shinken never reads a partial
+        directory.
+        """
+        if self.application_id.type_id.name != 'shinken':
+            self.raise_error(
+                'The container ' + self.fullname +
+                ' is not a shinken container.')
+        version = 'services.' + datetime.now().strftime('%Y%m%d.%H%M%S')
+        self.execute(['rm', '-rf', SHINKEN_ETC + '/' + version],
+                     username='shinken')
+        self.write_files(dict(
+            (SHINKEN_ETC + '/' + version + '/' + name, config)
+            for name, config in self.shinken_services().iteritems()),
+            username='shinken')
+        self.execute([
+            'cd', SHINKEN_ETC, '&&',
+            # The services directory of the older containers is moved away
+            # once, to be replaced by the symlink
+            'if [ ! -L services ]; then mv services services.orig; fi', '&&',
+            'ln', '-sfn', version, 'services.link', '&&',
+            'mv', '-T', 'services.link', 'services', '&&',
+            'ls', '-d', 'services.*', '|', 'grep', '-vx', version, '|',
+            'xargs', '-r', 'rm', '-rf'], username='shinken')
+        self.execute_reload(SHINKEN_RELOAD, username='shinken')
+
+    @api.multi
+    def shinken_backups(self):
+        """
+        Return the backup containers of the containers and bases watched
+        by the shinken container.
+        """
+        container = self.shinken_container
+        backups = self.browse()
+        for link in self.env['clouder.container.link'].search([
+                ('target', '=', container.id),
+                ('name.type_id.name', '=', 'shinken'),
+                ('deployed', '=', True)]):
+            if link.container_id.autosave and link.container_id.backup_ids:
+                backups |= link.container_id.backup_ids[0]
+        for link in self.env['clouder.base.link'].search([
+                ('target', '=', container.id),
+                ('name.type_id.name', '=', 'shinken'),
+                ('deployed', '=', True)]):
+            if link.base_id.autosave and link.base_id.backup_ids:
+                backups |= link.base_id.backup_ids[0]
+        return backups
+
+    @api.model
+    def shinken_check_backups_all(self):
+        """
+        Check the backups of all the shinken containers, called by cron.
+        """
+        for container in self.search([
+                ('application_id.type_id.name', '=', 'shinken'),
+                ('parent_id', '=', False)]):
+            container.shinken_check_backups()
+
+    @api.multi
+    def shinken_check_backups(self):
+        self = self.with_context(no_enqueue=True)
+        self.do('shinken_check_backups', 'shinken_check_backups_exec')
+
+    @api.multi
+    def shinken_check_backups_exec(self):
+        """
+        Check all the repositories of each backup container in one pass, and
+        send the results to shinken as passive checks.
+        """
+        results = ''
+        for backup in self.shinken_backups():
+            results += backup.execute(
+                [BACKUP_CHECK, backup.backup_method, 'all'])
+        if results.strip():
+            self.execute([
+                'echo', base64.b64encode(results), '|', 'base64', '-d',
+                '>>', SHINKEN_COMMAND_FILE], username='shinken')
 
     @api.multi
     def deploy_shinken_server(self, nrpe):
@@ -60,38 +217,23 @@ class ClouderContainer(models.Model):
         """
 
         server = nrpe.server_id
-        self.send(
-            modules.get_module_path('clouder_template_shinken') +
-            '/res/server-shinken.config', server.shinken_configfile,
+        self.write_files({server.shinken_configfile: render_config(
+            [shinken_template('server-shinken')], [
+                ('IP', server.ip),
+                ('NAME', server.name),
+                ('SSHPORT', str(server.ssh_port)),
+                ('NRPEPORT', nrpe.ports['nrpe']['hostport'])])},
             username='shinken')
-        self.execute([
-            'sed', '-i',
-            '"s/IP/' + server.ip + '/g"',
-            server.shinken_configfile], username='shinken')
-        self.execute([
-            'sed', '-i',
-            '"s/NAME/' + server.name + '/g"',
-            server.shinken_configfile], username='shinken')
-        self.execute([
-            'sed', '-i',
-            '"s/SSHPORT/' + str(server.ssh_port) + '/g"',
-            server.shinken_configfile], username='shinken')
-        self.execute([
-            'sed', '-i',
-            '"s/NRPEPORT/' + nrpe.ports['nrpe']['hostport'] + '/g"',
-            server.shinken_configfile], username='shinken')
-        self.execute(['/usr/local/shinken/bin/init.d/shinken', 'reload'],
-                     username='shinken')
+        self.execute_reload(SHINKEN_RELOAD, username='shinken')
 
     @api.multi
     def purge_shinken_server(self, nrpe):
         """
         Remove the configuration file.
         """
-        self.execute(['rm', nrpe.server_id.shinken_configfile],
-                     username='shinken')
-        self.execute(['/usr/local/shinken/bin/init.d/shinken', 'reload'],
+        self.execute(['rm', '-f', nrpe.server_id.shinken_configfile],
                      username='shinken')
+        self.execute_reload(SHINKEN_RELOAD, username='shinken')
 
     @api.multi
     def deploy_post(self):
@@ -101,18 +243,11 @@ class ClouderContainer(models.Model):
         super(ClouderContainer, self).deploy_post()
         if self.application_id.type_id.name == 'shinken' \
                 and self.application_id.check_tags(['data']):
-            self.send(
-                modules.get_module_path('clouder_template_shinken') +
-                '/res/general-shinken.config',
-                '/usr/local/shinken/etc/services/clouder.cfg',
-                username='shinken')
-            self.execute([
-                'sed', '-i', '"s/SYSADMIN_MAIL/' +
-                self.email_sysadmin + '/g"',
-                '/usr/local/shinken/etc/services/clouder.cfg'],
-                username='shinken')
+            self.write_files({
+                SHINKEN_ETC + '/services/clouder.cfg':
+                    self.shinken_general_config()}, username='shinken')
             self.execute(
-                ['rm', '/usr/local/shinken/etc/hosts/localhost.cfg'],
+                ['rm', SHINKEN_ETC + '/hosts/localhost.cfg'],
                 username='shinken')
 
 
@@ -128,40 +263,38 @@ class ClouderBase(models.Model):
         """
         Property returning the shinken config file.
         """
-        return '/usr/local/shinken/etc/services/' + self.fullname + '.cfg'
+        return SHINKEN_ETC + '/services/' + self.fullname + '.cfg'
 
     @api.multi
     def deploy_post(self):
         """
-        Update odoo configuration.
+        Set the domain of the notifications in the general configuration.
         """
         res = super(ClouderBase, self).deploy_post()
         if self.application_id.type_id.name == 'shinken':
-            self.container_id.execute([
-                'sed', '-i', '"s/SHINKENDOMAIN/' +
-                self.fulldomain + '/g"',
-                '/usr/local/shinken/etc/services/clouder.cfg'],
-                username='shinken')
-
-            self.container_id.execute(
-                ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
+            self.container_id.write_files({
+                SHINKEN_ETC + '/services/clouder.cfg':
+                    self.container_id.shinken_general_config()},
                 username='shinken')
+            self.container_id.execute_reload(
+                SHINKEN_RELOAD, username='shinken')
         return res
 
     @api.multi
     def purge_post(self):
         """
-        Remove filestore.
+        Remove the domain of the notifications from the general
+        configuration.
         """
         res = super(ClouderBase, self).purge_post()
         if self.application_id.type_id.name == 'shinken':
-            self.container_id.execute([
-                'sed', '-i', '"s/' + self.fulldomain + '/SHINKENDOMAIN/g"',
-                '/usr/local/shinken/etc/services/clouder.cfg'],
-                username='shinken')
-            self.container_id.execute(
-                ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
+            container = self.container_id.with_context(
+                shinken_purge_base=True)
+            container.write_files({
+                SHINKEN_ETC + '/services/clouder.cfg':
+                    container.shinken_general_config()},
                 username='shinken')
+            container.execute_reload(SHINKEN_RELOAD, username='shinken')
         return res
 
 
@@ -172,54 +305,33 @@ class ClouderContainerLink(models.Model):
 
     _inherit = 'clouder.container.link'
 
+    @api.multi
+    def shinken_config(self):
+        """
+        Return the configuration file watching the container.
+        """
+        container = self.container_id
+        backup = container.backup_ids[0]
+        return render_config([shinken_template('container-shinken')], [
+            ('BACKUPIP', backup.server_id.ip),
+            ('PORT', backup.ports['nrpe']['hostport']),
+            ('METHOD', backup.backup_method),
+            ('TYPE', 'container'),
+            ('UNIQUE_NAME', container.fullname),
+            ('HOST', container.server_id.name)])
+
     @api.multi
     def deploy_link(self):
         """
         Deploy the configuration file to watch the container.
         """
         super(ClouderContainerLink, self).deploy_link()
-        if self.name.type_id.name == 'shinken':
-            if self.container_id.autosave:
-                config_file = 'container-shinken'
-                self.target.send(
-                    modules.get_module_path('clouder_template_shinken') +
-                    '/res/' + config_file + '.config',
-                    self.container_id.shinken_configfile, username='shinken')
-                self.target.execute([
-                    'sed', '-i',
-                    '"s/BACKUPIP/' +
-                    self.container_id.backup_ids[0].server_id.ip + '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i',
-                    '"s/PORT/' +
-                    self.container_id.backup_ids[0].ports['nrpe']['hostport'] +
-                    '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i', '"s/METHOD/' +
-                    self.container_id.backup_ids[0].backup_method + '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i', '"s/TYPE/container/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i',
-                    '"s/BACKUPIP/' +
-                    self.container_id.backup_ids[0].server_id.ip + '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i',
-                    '"s/UNIQUE_NAME/' + self.container_id.fullname + '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-                self.target.execute([
-                    'sed', '-i',
-                    '"s/HOST/' + self.container_id.server_id.name + '/g"',
-                    self.container_id.shinken_configfile], username='shinken')
-
-                self.target.execute(
-                    ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
-                    username='shinken')
+        if self.name.type_id.name == 'shinken' \
+                and self.container_id.autosave:
+            self.target.write_files({
+                self.container_id.shinken_configfile: self.shinken_config()},
+                username='shinken')
+            self.target.execute_reload(SHINKEN_RELOAD, username='shinken')
 
     @api.multi
     def purge_link(self):
@@ -228,11 +340,10 @@ class ClouderContainerLink(models.Model):
         """
         super(ClouderContainerLink, self).purge_link()
         if self.name.type_id.name == 'shinken':
-            self.target.execute(['rm', self.container_id.shinken_configfile],
-                                username='shinken')
             self.target.execute(
-                ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
+                ['rm', '-f', self.container_id.shinken_configfile],
                 username='shinken')
+            self.target.execute_reload(SHINKEN_RELOAD, username='shinken')
 
 
 class ClouderBaseLink(models.Model):
@@ -242,6 +353,30 @@ class ClouderBaseLink(models.Model):
 
     _inherit = 'clouder.base.link'
 
+    @api.multi
+    def shinken_config(self):
+        """
+        Return the configuration file watching the base.
+        """
+        base = self.base_id
+        config_file = 'base-shinken'
+        values = []
+        if base.autosave:
+            backup = base.backup_ids[0]
+            values = [
+                ('BACKUPIP', backup.server_id.ip),
+                ('PORT', backup.ports['nrpe']['hostport']),
+                ('METHOD', backup.backup_method)]
+        else:
+            config_file = 'base-shinken-nosave'
+        values += [
+            ('TYPE', 'base'),
+            ('UNIQUE_NAME', base.fullname),
+            ('DATABASES', base.databases_comma),
+            ('BASE', base.name),
+            ('DOMAIN', base.fulldomain)]
+        return render_config([shinken_template(config_file)], values)
+
     @api.multi
     def deploy_link(self):
         """
@@ -249,48 +384,10 @@ class ClouderBaseLink(models.Model):
         """
         super(ClouderBaseLink, self).deploy_link()
         if self.name.type_id.name == 'shinken':
-            config_file = 'base-shinken'
-            if not self.base_id.autosave:
-                config_file = 'base-shinken-nosave'
-            self.target.send(
-                modules.get_module_path('clouder_template_shinken') +
-                '/res/' + config_file + '.config',
-                self.base_id.shinken_configfile, username='shinken')
-            self.target.execute([
-                'sed', '-i',
-                '"s/BACKUPIP/' +
-                self.base_id.backup_ids[0].server_id.ip + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i',
-                '"s/PORT/' +
-                self.base_id.backup_ids[0].ports['nrpe']['hostport'] + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i', '"s/METHOD/' +
-                self.base_id.backup_ids[0].backup_method + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i', '"s/TYPE/base/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i',
-                '"s/UNIQUE_NAME/' + self.base_id.fullname + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i',
-                '"s/DATABASES/' + self.base_id.databases_comma + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i', '"s/BASE/' + self.base_id.name + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute([
-                'sed', '-i',
-                '"s/DOMAIN/' + self.base_id.fulldomain + '/g"',
-                self.base_id.shinken_configfile], username='shinken')
-            self.target.execute(
-                ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
+            self.target.write_files({
+                self.base_id.shinken_configfile: self.shinken_config()},
                 username='shinken')
+            self.target.execute_reload(SHINKEN_RELOAD, username='shinken')
 
     @api.multi
     def purge_link(self):
@@ -299,8 +396,6 @@ class ClouderBaseLink(models.Model):
         """
         super(ClouderBaseLink, self).purge_link()
         if self.name.type_id.name == 'shinken':
-            self.target.execute(['rm', self.base_id.shinken_configfile],
+            self.target.execute(['rm', '-f', self.base_id.shinken_configfile],
                                 username='shinken')
-            self.target.execute(
-                ['/usr/local/shinken/bin/init.d/shinken', 'reload'],
-                username='shinken')
+            self.target.execute_reload(SHINKEN_RELOAD, username='shinken')